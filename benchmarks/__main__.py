@@ -0,0 +1,88 @@
+#-------------------------------------------------------------------
+# benchmarks.__main__
+#
+# A minimal runner for the benchmark suite, for when asv is not
+# available.  Runs each time_* benchmark a few times and reports
+# the best wall time, along with the value of each track_*
+# benchmark.
+#
+# Usage:
+#   python -m benchmarks [substring]
+#-------------------------------------------------------------------
+
+import importlib
+import inspect
+import itertools
+import os
+import sys
+import time
+
+REPEAT = 3
+
+#-------------------------------------------------------------------
+def iter_suites():
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    for filename in sorted(os.listdir(directory)):
+        if filename.startswith('bench_') and filename.endswith('.py'):
+            module = importlib.import_module('benchmarks.' + filename [:-3])
+            for name, cls in inspect.getmembers(module, inspect.isclass):
+                if cls.__module__ == module.__name__ and name.endswith('Suite'):
+                    yield module.__name__, cls
+
+#-------------------------------------------------------------------
+def iter_params(cls):
+    params = getattr(cls, 'params', None)
+
+    if params is None:
+        return [()]
+    elif params and isinstance(params [0], list):
+        return list(itertools.product(*params))
+    else:
+        return [(param,) for param in params]
+
+#-------------------------------------------------------------------
+def run_benchmark(suite, name, args):
+    method = getattr(suite, name)
+
+    if name.startswith('track_'):
+        return '%s %s' % (method(*args), getattr(method, 'unit', ''))
+
+    times = []
+    for n in range(REPEAT):
+        start = time.perf_counter()
+        method(*args)
+        times.append(time.perf_counter() - start)
+
+    return '%.4fs' % min(times)
+
+#-------------------------------------------------------------------
+def main():
+    pattern = sys.argv [1] if len(sys.argv) > 1 else ''
+
+    for module_name, cls in iter_suites():
+        names = [name for name in dir(cls) if name.startswith(('time_', 'track_'))]
+
+        for args in iter_params(cls):
+            label = '%s.%s(%s)' % (module_name.split('.')[-1], cls.__name__,
+                                   ', '.join(repr(arg) for arg in args))
+            if pattern not in label:
+                continue
+
+            suite = cls()
+
+            try:
+                if hasattr(suite, 'setup'):
+                    suite.setup(*args)
+            except NotImplementedError:
+                continue
+
+            try:
+                for name in names:
+                    print('%-60s %-22s %s' % (label, name, run_benchmark(suite, name, args)), flush = True)
+            finally:
+                if hasattr(suite, 'teardown'):
+                    suite.teardown(*args)
+
+if __name__ == '__main__':
+    main()
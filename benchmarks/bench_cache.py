@@ -0,0 +1,57 @@
+#-------------------------------------------------------------------
+# benchmarks.bench_cache
+#
+# Benchmarks of saving messages to and loading them from the
+# message cache.
+#-------------------------------------------------------------------
+
+from webmail.application import CacheStatsCommand
+from webmail.fakeserver import generate_messages
+
+from .common import Workspace, get_server, reset_config
+
+#-------------------------------------------------------------------
+class CacheSuite():
+    """
+        BaseCommand.cache_save_message and cache_fetch_message over
+        a batch of synthetic messages.
+    """
+
+    params = [None, 'zlib']
+    param_names = ['compression']
+
+    #----------------------------------------------------------------
+    def setup(self, compression):
+        self.messages = [raw for raw, flags, date in
+                         generate_messages(200, attachment_ratio = 0.1)]
+        self.workspace = Workspace(get_server(0), cache_compression = compression)
+
+        reset_config()
+        self.command = CacheStatsCommand(self.workspace.argv())
+
+        for uid, raw in enumerate(self.messages, 1):
+            self.command.cache_save_message(uid, raw)
+
+    #----------------------------------------------------------------
+    def teardown(self, compression):
+        self.command.close()
+        self.workspace.remove()
+
+    #----------------------------------------------------------------
+    def time_save(self, compression):
+        for uid, raw in enumerate(self.messages, 1):
+            self.command.cache_save_message(uid, raw)
+
+    #----------------------------------------------------------------
+    def time_fetch(self, compression):
+        for uid in range(1, len(self.messages) + 1):
+            message = self.command.cache_fetch_message(uid)
+            for part in message.mailparts:
+                part.get_payload()
+            message.close()
+
+    #----------------------------------------------------------------
+    def track_stored_bytes(self, compression):
+        return self.command.get_cache().stats() ['stored_bytes']
+
+    track_stored_bytes.unit = 'bytes'
@@ -0,0 +1,105 @@
+#-------------------------------------------------------------------
+# benchmarks.bench_commands
+#
+# Benchmarks of the search and read commands against a fake IMAP
+# server on localhost.
+#-------------------------------------------------------------------
+
+from webmail.application import SearchMailCommand, ReadMailCommand
+
+from .common import Workspace, get_server, measure, run_command
+
+#-------------------------------------------------------------------
+class SearchMailSuite():
+    """
+        SearchMailCommand.run listing every message in the mailbox.
+        The text listing makes several requests per message, so it is
+        only measured on the smallest mailbox.
+    """
+
+    params = ([1000, 10000, 100000], ['jsonl', 'text'])
+    param_names = ['messages', 'format']
+    timeout = 600
+
+    #----------------------------------------------------------------
+    def setup(self, messages, format):
+        if format == 'text' and messages > 1000:
+            raise NotImplementedError()
+
+        self.server = get_server(messages)
+        self.workspace = Workspace(self.server)
+        self.argv = self.workspace.argv('--all', '--format', format)
+
+    #----------------------------------------------------------------
+    def teardown(self, messages, format):
+        self.workspace.remove()
+
+    #----------------------------------------------------------------
+    def time_search(self, messages, format):
+        self.workspace.clear_cache()
+        run_command(SearchMailCommand, self.argv)
+
+    #----------------------------------------------------------------
+    def track_round_trips(self, messages, format):
+        self.workspace.clear_cache()
+        return measure(self.server, SearchMailCommand, self.argv) ['round_trips']
+
+    track_round_trips.unit = 'commands'
+
+    #----------------------------------------------------------------
+    def track_bytes_received(self, messages, format):
+        self.workspace.clear_cache()
+        return measure(self.server, SearchMailCommand, self.argv) ['bytes_received']
+
+    track_bytes_received.unit = 'bytes'
+
+#-------------------------------------------------------------------
+class ReadMailSuite():
+    """
+        ReadMailCommand.run on a message with an attachment, with the
+        message cache empty (cold) or already holding it (warm).
+    """
+
+    params = ['cold', 'warm']
+    param_names = ['cache']
+
+    #----------------------------------------------------------------
+    def setup(self, cache):
+        self.server = get_server(1000)
+        self.workspace = Workspace(self.server)
+
+        # The largest message is one with an attachment.
+        mailbox = self.server.get_mailbox('INBOX')
+        largest = max(mailbox.messages, key = lambda message: len(message.raw))
+        self.argv = self.workspace.argv(str(largest.uid))
+
+        if cache == 'warm':
+            run_command(ReadMailCommand, self.argv)
+
+    #----------------------------------------------------------------
+    def teardown(self, cache):
+        self.workspace.remove()
+
+    #----------------------------------------------------------------
+    def prepare(self, cache):
+        if cache == 'cold':
+            self.workspace.clear_cache()
+
+    #----------------------------------------------------------------
+    def time_read(self, cache):
+        self.prepare(cache)
+        run_command(ReadMailCommand, self.argv)
+
+    #----------------------------------------------------------------
+    def track_round_trips(self, cache):
+        self.prepare(cache)
+        return measure(self.server, ReadMailCommand, self.argv) ['round_trips']
+
+    track_round_trips.unit = 'commands'
+
+    #----------------------------------------------------------------
+    def track_bytes_received(self, cache):
+        self.prepare(cache)
+        return measure(self.server, ReadMailCommand, self.argv) ['bytes_received']
+
+    track_bytes_received.unit = 'bytes'
@@ -0,0 +1,88 @@
+#-------------------------------------------------------------------
+# benchmarks.bench_config
+#
+# Benchmarks of query construction and configuration parsing.
+#-------------------------------------------------------------------
+
+import json
+import os
+import tempfile
+
+from webmail.application import SearchMailCommand
+from webmail.client import IMAPQuery
+from webmail.data import parse_json
+
+from .common import reset_config
+
+#-------------------------------------------------------------------
+class IMAPQuerySuite():
+    """
+        Building and rendering an IMAPQuery of many phrases.
+    """
+
+    params = [10, 100, 1000]
+    param_names = ['phrases']
+
+    #----------------------------------------------------------------
+    def time_build(self, phrases):
+        q = IMAPQuery()
+        for n in range(phrases // 2):
+            q = q.from_q('sender%d@example.com' % n).or_q(
+                    IMAPQuery().seen(), IMAPQuery().subject('report %d' % n))
+        str(q)
+
+#-------------------------------------------------------------------
+class ProcessConfigSuite():
+    """
+        BaseQueryCommand.process_config with a long chain of query
+        options, including --or and --not.
+    """
+
+    params = [10, 100, 1000]
+    param_names = ['options']
+
+    #----------------------------------------------------------------
+    def setup(self, options):
+        self.argv = ['--no-prompt']
+        for n in range(options // 4):
+            self.argv += ['--from', 'sender%d@example.com' % n, '--or',
+                          '--subject', 'report %d' % n, '--not', '--seen']
+
+    #----------------------------------------------------------------
+    def time_process_config(self, options):
+        reset_config()
+        SearchMailCommand(self.argv)
+
+#-------------------------------------------------------------------
+class ParseJSONSuite():
+    """
+        parse_json on a config file with many accounts and comments.
+    """
+
+    params = [100, 1000]
+    param_names = ['accounts']
+
+    #----------------------------------------------------------------
+    def setup(self, accounts):
+        fd, self.filename = tempfile.mkstemp(suffix = '.json')
+
+        with os.fdopen(fd, 'w') as f:
+            f.write('{\n')
+            for n in range(accounts):
+                f.write('    // Account %d\n' % n)
+                f.write('    "account%d": %s,\n' % (n, json.dumps({
+                    'imap_username':    'user%d@example.com' % n,
+                    'imap_hostname':    'imap%d.example.com' % n,
+                    'cache_max_bytes':  n * 1000000,
+                    'line_format':      '[$status] $uid <>     <$sender_name> $date'
+                })))
+            f.write('    /* The default account. */\n')
+            f.write('    "account": "account0"\n}\n')
+
+    #----------------------------------------------------------------
+    def teardown(self, accounts):
+        os.remove(self.filename)
+
+    #----------------------------------------------------------------
+    def time_parse_json(self, accounts):
+        parse_json(self.filename)
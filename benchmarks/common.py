@@ -0,0 +1,119 @@
+#-------------------------------------------------------------------
+# benchmarks.common
+#
+# Shared fixtures for the benchmark suite: fake IMAP servers with
+# synthetic mailboxes, and command configuration.
+#-------------------------------------------------------------------
+
+import contextlib
+import copy
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from webmail import application
+from webmail.fakeserver import FakeIMAPServer
+
+#-------------------------------------------------------------------
+# Commands update the module level DEFAULT_CONFIG in place, so it is
+# restored before each command is constructed.
+_DEFAULT_CONFIG = copy.deepcopy(application.DEFAULT_CONFIG)
+
+_SERVERS = {}
+
+#-------------------------------------------------------------------
+def get_server(count, seed = 0):
+    """
+        Get a running fake server with count synthetic messages in
+        its INBOX.  Servers are shared between benchmarks, as large
+        mailboxes take a while to generate.
+    """
+
+    key = (count, seed)
+    if key not in _SERVERS:
+        server = FakeIMAPServer().start()
+        server.populate(count, seed = seed)
+        _SERVERS [key] = server
+
+    return _SERVERS [key]
+
+#-------------------------------------------------------------------
+def reset_config():
+    application.DEFAULT_CONFIG.clear()
+    application.DEFAULT_CONFIG.update(copy.deepcopy(_DEFAULT_CONFIG))
+
+#-------------------------------------------------------------------
+class Workspace():
+    """
+        A temporary directory holding a config file which points the
+        commands at a fake server and a private cache directory.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, server, **settings):
+        self.directory = tempfile.mkdtemp(prefix = 'webmail-bench-')
+        self.cache_dir = os.path.join(self.directory, 'cache')
+        self.config_file = os.path.join(self.directory, 'webmail.json')
+
+        config = {
+            'imap_hostname':    server.hostname,
+            'imap_port':        server.port,
+            'imap_ssl':         False,
+            'imap_username':    server.username,
+            'imap_password':    server.password,
+            'cache_dir':        self.cache_dir,
+            'interactive':      False,
+            'mime:text/plain':  'PRINT'
+        }
+        config.update(settings)
+
+        with open(self.config_file, 'w') as f:
+            json.dump(config, f)
+
+    #----------------------------------------------------------------
+    def argv(self, *args):
+        return ['-c', self.config_file] + list(args)
+
+    #----------------------------------------------------------------
+    def clear_cache(self):
+        shutil.rmtree(self.cache_dir, ignore_errors = True)
+
+    #----------------------------------------------------------------
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+#-------------------------------------------------------------------
+def run_command(cls, argv):
+    """
+        Construct and run a command with its output discarded.
+        Returns the command.
+    """
+
+    reset_config()
+
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        command = cls(argv)
+        try:
+            command.run()
+        finally:
+            command.close()
+
+    return command
+
+#-------------------------------------------------------------------
+def measure(server, cls, argv):
+    """
+        Run a command against a fake server, returning a dictionary
+        with the number of commands sent and the bytes transferred.
+    """
+
+    server.reset_stats()
+    run_command(cls, argv)
+    return {
+        'round_trips':      server.stats ['commands'],
+        'bytes_received':   server.stats ['bytes_sent'],
+        'bytes_sent':       server.stats ['bytes_received']
+    }
@@ -0,0 +1,78 @@
+#-------------------------------------------------------------------
+# tests.common
+#
+# Shared fixtures for the test suite: a fake IMAP server with a
+# synthetic mailbox per test, and helpers to run commands against it.
+#-------------------------------------------------------------------
+
+import contextlib
+import io
+import os
+import unittest
+
+from webmail.cache import MailCache
+from webmail.fakeserver import FakeIMAPServer, DEFAULT_CAPABILITIES
+
+from benchmarks.common import Workspace, reset_config
+
+#-------------------------------------------------------------------
+class FakeServerTestCase(unittest.TestCase):
+    """
+        Starts a fake IMAP server with a synthetic INBOX of 'messages'
+        messages for each test, and a workspace whose config points
+        commands at it.
+    """
+
+    capabilities = DEFAULT_CAPABILITIES
+    messages = 10
+
+    #----------------------------------------------------------------
+    def setUp(self):
+        self.server = FakeIMAPServer(capabilities = self.capabilities).start()
+        self.server.populate(self.messages)
+        self.workspace = Workspace(self.server)
+
+    #----------------------------------------------------------------
+    def tearDown(self):
+        self.server.stop()
+        self.workspace.remove()
+
+    #----------------------------------------------------------------
+    def run_command(self, cls, *args):
+        """
+            Construct and run a command against the fake server.
+            Returns what it printed to stdout.
+        """
+
+        reset_config()
+        output = io.StringIO()
+
+        with contextlib.redirect_stdout(output):
+            command = cls(self.workspace.argv(*args))
+            try:
+                command.run()
+            finally:
+                command.close()
+
+        return output.getvalue()
+
+    #----------------------------------------------------------------
+    def get_cache(self):
+        return MailCache(os.path.join(self.workspace.cache_dir, 'default'))
+
+    #----------------------------------------------------------------
+    def get_mailbox(self, name = 'INBOX'):
+        return self.server.get_mailbox(name)
+
+#-------------------------------------------------------------------
+def header(raw, name):
+    """
+        Get the value of a header from a raw message, or None.
+    """
+
+    prefix = name.lower().encode() + b':'
+    for line in raw.split(b'\r\n\r\n', 1)[0].split(b'\r\n'):
+        if line.lower().startswith(prefix):
+            return line[len(prefix):].strip().decode()
+
+    return None
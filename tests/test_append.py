@@ -0,0 +1,69 @@
+#-------------------------------------------------------------------
+# tests.test_append
+#
+# Tests of MailClient.append with and without the LITERAL+ and
+# MULTIAPPEND extensions.
+#-------------------------------------------------------------------
+
+import datetime
+import os
+
+from webmail.client import MailClient
+from webmail.fakeserver import generate_messages
+
+from .common import FakeServerTestCase
+
+#-------------------------------------------------------------------
+class AppendTests(FakeServerTestCase):
+
+    messages = 0
+
+    #----------------------------------------------------------------
+    def append(self, messages, **kwargs):
+        client = MailClient()
+        client.connect(self.server.username, self.server.password,
+                       self.server.hostname, self.server.port, ssl = False)
+        try:
+            return client.append('INBOX', messages, **kwargs)
+        finally:
+            client.imap.logout()
+
+    #----------------------------------------------------------------
+    def check_append(self):
+        messages = list(generate_messages(25, attachment_ratio = 0.2))
+        date = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo = datetime.timezone.utc)
+
+        uids = self.append([(raw, flags, date) for raw, flags, internaldate in messages],
+                           batch_size = 10)
+
+        inbox = self.get_mailbox()
+        self.assertEqual(uids, list(range(1, 26)))
+        self.assertEqual([m.raw for m in inbox.messages], [raw for raw, flags, d in messages])
+        self.assertEqual([sorted(m.flags) for m in inbox.messages],
+                         [sorted(flags) for raw, flags, d in messages])
+
+    #----------------------------------------------------------------
+    def test_multiappend(self):
+        self.check_append()
+
+    #----------------------------------------------------------------
+    def test_pipelined(self):
+        self.server.capabilities.remove('MULTIAPPEND')
+        self.check_append()
+
+    #----------------------------------------------------------------
+    def test_synchronizing_literals(self):
+        for name in ['MULTIAPPEND', 'LITERAL+']:
+            self.server.capabilities.remove(name)
+        self.check_append()
+
+    #----------------------------------------------------------------
+    def test_file_with_bare_line_feeds(self):
+        filename = os.path.join(self.workspace.directory, 'message.eml')
+        with open(filename, 'wb') as f:
+            f.write(b'Subject: From a file\n\nLine one\nLine two\r\n')
+
+        self.append([(filename, [], None)])
+
+        self.assertEqual(self.get_mailbox().messages[0].raw,
+                         b'Subject: From a file\r\n\r\nLine one\r\nLine two\r\n')
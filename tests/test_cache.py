@@ -0,0 +1,164 @@
+#-------------------------------------------------------------------
+# tests.test_cache
+#
+# Tests of the framing of message cache files.
+#-------------------------------------------------------------------
+
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import unittest
+import zlib
+
+from webmail.cache import MailCache, CorruptCacheEntry, check_frame
+from webmail.cache import FOOTER_MAGIC, FRAME_FOOTER, FRAME_HEADER, LEGACY_FRAME_MAGIC
+from webmail.cache import ACCESS_BATCH_SIZE, INDEX_FILENAME
+
+#-------------------------------------------------------------------
+MESSAGE = b'Subject: Test\r\nMessage-ID: <1@example.com>\r\n\r\n' + b'Hello, world!\r\n' * 1000
+
+#-------------------------------------------------------------------
+class CacheFrameTests(unittest.TestCase):
+
+    compression = None
+
+    #----------------------------------------------------------------
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = 'webmail-test-')
+        self.cache = MailCache(self.directory, compression = self.compression)
+
+    #----------------------------------------------------------------
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+    #----------------------------------------------------------------
+    def damage(self, key, truncate = 0, offset = None):
+        filename = self.cache.filename(key)
+        with open(filename, 'rb') as f:
+            data = bytearray(f.read())
+
+        if truncate:
+            del data[-truncate:]
+        else:
+            data[len(data) // 2 if offset is None else offset] ^= 0xff
+
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    #----------------------------------------------------------------
+    def test_round_trip(self):
+        self.cache.save('1', MESSAGE)
+
+        self.assertEqual(self.cache.load('1'), MESSAGE)
+        self.assertEqual(self.cache.open_message('1').get_subject(), 'Test')
+
+    #----------------------------------------------------------------
+    def test_truncated_file_is_removed(self):
+        self.cache.save('1', MESSAGE)
+        self.damage('1', truncate = 3)
+
+        self.assertIsNone(self.cache.open_message('1'))
+        self.assertFalse(self.cache.has('1'))
+
+    #----------------------------------------------------------------
+    def test_checksum(self):
+        self.cache.save('1', MESSAGE)
+        self.damage('1')
+
+        data = self.cache.read('1')
+        self.assertRaises(CorruptCacheEntry, check_frame, data)
+        check_frame(data, verify = False)
+
+        self.assertIsNone(self.cache.load('1'))
+        self.assertFalse(self.cache.has('1'))
+
+    #----------------------------------------------------------------
+    def test_damaged_header_is_removed_when_opened(self):
+        self.cache.save('1', MESSAGE)
+        self.damage('1', offset = FRAME_HEADER.size + 2)
+
+        self.assertIsNone(self.cache.open_message('1'))
+        self.assertFalse(self.cache.has('1'))
+
+    #----------------------------------------------------------------
+    def test_legacy_frame(self):
+        frame = struct.pack('>4sBI', LEGACY_FRAME_MAGIC, 0, 0) + MESSAGE
+        with open(self.cache.filename('1'), 'wb') as f:
+            f.write(frame + FRAME_FOOTER.pack(FOOTER_MAGIC, len(frame), zlib.crc32(frame)))
+
+        self.assertEqual(self.cache.load('1'), MESSAGE)
+        self.assertEqual(self.cache.open_message('1').get_subject(), 'Test')
+
+    #----------------------------------------------------------------
+    def test_verify(self):
+        self.cache.save('1', MESSAGE)
+        self.cache.save('2', MESSAGE)
+        self.damage('1')
+
+        self.assertEqual(self.cache.verify(), 1)
+        self.assertEqual(list(self.cache.keys()), ['2'])
+
+#-------------------------------------------------------------------
+class CacheAccessTests(unittest.TestCase):
+
+    #----------------------------------------------------------------
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix = 'webmail-test-')
+        self.cache = MailCache(self.directory)
+        self.cache.get_index()
+
+    #----------------------------------------------------------------
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+    #----------------------------------------------------------------
+    def get_hits(self):
+        db = sqlite3.connect(os.path.join(self.directory, INDEX_FILENAME))
+        try:
+            return dict(db.execute("SELECT key, hits FROM entries"))
+        finally:
+            db.close()
+
+    #----------------------------------------------------------------
+    def test_accesses_are_written_on_close(self):
+        self.cache.save('1', MESSAGE)
+        self.cache.load('1')
+        self.cache.open_message('1').close()
+
+        self.assertEqual(self.get_hits(), {})
+
+        self.cache.close()
+        self.assertEqual(self.get_hits(), {'1': 2})
+
+    #----------------------------------------------------------------
+    def test_accesses_are_written_in_batches(self):
+        for n in range(ACCESS_BATCH_SIZE):
+            self.cache.touch(str(n), 100)
+
+        self.assertEqual(len(self.get_hits()), ACCESS_BATCH_SIZE)
+        self.assertEqual(self.cache.accesses, {})
+
+    #----------------------------------------------------------------
+    def test_removed_entry_is_not_written(self):
+        self.cache.save('1', MESSAGE)
+        self.cache.remove('1')
+        self.cache.close()
+
+        self.assertEqual(self.get_hits(), {})
+
+#-------------------------------------------------------------------
+class CompressedCacheFrameTests(CacheFrameTests):
+
+    compression = 'zlib'
+
+    #----------------------------------------------------------------
+    def test_damaged_file_is_removed_when_opened(self):
+        self.cache.save('1', MESSAGE)
+        self.damage('1')
+
+        self.assertIsNone(self.cache.open_message('1'))
+        self.assertFalse(self.cache.has('1'))
@@ -0,0 +1,96 @@
+#-------------------------------------------------------------------
+# tests.test_mime
+#
+# Tests of the lazy MIME scanner and of streaming part payloads.
+#-------------------------------------------------------------------
+
+import base64
+import quopri
+import random
+import unittest
+
+from webmail.mime import LazyMessage, decode_base64, find_header_end
+
+#-------------------------------------------------------------------
+def attachment_message(body, encoding = 'base64'):
+    return (b'Subject: Test\r\nMIME-Version: 1.0\r\n'
+            b'Content-Type: multipart/mixed; boundary="XX"\r\n\r\n'
+            b'--XX\r\nContent-Type: text/plain\r\n\r\nHello\r\n'
+            b'--XX\r\nContent-Type: application/octet-stream\r\n'
+            b'Content-Disposition: attachment; filename="data.bin"\r\n'
+            b'Content-Transfer-Encoding: ' + encoding.encode() + b'\r\n\r\n'
+            + body + b'\r\n--XX--\r\n')
+
+#-------------------------------------------------------------------
+def attachment(raw):
+    return [part for part in LazyMessage(raw).mailparts if part.filename][0]
+
+#-------------------------------------------------------------------
+class FindHeaderEndTests(unittest.TestCase):
+
+    #----------------------------------------------------------------
+    def test_separators(self):
+        self.assertEqual(find_header_end(b'A: b\r\n\r\nbody', 0, 12), (6, 8))
+        self.assertEqual(find_header_end(b'A: b\n\nbody', 0, 10), (5, 6))
+        self.assertEqual(find_header_end(b'\r\nbody', 0, 6), (0, 2))
+        self.assertEqual(find_header_end(b'A: b', 0, 4), (4, 4))
+
+    #----------------------------------------------------------------
+    def test_earliest_separator_wins(self):
+        buf = b'A: b\n\nbody\r\n\r\nmore'
+        self.assertEqual(find_header_end(buf, 0, len(buf)), (5, 6))
+
+        buf = b'A: b\r\n\r\nbody\n\nmore'
+        self.assertEqual(find_header_end(buf, 0, len(buf)), (6, 8))
+
+#-------------------------------------------------------------------
+class PayloadTests(unittest.TestCase):
+
+    #----------------------------------------------------------------
+    def setUp(self):
+        self.data = random.Random(0).randbytes(100 * 1024)
+        self.encoded = base64.encodebytes(self.data).replace(b'\n', b'\r\n')
+
+    #----------------------------------------------------------------
+    def assertStreams(self, part, expected):
+        for chunk_size in [1000, 4097, 65536, 1 << 20]:
+            self.assertEqual(b''.join(part.iter_payload(chunk_size)), expected)
+        self.assertEqual(part.get_payload(), expected)
+
+    #----------------------------------------------------------------
+    def test_base64(self):
+        self.assertStreams(attachment(attachment_message(self.encoded)), self.data)
+
+    #----------------------------------------------------------------
+    def test_base64_with_stray_bytes(self):
+        encoded = bytearray(self.encoded)
+        for pos, byte in [(100, b'!'), (50000, b'\x00'), (90001, b'*')]:
+            encoded[pos:pos] = byte
+
+        self.assertStreams(attachment(attachment_message(bytes(encoded))), self.data)
+
+    #----------------------------------------------------------------
+    def test_base64_without_padding(self):
+        data = self.data[:-1]
+        encoded = base64.encodebytes(data).rstrip(b'\n=')
+
+        self.assertStreams(attachment(attachment_message(encoded)), data)
+
+    #----------------------------------------------------------------
+    def test_base64_truncated(self):
+        # A lone character left at the end holds less than a byte.
+        encoded = base64.b64encode(b'hello world!!')[:-3]
+        self.assertEqual(decode_base64(encoded), b'hello world!')
+
+        part = attachment(attachment_message(encoded))
+        self.assertStreams(part, b'hello world!')
+
+    #----------------------------------------------------------------
+    def test_quoted_printable(self):
+        text = ('café ' * 5000).encode('utf-8')
+        encoded = quopri.encodestring(text).replace(b'\n', b'\r\n')
+
+        part = attachment(attachment_message(encoded, 'quoted-printable'))
+        for chunk_size in [1000, 4097]:
+            self.assertEqual(b''.join(part.iter_payload(chunk_size)).replace(b'\r\n', b'\n'),
+                             text)
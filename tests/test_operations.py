@@ -0,0 +1,143 @@
+#-------------------------------------------------------------------
+# tests.test_operations
+#
+# Tests of --copy, --move, --expunge, --export and --cache-index
+# against the fake server, and of how they keep the message cache
+# consistent.
+#-------------------------------------------------------------------
+
+import mailbox
+import os
+import unittest.mock
+
+from webmail.application import CacheIndexCommand, ReadMailCommand, RestoreCommand
+from webmail.application import SearchMailCommand
+from webmail.fakeserver import GMAIL_CAPABILITIES
+
+from .common import FakeServerTestCase, header
+
+#-------------------------------------------------------------------
+class CacheOperationTests(FakeServerTestCase):
+
+    #----------------------------------------------------------------
+    def test_move_does_not_shadow_other_uids(self):
+        self.run_command(ReadMailCommand, '5')
+        self.run_command(SearchMailCommand, '--uid', '5', '--move', 'Archive')
+
+        # Message 5 is UID 1 in Archive, which must not be confused
+        # with UID 1 in INBOX.
+        self.assertEqual(self.get_mailbox('Archive').messages[0].uid, 1)
+        self.assertEqual(self.run_command(ReadMailCommand, '1'),
+                         self.run_command(ReadMailCommand, '-C', '1'))
+
+        cache = self.get_cache()
+        self.assertFalse(cache.has('5'))
+        self.assertIn(cache.load('1'), [None, self.get_mailbox().messages[0].raw])
+
+    #----------------------------------------------------------------
+    def test_copy_keeps_cached_source(self):
+        self.run_command(ReadMailCommand, '3')
+        raw = self.get_mailbox().messages[2].raw
+
+        self.run_command(SearchMailCommand, '--uid', '3', '--copy', 'Archive')
+
+        self.assertEqual(len(self.get_mailbox().messages), self.messages)
+        self.assertEqual(self.get_mailbox('Archive').messages[0].raw, raw)
+        self.assertEqual(self.get_cache().load('3'), raw)
+
+    #----------------------------------------------------------------
+    def test_move_without_move_extension(self):
+        self.server.capabilities.remove('MOVE')
+        self.run_command(ReadMailCommand, '2')
+
+        output = self.run_command(SearchMailCommand, '--uid', '2:4', '--move', 'Archive')
+
+        self.assertIn("3 message(s) moved to Archive.", output)
+        self.assertEqual([m.uid for m in self.get_mailbox().messages],
+                         [1] + list(range(5, self.messages + 1)))
+        self.assertEqual(len(self.get_mailbox('Archive').messages), 3)
+        self.assertFalse(self.get_cache().has('2'))
+
+    #----------------------------------------------------------------
+    def test_move_without_uidplus_does_not_expunge(self):
+        self.server.capabilities.remove('MOVE')
+        self.server.capabilities.remove('UIDPLUS')
+        self.get_mailbox().messages[6].flags.append('\\Deleted')
+        self.run_command(ReadMailCommand, '2')
+        self.server.reset_stats()
+
+        output = self.run_command(SearchMailCommand, '--uid', '2:4', '--move', 'Archive')
+
+        self.assertIn("3 message(s) copied to Archive and flagged as deleted.", output)
+        self.assertIn("not expunged", output)
+        self.assertNotIn('EXPUNGE', self.server.stats ['verbs'])
+
+        # Message 7, flagged as deleted beforehand, must not be removed.
+        messages = self.get_mailbox().messages
+        self.assertEqual([m.uid for m in messages], list(range(1, self.messages + 1)))
+        self.assertEqual([m.uid for m in messages if '\\Deleted' in m.flags], [2, 3, 4, 7])
+        self.assertEqual(len(self.get_mailbox('Archive').messages), 3)
+        self.assertTrue(self.get_cache().has('2'))
+
+    #----------------------------------------------------------------
+    def test_expunge_removes_cached_messages(self):
+        self.run_command(ReadMailCommand, '4')
+        self.run_command(SearchMailCommand, '--uid', '4', '--flag', 'Deleted', '--expunge')
+
+        self.assertNotIn(4, [m.uid for m in self.get_mailbox().messages])
+        self.assertFalse(self.get_cache().has('4'))
+
+#-------------------------------------------------------------------
+class ExportTests(FakeServerTestCase):
+
+    #----------------------------------------------------------------
+    def test_export_is_in_uid_order(self):
+        # Cache some messages, so the export merges the cache with
+        # the messages downloaded.
+        for uid in ['2', '5', '9']:
+            self.run_command(ReadMailCommand, uid)
+
+        filename = os.path.join(self.workspace.directory, 'export.mbox')
+        output = self.run_command(SearchMailCommand, '--all', '--export', 'mbox:' + filename)
+
+        self.assertIn("3 from cache", output)
+        self.assertEqual([message ['Message-ID'] for message in mailbox.mbox(filename)],
+                         [header(m.raw, 'Message-ID') for m in self.get_mailbox().messages])
+
+    #----------------------------------------------------------------
+    def test_maildir_keeps_flags_of_unread_messages(self):
+        flags = [[], ['\\Flagged'], ['\\Answered', '\\Draft'], ['\\Seen']]
+        for message, message_flags in zip(self.get_mailbox().messages, flags):
+            message.flags = list(message_flags)
+
+        directory = os.path.join(self.workspace.directory, 'maildir')
+        self.run_command(SearchMailCommand, '--uid', '1:4', '--export', 'maildir:' + directory)
+
+        self.assertEqual(len(os.listdir(os.path.join(directory, 'new'))), 1)
+        self.assertEqual(sorted(name.split(':2,')[1]
+                                for name in os.listdir(os.path.join(directory, 'cur'))),
+                         ['DR', 'F', 'S'])
+
+        self.server.get_mailbox('Restored', create = True)
+        self.run_command(RestoreCommand, '-i', 'Restored', 'maildir:' + directory)
+
+        self.assertEqual(sorted(sorted(m.flags) for m in self.get_mailbox('Restored').messages),
+                         sorted(sorted(f) for f in flags))
+
+#-------------------------------------------------------------------
+class GmailCacheIndexTests(FakeServerTestCase):
+
+    capabilities = GMAIL_CAPABILITIES
+
+    #----------------------------------------------------------------
+    def test_index_without_migration(self):
+        self.run_command(ReadMailCommand, '2')
+        self.run_command(ReadMailCommand, '5')
+        self.assertEqual(len([key for key in self.get_cache().keys() if key.startswith('gm/')]), 2)
+
+        # The X-GM-MSGIDs must not depend on the migration of
+        # messages cached by UID.
+        with unittest.mock.patch.object(CacheIndexCommand, 'migrate_uid_keys', return_value = 0):
+            output = self.run_command(CacheIndexCommand)
+
+        self.assertIn("2 message(s) indexed, 0 already indexed", output)
@@ -0,0 +1,80 @@
+#-------------------------------------------------------------------
+# tests.test_reports
+#
+# Tests that --stats and --profile still report on a command which
+# failed partway.
+#-------------------------------------------------------------------
+
+import contextlib
+import io
+import json
+import os
+import pstats
+import sys
+import unittest.mock
+
+from webmail import application, stats, timing
+
+from benchmarks.common import reset_config
+
+from .common import FakeServerTestCase
+
+#-------------------------------------------------------------------
+class FailedCommandReportTests(FakeServerTestCase):
+
+    #----------------------------------------------------------------
+    def run_main(self, *args):
+        """
+            Run main() with the given arguments.  Returns what it
+            printed to stderr.
+        """
+
+        # Each invocation is a process of its own.
+        reset_config()
+        stats.command_stats.reset()
+        timing.timer.reset()
+        output = io.StringIO()
+
+        with unittest.mock.patch.object(sys, 'argv', ['webmail'] + self.workspace.argv(*args)), \
+                contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(output):
+            application.main()
+
+        return output.getvalue()
+
+    #----------------------------------------------------------------
+    def test_stats_after_lost_connection(self):
+        # COPY is not retried, so the command fails.
+        self.server.drop_connection('COPY')
+
+        output = self.run_main('--stats', '--uid', '1', '--copy', 'Archive')
+
+        self.assertIn("Fatal error", output)
+        self.assertRegex(output, r'(?m)^UID COPY\s+1\s+1\s')
+
+    #----------------------------------------------------------------
+    def test_stats_failure_does_not_hide_error(self):
+        self.server.drop_connection('COPY')
+
+        with unittest.mock.patch.object(application.BaseCommand, 'print_command_stats',
+                                        side_effect = ValueError('broken')):
+            output = self.run_main('--stats', '--uid', '1', '--copy', 'Archive')
+
+        self.assertIn("Could not print command statistics: broken", output)
+        self.assertIn("Fatal error", output)
+
+    #----------------------------------------------------------------
+    def test_profile_after_lost_connection(self):
+        self.server.drop_connection('COPY')
+        stats_file = os.path.join(self.workspace.directory, 'profile.pstats')
+        trace_file = os.path.join(self.workspace.directory, 'trace.json')
+
+        output = self.run_main('--profile', '--profile-stats', stats_file,
+                               '--profile-trace', trace_file,
+                               '--uid', '1', '--copy', 'Archive')
+
+        self.assertIn("Fatal error", output)
+        self.assertRegex(output, r'(?m)^ELAPSED\s')
+        self.assertTrue(pstats.Stats(stats_file).total_calls)
+        with open(trace_file) as infile:
+            self.assertTrue(json.load(infile)['traceEvents'])
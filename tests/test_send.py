@@ -0,0 +1,67 @@
+#-------------------------------------------------------------------
+# tests.test_send
+#
+# Tests of the command line parsing of --send.
+#-------------------------------------------------------------------
+
+import sys
+import unittest
+import unittest.mock
+
+from webmail import application
+from webmail.application import SendMailCommand
+
+from benchmarks.common import reset_config
+
+#-------------------------------------------------------------------
+class SendArgumentTests(unittest.TestCase):
+
+    #----------------------------------------------------------------
+    def parse(self, *args):
+        """
+            Run main() with the given arguments, returning the command
+            it constructed without running it.
+        """
+
+        commands = []
+        reset_config()
+
+        with unittest.mock.patch.object(sys, 'argv', ['webmail'] + list(args)), \
+                unittest.mock.patch.object(SendMailCommand, 'run', autospec = True,
+                                           side_effect = commands.append):
+            application.main()
+
+        self.assertEqual(len(commands), 1)
+        return commands[0]
+
+    #----------------------------------------------------------------
+    def test_files_before_options(self):
+        command = self.parse('--send', 'a.eml', 'b.eml', '--to', 'x@example.com', '--queue')
+
+        self.assertEqual(command.files, ['a.eml', 'b.eml'])
+        self.assertEqual(command.recipients, ['x@example.com'])
+        self.assertTrue(command.queue_only)
+
+    #----------------------------------------------------------------
+    def test_files_after_options(self):
+        command = self.parse('--send', '--to', 'x@example.com', '--to', 'y@example.com',
+                             '--subject', 'Hello', 'a.txt', 'b.txt', 'c.txt')
+
+        self.assertEqual(command.files, ['a.txt', 'b.txt', 'c.txt'])
+        self.assertEqual(command.recipients, ['x@example.com', 'y@example.com'])
+        self.assertEqual(command.subject, 'Hello')
+
+    #----------------------------------------------------------------
+    def test_files_mixed_with_options(self):
+        command = self.parse('--send', 'a.eml', '--flush', 'b.eml', '--sent', 'Sent')
+
+        self.assertEqual(command.files, ['a.eml', 'b.eml'])
+        self.assertTrue(command.flush_only)
+        self.assertEqual(command.config ['imap_sent_mailbox'], 'Sent')
+
+    #----------------------------------------------------------------
+    def test_no_files(self):
+        command = self.parse('--send', '--flush')
+
+        self.assertEqual(command.files, [])
+        self.assertTrue(command.flush_only)
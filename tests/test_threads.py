@@ -0,0 +1,80 @@
+#-------------------------------------------------------------------
+# tests.test_threads
+#
+# Tests of conversation threading.
+#-------------------------------------------------------------------
+
+import unittest
+
+from webmail.threads import thread_records, thread_tree
+
+#-------------------------------------------------------------------
+def record(uid, parent = None, subject = 'Subject', date = None):
+    return {
+        'uid':          uid,
+        'message_id':   '<%d@example.com>' % uid,
+        'refs':         '<%d@example.com>' % parent if parent is not None else '',
+        'in_reply_to':  '',
+        'subject':      subject,
+        'date':         uid if date is None else date
+    }
+
+#-------------------------------------------------------------------
+def flatten(roots):
+    return [[(depth, node.record ['uid'] if node.record else None)
+             for depth, node in root.walk()] for root in roots]
+
+#-------------------------------------------------------------------
+class ThreadTests(unittest.TestCase):
+
+    #----------------------------------------------------------------
+    def test_replies(self):
+        roots = thread_records([
+            record(1, subject = 'First'),
+            record(2, 1, subject = 'Re: First'),
+            record(3, 1, subject = 'Re: First'),
+            record(4, 2, subject = 'Re: First'),
+            record(5, subject = 'Second'),
+        ])
+
+        # Threads are most recently active first, replies by date.
+        self.assertEqual(flatten(roots), [
+            [(0, 5)],
+            [(0, 1), (1, 2), (2, 4), (1, 3)]
+        ])
+
+    #----------------------------------------------------------------
+    def test_missing_parent(self):
+        roots = thread_records([record(2, 1), record(3, 1)])
+        self.assertEqual(flatten(roots), [[(0, None), (1, 2), (1, 3)]])
+
+    #----------------------------------------------------------------
+    def test_subject_grouping(self):
+        roots = thread_records([
+            record(1, subject = 'Lunch'),
+            record(2, subject = 'Re: Lunch')
+        ])
+
+        self.assertEqual(flatten(roots), [[(0, 1), (1, 2)]])
+
+    #----------------------------------------------------------------
+    def test_deep_reply_chain(self):
+        depth = 5000
+        records = [record(1)] + [record(uid, uid - 1) for uid in range(2, depth + 1)]
+
+        roots = thread_records(records)
+
+        self.assertEqual(len(roots), 1)
+        self.assertEqual(flatten(roots)[0], [(uid - 1, uid) for uid in range(1, depth + 1)])
+
+    #----------------------------------------------------------------
+    def test_deep_server_thread(self):
+        depth = 5000
+        tree = (depth, [])
+        for uid in range(depth - 1, 0, -1):
+            tree = (uid, [tree])
+
+        roots = thread_tree([tree], dict((uid, record(uid)) for uid in range(1, depth + 1)))
+
+        self.assertEqual(flatten(roots)[0], [(uid - 1, uid) for uid in range(1, depth + 1)])
+        self.assertEqual(roots[0].latest, depth)
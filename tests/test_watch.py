@@ -0,0 +1,87 @@
+#-------------------------------------------------------------------
+# tests.test_watch
+#
+# Tests of --watch against the fake server.
+#-------------------------------------------------------------------
+
+import threading
+import time
+
+from webmail.application import SearchMailCommand
+
+from .common import FakeServerTestCase
+
+#-------------------------------------------------------------------
+class WatchTests(FakeServerTestCase):
+
+    messages = 5
+
+    #----------------------------------------------------------------
+    def watch(self, count, *args, before_resync = None):
+        """
+            Run --watch until count events have been reported, and
+            return them as (event, uid, record) tuples.
+        """
+
+        events = []
+
+        class WatchCommand(SearchMailCommand):
+            def watch_resync(self, client, index, uids):
+                if before_resync is not None:
+                    before_resync()
+                return SearchMailCommand.watch_resync(self, client, index, uids)
+
+            def print_watch_event(self, event, uid, record):
+                events.append((event, uid, record))
+                if len(events) >= count:
+                    raise KeyboardInterrupt()
+
+        self.run_command(WatchCommand, '--watch', *args)
+        return events
+
+    #----------------------------------------------------------------
+    def wait_for_idle(self):
+        deadline = time.time() + 10
+        while not self.server.stats ['verbs'].get('IDLE') and time.time() < deadline:
+            time.sleep(0.01)
+
+    #----------------------------------------------------------------
+    def test_reconnect(self):
+        inbox = self.get_mailbox()
+
+        def change_mailbox():
+            # Changes made while disconnected are reported after the
+            # mailbox is listed again.
+            with self.server.lock:
+                inbox.append(b'Subject: Late\r\nFrom: a@example.com\r\n\r\nHello\r\n')
+                inbox.remove([1])
+
+        self.server.drop_connection('IDLE')
+        events = self.watch(2, '--all', before_resync = change_mailbox)
+
+        self.assertEqual([(event, uid) for event, uid, record in events],
+                         [('expunged', 1), ('new', self.messages + 1)])
+        self.assertEqual(events[1][2]['subject'], 'Late')
+
+    #----------------------------------------------------------------
+    def test_flags_of_unindexed_message(self):
+        inbox = self.get_mailbox()
+        message = inbox.messages[2]
+
+        def change_flags():
+            self.wait_for_idle()
+            with self.server.lock:
+                message.flags = ['\\Flagged']
+            self.server.notify(inbox, '* 3 FETCH (FLAGS (\\Flagged))')
+
+        thread = threading.Thread(target = change_flags)
+        thread.start()
+
+        # Only UID 1 is listed, so UID 3 is not yet in the index.
+        events = self.watch(1, '--uid', '1')
+        thread.join()
+
+        event, uid, record = events[0]
+        self.assertEqual((event, uid), ('flags', 3))
+        self.assertEqual(record ['flags'], '\\Flagged')
+        self.assertTrue(record ['subject'])
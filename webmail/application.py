@@ -7,10 +7,12 @@
 # Date: March 11th, 2013
 #-------------------------------------------------------------------
 
+import cProfile
 import datetime
 import email.utils
 import getopt
 import getpass
+import json
 import mimetypes
 import os
 import re
@@ -24,9 +26,20 @@ from tempfile import NamedTemporaryFile
 from textwrap import TextWrapper
 
 import parsedatetime as pdt
+import pyzmail
 
+from .cache import MailCache
+from .capabilities import CapabilityCache
 from .client import *
 from .data import parse_json
+from .export import open_archive, open_archive_entries, open_export
+from .index import HeaderIndex, header_record
+from .mime import LazyMessage, find_header_end
+from .parallel import ParsePool
+from .sender import MailSender, Outbox, envelope_recipients
+from .stats import command_stats
+from .threads import thread_records, thread_tree
+from . import timing
 
 #-------------------------------------------------------------------
 DEFAULT_CONFIG = {
@@ -39,15 +52,41 @@ DEFAULT_CONFIG = {
         'imap_username':                None,
         'imap_password':                None,
         'imap_mailbox':                 'INBOX',
+        'imap_max_sequence_set':        4096,
+        'imap_compress':                True,
+        'imap_retries':                 5,
+        'imap_retry_delay':             0.5,
+        'imap_retry_max_delay':         30.0,
+        'imap_sent_mailbox':            None,
+        'imap_capability_ttl':          86400,
+        'imap_disable_capabilities':    [],
+        'append_batch_size':            100,
 
         'cache_dir':                    '~/.webmail/',
         'cache_enabled':                True,
+        'cache_compression':            None,
+        'cache_compression_level':      6,
+        'cache_dictionary':             True,
+        'cache_max_bytes':              None,
+        'cache_max_age':                None,
+        'cache_eviction':               'lru',
+        'cache_gc_interval':            3600,
         'download_threshold':           100000,
+        'fetch_batch_size':             100,
+        'summary_batch_size':           500,
+        'parse_processes':              None,
 
         'smtp_hostname':                'smtp.gmail.com',
         'smtp_port':                    587,
         'smtp_mode':                    'tls',
         'smtp_text_enc':                'us-ascii',
+        'smtp_username':                None,
+        'smtp_password':                None,
+        'smtp_from':                    None,
+        'smtp_attempts':                10,
+        'smtp_retry_delay':             60.0,
+        'smtp_retry_max_delay':         3600.0,
+        'outbox_dir':                   '~/.webmail-outbox/',
 
         'verbose':                      0,
         'supress':                      False,
@@ -56,13 +95,17 @@ DEFAULT_CONFIG = {
         'line_format':                  '[$status] $uid <>     <$sender_name> $date',
         'st_date_format_recent':        '%b %d %l:%M%P',
         'st_date_format_far':           '%b %d %Y %l:%M%P',
+        'output_format':                'text',
+        'watch_line_format':            '[$event] $uid <$sender_name> $subject',
+        'watch_poll_interval':          60,
+        'thread_line_format':           '$uid $date <$sender_name> $indent$subject',
+        'thread_indent':                '  ',
 
         'date_format':                  '%B %d %Y, %l:%M%P',
         'normalize_enabled':            False,
         'normalize_form':               'NFD',
         'print_encoding':               'utf8',
         'print_encoding_rule':          'ignore',
-        'file_encoding':                'utf8',
 
         'mime:text/plain':              "PRINT",
         'mime:text/html':               'chromium --user-data-dir=/tmp %s',
@@ -72,6 +115,10 @@ DEFAULT_CONFIG = {
         'mime:video/*':                 'vlc %s',
 
         'debug':                        False,
+        'print_stats':                  False,
+        'profile':                      False,
+        'profile_stats':                None,
+        'profile_trace':                None,
 
         'default':                      {}
 }
@@ -83,7 +130,9 @@ _G_LONGOPTS = ['config=', 'imap-host=', 'imap-port=',
                     'imap-user=', 'imap-password=',
                     'inbox=', 'limit=', 'supress',
                     'account=', 'debug', 'no-prompt',
-                    'no-cache']
+                    'no-cache', 'no-compress', 'stats',
+                    'profile', 'profile-stats=', 'profile-trace=',
+                    'disable-capability=']
 
 #-------------------------------------------------------------------
 class ThresholdExceeded(Exception):
@@ -114,6 +163,51 @@ class MailpartHandler():
         else:
             return os.path.splitext(self.part.filename)[1]
 
+    def get_filename(self):
+        """
+            Determine a safe filename for saving the mailpart, based on
+            the filename in the message if there is one.
+        """
+
+        filename = None
+        if self.part.filename:
+            filename = os.path.basename(self.part.filename.replace('\\', '/')).strip()
+
+        if not filename or filename in ['.', '..']:
+            filename = "mailpart-%d%s" %(self.part_num, self.get_file_extension() or '')
+
+        return filename
+
+    def save(self, directory):
+        """
+            Save the decoded mailpart to a file in the given directory,
+            without overwriting existing files.  The payload is decoded
+            and written in chunks, so memory use is bounded regardless
+            of the size of the mailpart.
+
+            Returns the path of the file written.
+        """
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        base, ext = os.path.splitext(self.get_filename())
+        filename = os.path.join(directory, base + ext)
+        n = 1
+
+        while True:
+            try:
+                fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                break
+            except FileExistsError:
+                filename = os.path.join(directory, "%s-%d%s" %(base, n, ext))
+                n += 1
+
+        with os.fdopen(fd, 'wb') as out_file:
+            self.part.write_payload(out_file)
+
+        return filename
+
     def open(self):
         """
             Open the mailpart for viewing by the user.  This could
@@ -167,7 +261,7 @@ class MailpartHandler():
         else:
             # Save the mailpart payload to a file for further processing.
             tmpfile = NamedTemporaryFile(suffix = self.get_file_extension(), delete = False)
-            tmpfile.write(self.part.get_payload())
+            self.part.write_payload(tmpfile)
             tmpfile.close()
 
             handler_cmd = handler % tmpfile.name
@@ -190,6 +284,10 @@ class BaseCommand():
 
     PARAMETERS = 0
 
+    # If True, options and arguments may be mixed on the command line,
+    # e.g. for commands taking any number of files.
+    MIXED_ARGUMENTS = False
+
     #----------------------------------------------------------------
     def __init__(self, argv, shortopts, longopts, config):
         self.argv = argv
@@ -198,29 +296,46 @@ class BaseCommand():
         self.longopts = _G_LONGOPTS + longopts
         self.optional_config_files = DEFAULT_CONFIG_FILENAMES
         self.specific_config_files = []
+        self.clients = []
+        self.senders = []
+        self.cache = None
+        self.profiler = None
         self.config = DEFAULT_CONFIG
         self.config.update(config)
 
-        opts, args = getopt.getopt(self.argv, self.shortopts, self.longopts)
-        self.process_config(opts, args)
+        with timing.phase('config'):
+            parse = getopt.gnu_getopt if self.MIXED_ARGUMENTS else getopt.getopt
+            opts, args = parse(self.argv, self.shortopts, self.longopts)
+            self.process_config(opts, args)
 
     #----------------------------------------------------------------
     def process_config(self, opts, args):
         for opt, val in opts:
             if opt in ['-c', '--config']:
                 self.specific_config_files.append(str(val))
+            elif opt in ['--profile']:
+                self.config ['profile'] = True
+            elif opt in ['--profile-stats']:
+                self.config ['profile_stats'] = str(val)
+            elif opt in ['--profile-trace']:
+                self.config ['profile_trace'] = str(val)
+
+        if self.config ['profile_stats'] and self.profiler is None:
+            self.start_profiler()
 
         self.optional_config_files = [os.path.abspath(os.path.expanduser(x)) for x in self.optional_config_files]
         self.specific_config_files = [os.path.abspath(os.path.expanduser(x)) for x in self.specific_config_files]
 
         for filename in self.optional_config_files:
             try:
-                self.config.update(parse_json(filename))
+                with timing.phase('parse_json'):
+                    self.config.update(parse_json(filename))
             except FileNotFoundError as e:
                 pass
 
         for filename in self.specific_config_files:
-            self.config.update(parse_json(filename))
+            with timing.phase('parse_json'):
+                self.config.update(parse_json(filename))
 
         for opt, val in opts:
             if opt in ['-v', '--verbose']:
@@ -245,6 +360,13 @@ class BaseCommand():
                 self.config ['interactive'] = False
             elif opt in ['-C', '--no-cache']:
                 self.config ['cache_enabled'] = False
+            elif opt in ['--no-compress']:
+                self.config ['imap_compress'] = False
+            elif opt in ['--stats']:
+                self.config ['print_stats'] = True
+            elif opt in ['--disable-capability']:
+                self.config ['imap_disable_capabilities'] = \
+                        self.config ['imap_disable_capabilities'] + [str(val)]
 
         self.process_account_settings(self.config ['account'])
 
@@ -281,17 +403,192 @@ class BaseCommand():
         else:
             return s
 
+    #----------------------------------------------------------------
+    def get_cache(self):
+        """
+            Get the message cache for the current account.
+
+            Config Settings:
+                cache_dir:
+                    The directory under which emails are written.  Emails will be written
+                    to a directory under cache_dir based on the account from which they
+                    were read.
+                cache_compression:
+                    None to store messages uncompressed, or 'zlib' or 'zstd' to
+                    compress each message.  'zstd' requires the zstandard module.
+                    Messages are readable regardless of this setting.
+                cache_compression_level:
+                    The compression level passed to the codec.
+                cache_dictionary:
+                    Whether to compress with the dictionary trained by --cache-train.
+        """
+
+        if self.cache is None:
+            self.cache = MailCache(
+                    os.path.join(
+                        os.path.expanduser(self.config ['cache_dir']),
+                        self.config ['account']),
+                    compression = self.config ['cache_compression'],
+                    level = self.config ['cache_compression_level'],
+                    use_dictionary = self.config ['cache_dictionary'])
+
+        return self.cache
+
+    #----------------------------------------------------------------
+    def close(self):
+        """
+            Release resources held by the command, waiting for any
+            background cache collection to finish.
+        """
+
+        for sender in self.senders:
+            sender.disconnect()
+
+        if self.cache is not None:
+            self.cache.close()
+
     #----------------------------------------------------------------
     def cache_filename_for_uid(self, uid):
         """
             Determines the absolute path of a cache file for the given UID.
         """
 
-        cache_dir = os.path.join(
-                os.path.expanduser(self.config ['cache_dir']),
-                self.config ['account'])
-        filename = os.path.join(cache_dir, "%s.webmail" % uid)
-        return filename
+        return self.get_cache().filename(uid)
+
+    #----------------------------------------------------------------
+    def open_header_index(self):
+        """
+            Open the header index for the current account.  The index
+            is kept alongside the message cache, or in memory if the
+            cache is disabled.
+
+            Config Settings:
+                cache_enabled:
+                    If this setting is False, the index is not persisted.
+                cache_dir:
+                    The directory under which the index is written, in a
+                    directory based on the account.
+        """
+
+        if not self.config ['cache_enabled']:
+            return HeaderIndex()
+
+        cache = self.get_cache()
+        cache.make_directory()
+
+        return HeaderIndex(os.path.join(cache.directory, 'headers.sqlite'))
+
+    #----------------------------------------------------------------
+    def json_record(self, record, **kwargs):
+        """
+            Convert a header index record into a dictionary suitable
+            for JSON output.  Any keyword arguments are added to it.
+        """
+
+        date = None
+        if record ['date'] is not None:
+            date = datetime.datetime.fromtimestamp(record ['date']).isoformat()
+
+        result = dict(kwargs)
+        result.update({
+            'uid':          record ['uid'],
+            'flags':        record ['flags'].split(),
+            'size':         record ['size'],
+            'date':         date,
+            'from':         record ['sender_addr'],
+            'from_name':    record ['sender_name'],
+            'to':           record ['recipients'],
+            'subject':      record ['subject'],
+            'message_id':   record ['message_id']
+        })
+
+        if record.get('gm_msgid') is not None:
+            result.update({
+                'gm_msgid':     record ['gm_msgid'],
+                'gm_thrid':     record ['gm_thrid'],
+                'labels':       json.loads(record ['gm_labels'] or '[]')
+            })
+
+        return result
+
+    #----------------------------------------------------------------
+    def fetch_records(self, client, index, uids):
+        """
+            Get the header index records of the given messages in the
+            selected mailbox.  The summaries of messages missing from
+            the index are fetched in bulk and added to it.  The flags
+            of indexed messages, which other clients may have changed,
+            are fetched in a single FETCH and updated in the index.
+
+            Returns a dictionary mapping integer UIDs to records.
+        """
+
+        mailbox = client.get_mailbox()
+        with timing.phase('index'):
+            records = index.get_many(mailbox, client.uidvalidity, uids)
+        missing = [uid for uid in uids if int(uid) not in records]
+
+        if records:
+            for uid, attrs in client.fetch_attributes(sorted(records), 'FLAGS',
+                    max_length = self.config ['imap_max_sequence_set']):
+                flags = ' '.join(flag.decode() for flag in attrs.get('FLAGS') or [])
+                if uid in records and records [uid]['flags'] != flags:
+                    records [uid]['flags'] = flags
+                    with timing.phase('index'):
+                        index.set_flags(mailbox, client.uidvalidity, uid, flags.split())
+
+        if missing:
+            summaries = list(client.fetch_summaries(
+                missing, max_length = self.config ['imap_max_sequence_set']))
+
+            with timing.phase('parse'):
+                fetched = [header_record(summary) for summary in summaries]
+
+            with timing.phase('index'):
+                index.update(mailbox, client.uidvalidity, fetched)
+
+            for record in fetched:
+                records [record ['uid']] = record
+
+        return records
+
+    #----------------------------------------------------------------
+    def cache_keys(self, client, uids):
+        """
+            Get the message cache keys of the given messages in the
+            selected mailbox, as a dictionary mapping each UID to its key.
+
+            On Gmail, messages are cached under their X-GM-MSGID as
+            "gm/<id>", which is the same in every mailbox (label) a
+            message is in, so it is only downloaded and stored once.
+            Elsewhere, messages are cached under their UID.
+        """
+
+        if not client.has_capability(GMAIL_CAPABILITY):
+            return dict((uid, str(uid)) for uid in uids)
+
+        # Ids recorded in the header index need not be fetched again.
+        unknown = [int(uid) for uid in uids if int(uid) not in client.gmail_ids]
+        if unknown and self.config ['cache_enabled']:
+            index = self.open_header_index()
+            try:
+                records = index.get_many(client.get_mailbox(), client.uidvalidity, unknown)
+            finally:
+                index.close()
+
+            for uid, record in records.items():
+                if record ['gm_msgid'] is not None:
+                    client.gmail_ids [uid] = record ['gm_msgid']
+
+        gmail_ids = client.fetch_gmail_ids(uids,
+                max_length = self.config ['imap_max_sequence_set'])
+
+        return dict((uid, 'gm/%d' % gmail_ids [int(uid)] if int(uid) in gmail_ids else str(uid))
+                    for uid in uids)
+
+    #----------------------------------------------------------------
+    def cache_key(self, client, uid):
+        return self.cache_keys(client, [uid]) [uid]
 
     #----------------------------------------------------------------
     def cache_has_message(self, uid):
@@ -315,8 +612,7 @@ class BaseCommand():
         if not self.config ['cache_enabled']:
             return False
 
-        filename = self.cache_filename_for_uid(uid)
-        return os.path.exists(filename)
+        return self.get_cache().has(uid)
 
     #----------------------------------------------------------------
     def cache_fetch_message(self, uid):
@@ -324,6 +620,9 @@ class BaseCommand():
             Load a message item from the cache if it exists.  Returns None if
             the file does not exist in the cache or the cache is disabled.
 
+            The message is returned as a LazyMessage over a memory map of
+            the cache file, so mailparts are only decoded when opened.
+
             uid:
                 The message to load from cache.
 
@@ -340,18 +639,8 @@ class BaseCommand():
         if not self.config ['cache_enabled']:
             return None
 
-        try:
-            filename = self.cache_filename_for_uid(uid)
-            raw_message = None
-
-            with open(filename, 'rb') as in_file:
-                raw_message = in_file.read()
-
-            message = pyzmail.PyzMessage.factory(raw_message)
-            return message
-
-        except FileNotFoundError as e:
-            return None
+        with timing.phase('cache'):
+            return self.get_cache().open_message(uid)
 
     #----------------------------------------------------------------
     def fetch_message(self, client, uid):
@@ -372,15 +661,29 @@ class BaseCommand():
                     messages to the email cache.
         """
 
-        message = None
+        if not self.config ['cache_enabled']:
+            raw_message = client.fetch_message_body(uid)
+            if raw_message is None:
+                return None
+
+            with timing.phase('parse'):
+                return LazyMessage(raw_message)
 
-        if self.config ['cache_enabled']:
-            message = self.cache_fetch_message(uid)
+        key = self.cache_key(client, uid)
 
-        if not message:
-            message = client.fetch_message(uid)
-            if message is not None and self.config ['cache_enabled']:
-                self.cache_save_message(uid, message)
+        # Hold the cache lock for this message while it is downloaded,
+        # so another process fetching it waits and reads it from cache.
+        with self.get_cache().lock(key):
+            message = self.cache_fetch_message(key)
+
+            if not message:
+                raw_message = client.fetch_message_body(uid)
+                if raw_message is None:
+                    return None
+
+                self.cache_save_message(key, raw_message)
+                with timing.phase('parse'):
+                    message = LazyMessage(raw_message)
 
         return message
 
@@ -413,43 +716,46 @@ class BaseCommand():
             return None
 
         elif self.config ['cache_enabled'] and(threshold is None or size < threshold):
-            if not self.cache_has_message(uid):
-                message = client.fetch_message(uid)
-                if message is not None:
-                    self.cache_save_message(uid, message)
+            key = self.cache_key(client, uid)
+            with self.get_cache().lock(key):
+                if not self.cache_has_message(key):
+                    raw_message = client.fetch_message_body(uid)
+                    if raw_message is not None:
+                        self.cache_save_message(key, raw_message)
 
         return client.fetch_message_headers(uid)
 
     #----------------------------------------------------------------
-    def cache_save_message(self, uid, message):
+    def cache_save_message(self, uid, raw_message):
         """
-            Save the given message to the email cache.
+            Save the given message to the email cache.  The message is
+            stored exactly as received from the server, and is not
+            parsed until it is read back from the cache.
 
             uid:
                 The UID of the message to be saved.
-            message:
-                A PyzMessage object representing the message.
+            raw_message:
+                The raw RFC822 bytes of the message.
 
             Config Settings:
                 cache_dir:
                     The directory under which emails are written.
-                file_encoding:
-                    The encoding format used to store emails.
+                cache_compression:
+                    The codec used to compress emails, see get_cache().
+                cache_max_bytes, cache_max_age, cache_eviction:
+                    Limits on the cache, see CacheCollectCommand.  If set,
+                    the cache is collected in the background at most every
+                    'cache_gc_interval' seconds while messages are saved.
         """
         try:
-            cache_dir = os.path.join(
-                    os.path.expanduser(self.config ['cache_dir']),
-                    self.config ['account'])
-
-            if not os.path.isdir(cache_dir):
-                try:
-                    os.makedirs(cache_dir)
-                except OSError as e:
-                    raise Exception("Unable to create cache directory: %s" % str(e))
-
-            filename = os.path.join(cache_dir, "%s.webmail" % uid)
-            with open(filename, 'wb') as out_file:
-                out_file.write(message.as_string().encode(self.config ['file_encoding']))
+            cache = self.get_cache()
+            with timing.phase('cache'):
+                cache.save(uid, raw_message)
+            cache.start_janitor(
+                    max_bytes = self.config ['cache_max_bytes'],
+                    max_age = self.config ['cache_max_age'],
+                    policy = self.config ['cache_eviction'],
+                    interval = self.config ['cache_gc_interval'])
 
         except Exception as e:
             print("Could not save message %s to cache: %s" %(uid, e), file = sys.stderr)
@@ -461,6 +767,22 @@ class BaseCommand():
             Attempt to perform a login with the current settings,
             prompting the user if necessary for a username
             and password.
+
+            Config Settings:
+                imap_retries:
+                    The number of times a search or fetch is retried if
+                    the connection is lost, reconnecting each time.
+                imap_retry_delay, imap_retry_max_delay:
+                    The seconds to wait before the first retry, doubling
+                    for each retry up to the maximum.
+                imap_capability_ttl:
+                    The seconds for which the capabilities of each server
+                    are cached under cache_dir, or 0 to ask the server on
+                    every connection.  Not cached if the cache is disabled.
+                imap_disable_capabilities:
+                    Capabilities to treat as unsupported, forcing the
+                    fallback for each, e.g. ["MOVE", "ESEARCH"].  Also
+                    given with --disable-capability.
         """
 
         while not self.config ['imap_username'] or \
@@ -475,16 +797,162 @@ class BaseCommand():
                 raise Exception("No imap_password configured.")
             self.config ['imap_password'] = getpass.getpass()
 
-        client = MailClient()
+        capability_cache = None
+        if self.config ['cache_enabled'] and self.config ['imap_capability_ttl']:
+            capability_cache = CapabilityCache(
+                    os.path.join(os.path.expanduser(self.config ['cache_dir']), 'capabilities.json'),
+                    self.config ['imap_capability_ttl'])
+
+        client = MailClient(
+                retries = self.config ['imap_retries'],
+                retry_delay = self.config ['imap_retry_delay'],
+                retry_max_delay = self.config ['imap_retry_max_delay'],
+                capability_cache = capability_cache,
+                disabled_capabilities = self.config ['imap_disable_capabilities'])
         client.connect(
                 self.config ['imap_username'],
                 self.config ['imap_password'],
                 self.config ['imap_hostname'],
                 self.config ['imap_port'],
-                self.config ['imap_ssl'])
+                self.config ['imap_ssl'],
+                self.config ['imap_compress'])
 
+        self.clients.append(client)
         return client
 
+    #----------------------------------------------------------------
+    def perform_smtp_login(self):
+        """
+            Connect and log in to the SMTP server.  The IMAP username
+            and password are used unless SMTP credentials are given.
+
+            Config Settings:
+                smtp_hostname, smtp_port:
+                    The SMTP server to send mail through.
+                smtp_mode:
+                    'tls' to use STARTTLS, 'ssl' to connect with TLS, or
+                    'plain'.
+                smtp_username, smtp_password:
+                    The SMTP credentials, if different from imap_username
+                    and imap_password.
+                smtp_attempts:
+                    The number of times a queued message is attempted
+                    before it is given up on.
+                smtp_retry_delay, smtp_retry_max_delay:
+                    The seconds to wait before attempting a message again,
+                    doubling for each attempt up to the maximum.
+        """
+
+        username = self.config ['smtp_username'] or self.config ['imap_username']
+        password = self.config ['smtp_password'] or self.config ['imap_password']
+
+        if username and not password:
+            if not self.config ['interactive']:
+                raise Exception("No smtp_password configured.")
+            password = getpass.getpass()
+
+        sender = MailSender(
+                attempts = self.config ['smtp_attempts'],
+                retry_delay = self.config ['smtp_retry_delay'],
+                retry_max_delay = self.config ['smtp_retry_max_delay'])
+        sender.connect(
+                username,
+                password,
+                self.config ['smtp_hostname'],
+                self.config ['smtp_port'],
+                self.config ['smtp_mode'])
+
+        self.senders.append(sender)
+        return sender
+
+    #----------------------------------------------------------------
+    def get_outbox(self):
+        """
+            Get the outbox of messages waiting to be sent for the
+            current account.
+
+            Config Settings:
+                outbox_dir:
+                    The directory under which queued messages are kept, in
+                    a directory based on the account.
+        """
+
+        return Outbox(os.path.join(
+            os.path.expanduser(self.config ['outbox_dir']),
+            self.config ['account']))
+
+    #----------------------------------------------------------------
+    def print_transfer_stats(self):
+        """
+            Print the number of bytes transferred by each connection
+            made by this command, on the wire and after decompression.
+        """
+
+        for client in self.clients:
+            if not client.is_connected():
+                continue
+
+            stats = client.transfer_stats()
+            received = stats ['bytes_received']
+            wire_received = stats ['wire_bytes_received']
+
+            print("Transfer: %d bytes sent (%d on the wire), %d bytes received (%d on the wire)%s." % (
+                stats ['bytes_sent'], stats ['wire_bytes_sent'],
+                received, wire_received,
+                ", compression ratio %.2f" % (received / wire_received)
+                    if stats ['compressed'] and wire_received else ''),
+                file = sys.stderr)
+
+    #----------------------------------------------------------------
+    def print_command_stats(self):
+        """
+            Print the count, bytes transferred and latency of the IMAP
+            commands sent by this command, grouped by verb.
+        """
+
+        print(command_stats.format_summary(), file = sys.stderr)
+
+    #----------------------------------------------------------------
+    def start_profiler(self):
+        """
+            Start profiling this command with cProfile, for
+            write_profile() to save the statistics.
+        """
+
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    #----------------------------------------------------------------
+    def write_profile(self):
+        """
+            Report the time spent in each phase of this command.
+
+            Config Settings:
+                profile:
+                    If True, print the count, total time and self time
+                    of each phase to stderr, e.g. config, login, select,
+                    search, fetch, parse and render.
+                profile_stats:
+                    If set, the command is run under cProfile and the
+                    statistics are saved to this file, to be read with
+                    pstats or a viewer such as snakeviz.
+                profile_trace:
+                    If set, each phase is written to this file as a
+                    Chrome trace event, to be viewed in chrome://tracing
+                    or Perfetto.
+        """
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.config ['profile_stats'])
+            self.profiler = None
+
+        if self.config ['profile_trace']:
+            timing.timer.write_trace(self.config ['profile_trace'])
+
+        if self.config ['profile']:
+            print(timing.timer.format_summary(), file = sys.stderr)
+
     #----------------------------------------------------------------
     def print_header_summary(self, message):
         """
@@ -523,6 +991,40 @@ class BaseCommand():
             print(mailpart_str)
             n += 1
 
+    #----------------------------------------------------------------
+    def extract_mailparts(self, message, directory, part_num = None):
+        """
+            Save mailparts of the given message to files in a directory.
+
+            message:
+                The message from which to extract mailparts.
+            directory:
+                The directory to which files are written.
+            part_num:
+                If specified, only this mailpart is saved.  Otherwise all
+                mailparts except the message body are saved.
+
+            Returns the number of files written.
+        """
+
+        count = 0
+
+        for n, part in enumerate(message.mailparts):
+            if part_num is not None:
+                if n != part_num:
+                    continue
+            elif part.is_body and not part.filename:
+                continue
+
+            handler = MailpartHandler(self.config, part, n)
+            filename = handler.save(directory)
+            count += 1
+
+            if not self.config ['supress']:
+                print("mailpart %d saved to %s" %(n, filename))
+
+        return count
+
     #----------------------------------------------------------------
     def print_message_status(self, client, uid):
         """
@@ -593,6 +1095,11 @@ class BaseCommand():
                 date_ts))
 
 
+        with timing.phase('render'):
+            self.render_status_line(uid, sender_name, sender_addr, status, subject, date)
+
+    #----------------------------------------------------------------
+    def render_status_line(self, uid, sender_name, sender_addr, status, subject, date):
         template = Template(self.config ['line_format'])
         pre_line = template.substitute(
                 uid = uid,
@@ -825,6 +1332,58 @@ class SearchMailCommand(BaseQueryCommand):
             --unflag FLAG
                 Remove the given flag from each message.
 
+            --copy MAILBOX
+                Copy each message to the given mailbox on the server,
+                creating it if necessary.
+
+            --move MAILBOX
+                Move each message to the given mailbox on the server,
+                creating it if necessary.  UID MOVE is used if the
+                server supports it, otherwise the messages are copied,
+                flagged as deleted and expunged with UID EXPUNGE.  If the
+                server supports neither MOVE nor UIDPLUS, the messages
+                are copied and flagged as deleted but not expunged, as
+                EXPUNGE would remove every message in the mailbox already
+                flagged as deleted as well.
+
+            --expunge
+                Permanently delete each message.  If the server does not
+                support UIDPLUS, every message in the mailbox already
+                flagged as deleted is removed as well.
+
+            -x, --extract DIRECTORY
+                Save the attachments of each message to files in the
+                given directory.
+
+            --export mbox:FILE | maildir:DIR
+                Export each message to an mbox file or a Maildir
+                directory.  Messages in the cache are read from it,
+                the rest are downloaded in batches of 'fetch_batch_size'.
+
+            --threads
+                List the results as conversation threads, most recently
+                active first, with replies indented under the messages
+                they reply to.  With --limit, at most that many threads
+                are listed.  Lines are formatted with 'thread_line_format'.
+
+            --watch
+                After listing the results, keep the connection open and
+                report new, expunged and flag-changed messages in the
+                mailbox as they arrive.  IDLE is used if the server
+                supports it, otherwise the server is polled with NOOP
+                every 'watch_poll_interval' seconds.
+
+            --format FORMAT                 (config: output_format)
+                The format of the listing, threads and watch events,
+                either 'text' or 'jsonl'.  With 'jsonl', one JSON object
+                is printed per message as summaries arrive from the
+                server, and the count of messages found goes to stderr.
+
+            --unchanged-since MODSEQ
+                Only apply --flag and --unflag to messages which have
+                not been modified since the given CONDSTORE mod-sequence.
+                Messages changed since are reported and left alone.
+
         Notes:
             This is the default command.  For a list of available commands,
             type "webmail help".
@@ -832,11 +1391,15 @@ class SearchMailCommand(BaseQueryCommand):
 
     #----------------------------------------------------------------
     def __init__(self, argv):
-        SHORTOPTS    = 'su:p:l:H:i:p'
+        SHORTOPTS    = 'su:p:l:H:i:px:'
         LONGOPTS     = ['username=', 'password=', 'limit=', 'host=', 'inbox=', 'port=', 'no-ssl',
-                'flag=', 'unflag=', 'print']
+                'flag=', 'unflag=', 'print', 'unchanged-since=',
+                'watch', 'format=', 'extract=', 'export=', 'threads',
+                'copy=', 'move=', 'expunge']
 
         self.operations = []
+        self.unchanged_since = None
+        self.watch = False
 
         BaseQueryCommand.__init__(
                 self, argv, SHORTOPTS, LONGOPTS, {
@@ -862,8 +1425,18 @@ class SearchMailCommand(BaseQueryCommand):
                 self.config ['imap_port'] = int(val)
             elif opt in ['--no-ssl']:
                 self.config ['imap_ssl'] = False
-            elif opt in ['--flag', '--unflag']:
+            elif opt in ['--flag', '--unflag', '--copy', '--move', '--expunge']:
                 self.operations.append((opt, val))
+            elif opt in ['-x', '--extract']:
+                self.operations.append(('--extract', val))
+            elif opt in ['--export', '--threads']:
+                self.operations.append((opt, val))
+            elif opt in ['--unchanged-since']:
+                self.unchanged_since = int(val)
+            elif opt in ['--watch']:
+                self.watch = True
+            elif opt in ['--format']:
+                self.config ['output_format'] = str(val)
             elif opt in ['--print']:
                 self.operations.append((opt, val))
                 self.config ['supress'] = False
@@ -887,8 +1460,10 @@ class SearchMailCommand(BaseQueryCommand):
         uids = client.search(self.query)
         uids.reverse()
 
-        print(message % len(uids))
+        jsonl = self.config ['output_format'] == 'jsonl'
+        print(message % len(uids), file = sys.stderr if jsonl else sys.stdout)
 
+        matched = uids
         if self.config ['limit'] is not None:
             uids = uids [:self.config ['limit']]
 
@@ -900,117 +1475,647 @@ class SearchMailCommand(BaseQueryCommand):
                 if opt == '--print' and not self.config ['supress']:
                     client.set_mailbox(self.config ['imap_mailbox'], True)
 
+                    if jsonl:
+                        self.print_message_records(client, uids)
+                    else:
+                        for uid in uids:
+                            self.print_message_status(client, uid)
+
+                if opt == '--extract':
+                    client.set_mailbox(self.config ['imap_mailbox'], True)
+
+                    count = 0
                     for uid in uids:
-                        self.print_message_status(client, uid)
+                        message = self.fetch_message(client, uid)
+                        if message is not None:
+                            count += self.extract_mailparts(message, str(val))
+                            message.close()
 
-                if opt == '--flag':
-                    client.set_mailbox(self.config ['imap_mailbox'], False)
+                    print("%d mailpart(s) saved to %s." %(count, val))
 
-                    flag = str(val)
-                    if flag[0] != '\\':
-                        flag = '\\' + str(val)
+                if opt == '--threads':
+                    client.set_mailbox(self.config ['imap_mailbox'], True)
+                    self.print_threads(client, matched)
 
-                    client.flag(','.join(uids), flag)
-                    print("%d message(s) flagged as %s." %(len(uids), flag))
+                if opt == '--export':
+                    client.set_mailbox(self.config ['imap_mailbox'], True)
+                    self.export_messages(client, uids, str(val))
 
-                elif opt == '--unflag':
+                if opt in ['--flag', '--unflag']:
                     client.set_mailbox(self.config ['imap_mailbox'], False)
 
                     flag = str(val)
                     if flag[0] != '\\':
                         flag = '\\' + str(val)
 
-                    client.unflag(','.join(uids), flag)
-                    print("%s flag removed from %d messages." %(flag, len(uids)))
+                    stored, modified = client.store_flags(
+                            uids, [flag],
+                            add = opt == '--flag',
+                            unchanged_since = self.unchanged_since,
+                            max_length = self.config ['imap_max_sequence_set'])
+
+                    index = self.open_header_index()
+                    index.update_flags(client.get_mailbox(), client.uidvalidity,
+                            stored, [flag], add = opt == '--flag')
+                    index.close()
+
+                    if opt == '--flag':
+                        print("%d message(s) flagged as %s." %(len(stored), flag))
+                    else:
+                        print("%s flag removed from %d message(s)." %(flag, len(stored)))
+
+                    if modified:
+                        print("%d message(s) modified since %d were not changed: %s" %(
+                            len(modified), self.unchanged_since,
+                            uid_sequence_set(modified)))
+
+                if opt in ['--copy', '--move']:
+                    # COPY is permitted on a mailbox opened with EXAMINE.
+                    client.set_mailbox(self.config ['imap_mailbox'], opt == '--copy')
+
+                    mailbox = str(val)
+                    keep = opt == '--copy' or not client.can_move_messages()
+                    if opt == '--copy':
+                        uidvalidity, uid_map = client.copy_messages(uids, mailbox, create = True,
+                                max_length = self.config ['imap_max_sequence_set'])
+                        print("%d message(s) copied to %s." %(len(uids), mailbox))
+                    else:
+                        uidvalidity, uid_map = client.move_messages(uids, mailbox, create = True,
+                                max_length = self.config ['imap_max_sequence_set'])
+
+                        if keep:
+                            print("%d message(s) copied to %s and flagged as deleted." %(
+                                len(uids), mailbox))
+                            print("They were not expunged, as the server supports neither "
+                                  "MOVE nor UIDPLUS, and EXPUNGE would remove every message "
+                                  "in the mailbox flagged as deleted.  Use --expunge to "
+                                  "remove them together with those messages.")
+                        else:
+                            print("%d message(s) moved to %s." %(len(uids), mailbox))
+
+                    self.relocate_messages(client, uids, mailbox, uidvalidity, uid_map,
+                            keep = keep)
+
+                    if opt == '--move' and keep:
+                        index = self.open_header_index()
+                        index.update_flags(client.get_mailbox(), client.uidvalidity,
+                                uids, ['\\Deleted'], add = True)
+                        index.close()
+
+                if opt == '--expunge':
+                    client.set_mailbox(self.config ['imap_mailbox'], False)
 
-#-------------------------------------------------------------------
-class ReadMailCommand(BaseCommand):
-    """
-        Read a mail message specified by UID.
+                    client.store_flags(uids, ['\\Deleted'],
+                            max_length = self.config ['imap_max_sequence_set'])
+                    client.expunge_messages(uids,
+                            max_length = self.config ['imap_max_sequence_set'])
 
-        Usage:
-            webmail read <options> UID
+                    self.relocate_messages(client, uids, None, None, {})
+                    print("%d message(s) expunged." % len(uids))
 
-        Options:
-            -u, --username <username>     (config: imap_username)
-                The IMAP username.  User will be prompted if missing.
+        if self.watch:
+            self.watch_mailbox(client)
 
-            -p, --password <password>     (config: imap_password)
-                The IMAP password.  User will be prompted if missing.
+    #----------------------------------------------------------------
+    def print_message_records(self, client, uids):
+        """
+            Print one JSON object per message, in the order given.
 
-            -H, --host <hostname>          (config: imap_hostname)
-                The IMAP server to connect to. Default is 'imap.gmail.com'.
+            Summaries are taken from the header index, or fetched in
+            batches for messages not yet indexed, and each batch is
+            written and flushed as soon as it arrives, so a consumer
+            can start before the listing is complete.
 
-            -P, --port <port>                (config: imap_port)
-                The IMAP server port. Default is '993'.
+            Config Settings:
+                summary_batch_size:
+                    The number of messages listed per batch.
+        """
 
-            -i, --inbox <inbox>             (config: imap_mailbox)
-                The IMAP mailbox from which to read.  Default is 'INBOX'.
+        batch_size = self.config ['summary_batch_size']
+        index = self.open_header_index()
 
-            -m, --mailpart <num>
-                The mailpart to be inspected.
+        try:
+            index.purge_stale(client.get_mailbox(), client.uidvalidity)
 
-            --no-ssl                            (config: imap_ssl)
-                Disables IMAP SSL/TLS.  Not recommended, enabled by default.
+            for n in range(0, len(uids), batch_size):
+                batch = [int(uid) for uid in uids [n:n + batch_size]]
+                records = self.fetch_records(client, index, batch)
 
-            --peek
-                Do not mark the message as read.
+                with timing.phase('render'):
+                    lines = [json.dumps(self.json_record(records [uid]))
+                             for uid in batch if uid in records]
 
-            -s, --supress
-                Don't show the message header summary.
+                    if lines:
+                        sys.stdout.write('\n'.join(lines) + '\n')
+                        sys.stdout.flush()
 
-            --header
-                Only show the message header summary, show no message parts.
+        finally:
+            index.close()
 
-            --raw-header
-                Print the raw header instead of a summary.
+    #----------------------------------------------------------------
+    def print_threads(self, client, uids):
+        """
+            Print the given messages grouped into conversation threads.
 
-            -h, --help
-                Prints this help message.
+            Threads are built by the server if it supports
+            THREAD=REFERENCES, otherwise from the References and
+            In-Reply-To headers in the header index.  Either way the
+            index provides the headers of each line, so only messages
+            not yet indexed are fetched.
 
-            UID
-                Required. The UID of the message to read.
+            Config Settings:
+                thread_line_format:
+                    A format string used to display each message, which
+                    may have any of the fields of 'watch_line_format',
+                    as well as:
+                        date:
+                            The date of the message, as formatted by
+                            'st_date_format_recent'.
+                        indent:
+                            'thread_indent' repeated once for each
+                            level of the message in its thread.
+                output_format:
+                    'text' to format messages with thread_line_format, or
+                    'jsonl' to print one JSON object per message, with
+                    the keys 'thread' and 'depth' added.
+        """
 
-        For a list of available commands, type "webmail help".
-    """
+        index = self.open_header_index()
 
-    PARAMETERS = 1
+        try:
+            index.purge_stale(client.get_mailbox(), client.uidvalidity)
+            records = self.fetch_records(client, index, uids)
+        finally:
+            index.close()
+
+        if client.has_capability('THREAD=REFERENCES'):
+            tree = client.thread(self.query)
+            with timing.phase('thread'):
+                roots = thread_tree(tree, records)
+        else:
+            with timing.phase('thread'):
+                roots = thread_records(records.values())
+
+        if self.config ['limit'] is not None:
+            roots = roots [:self.config ['limit']]
+
+        with timing.phase('render'):
+            self.render_threads(roots)
 
     #----------------------------------------------------------------
-    def __init__(self, argv):
-        SHORTOPTS    = 'u:p:H:i:P:m:'
-        LONGOPTS     = ['username=', 'password=', 'host=', 'inbox=', 'port=', 'no-ssl', 'mailpart']
+    def render_threads(self, roots):
+        jsonl = self.config ['output_format'] == 'jsonl'
+        template = Template(self.config ['thread_line_format'])
+        missing = {'uid': '', 'flags': '', 'date': None, 'sender_name': '',
+                   'sender_addr': '', 'subject': '(message not available)'}
+
+        for n, root in enumerate(roots):
+            for depth, node in root.walk():
+                record = node.record
+
+                if jsonl:
+                    if record is not None:
+                        print(json.dumps(self.json_record(record, thread = n, depth = depth)))
+                    continue
+
+                if record is None:
+                    record = missing
+
+                date = ''
+                if record ['date'] is not None:
+                    date = datetime.datetime.fromtimestamp(record ['date']).strftime(
+                            self.config ['st_date_format_recent'])
+
+                print(template.safe_substitute(
+                    uid = record ['uid'],
+                    date = date,
+                    indent = self.config ['thread_indent'] * depth,
+                    flags = record ['flags'],
+                    sender_name = record ['sender_name'],
+                    sender_addr = record ['sender_addr'],
+                    subject = self.normalize(record ['subject'] or '')))
 
-        self.message_uid = None
-        self.message_part = None
+    #----------------------------------------------------------------
+    def relocate_messages(self, client, uids, mailbox, uidvalidity, uid_map, keep = False):
+        """
+            Update the message cache and the header index after messages
+            in the selected mailbox were copied or moved to another
+            mailbox, or expunged if mailbox is None.
 
-        self.header_only = False
-        self.raw_header = False
+            Index records are moved to the new UIDs given by uid_map, so
+            their headers are not fetched again.  Those without a new
+            UID, e.g. if the server does not support UIDPLUS, are removed
+            unless keep is set.
 
-        BaseCommand.__init__(
-                self, argv, SHORTOPTS, LONGOPTS, {})
+            The message cache is keyed by UID alone for the whole account,
+            so cached messages cannot follow their new UIDs, which may be
+            those of other messages in the selected mailbox.  They are
+            removed unless keep is set.
+
+            Config Settings:
+                cache_enabled:
+                    If this setting is False, only the index is updated.
+        """
+
+        source = client.get_mailbox()
+        index = self.open_header_index()
+
+        if uid_map:
+            index.relocate(source, client.uidvalidity, uid_map,
+                           mailbox, uidvalidity, keep = True)
+        if not keep:
+            index.remove(source, client.uidvalidity, uids)
+        index.close()
+
+        # On Gmail, messages are cached under ids which stay the same
+        # when they are moved or copied, see cache_keys().
+        if keep or not self.config ['cache_enabled'] or client.has_capability(GMAIL_CAPABILITY):
+            return
+
+        cache = self.get_cache()
+        for uid in uids:
+            if cache.has(uid):
+                cache.remove(str(uid))
 
     #----------------------------------------------------------------
-    def process_config(self, opts, args):
-        BaseCommand.process_config(self, opts, args)
+    def export_messages(self, client, uids, spec):
+        """
+            Export the given messages in UID order to an mbox file or
+            Maildir directory, and report the throughput.
 
-        if len(args) < 1:
-            raise Exception("No message UID specified to read.")
+            Messages found in the cache are read from it.  The rest are
+            downloaded in batches, and cached if they do not exceed
+            'download_threshold', so that memory use is bounded by the
+            batch size rather than the number of messages.  Cached and
+            downloaded messages are merged as they are written, so the
+            export is in UID order either way.
 
-        self.message_uid = args.pop(0)
+            Config Settings:
+                fetch_batch_size:
+                    The number of message bodies to download per FETCH.
+                download_threshold:
+                    The maximum size of a downloaded message to cache.
+        """
 
-        if args:
-            self.message_part = int(args.pop(0))
+        uids = sorted(int(uid) for uid in uids)
+        writer = open_export(spec)
+        cache = self.get_cache() if self.config ['cache_enabled'] else None
+        threshold = self.config ['download_threshold']
 
-        for opt, val in opts:
-            if opt in ['-u', '--username']:
-                self.config ['imap_username'] = str(val)
-            elif opt in ['-p', '--password']:
-                self.config ['imap_password'] = str(val)
-            elif opt in ['-l', '--limit']:
-                self.config ['limit'] = int(val)
-            elif opt in ['-h', '--host']:
-                self.config ['imap_hostname'] = str(val)
+        count = 0
+        cached = 0
+        total_bytes = 0
+        start = time.time()
+
+        try:
+            # Flags and dates are needed for every message, but are
+            # cheap enough to fetch in a single pass, along with the
+            # ids messages are cached under on Gmail.
+            metadata = dict(client.fetch_attributes(uids, '(FLAGS INTERNALDATE%s)' % (
+                ' X-GM-MSGID' if client.has_capability(GMAIL_CAPABILITY) else ''),
+                max_length = self.config ['imap_max_sequence_set']))
+            keys = self.cache_keys(client, uids)
+
+            in_cache = set()
+            if cache is not None:
+                in_cache = set(uid for uid in uids if cache.has(keys [uid]))
+
+            # Both sources are in UID order.  Messages which could not
+            # be downloaded, e.g. if they were expunged, are skipped.
+            downloads = client.fetch_message_bodies(
+                    [uid for uid in uids if uid not in in_cache],
+                    batch_size = self.config ['fetch_batch_size'],
+                    max_length = self.config ['imap_max_sequence_set'])
+            downloaded = next(downloads, None)
+
+            for uid in uids:
+                raw_message = cache.load(keys [uid]) if uid in in_cache else None
+
+                if raw_message is not None:
+                    cached += 1
+                else:
+                    if uid in in_cache:
+                        # Evicted or damaged since it was found.
+                        raw_message = dict(client.fetch_message_bodies([uid])).get(uid)
+                    else:
+                        while downloaded is not None and downloaded [0] < uid:
+                            downloaded = next(downloads, None)
+
+                        if downloaded is not None and downloaded [0] == uid:
+                            raw_message = downloaded [1]
+                            downloaded = next(downloads, None)
+
+                    if raw_message is None:
+                        continue
+
+                    if cache is not None and (threshold is None or len(raw_message) < threshold):
+                        self.cache_save_message(keys [uid], raw_message)
+
+                total_bytes += self.export_message(writer, raw_message, metadata.get(uid))
+                count += 1
+
+        finally:
+            writer.close()
+
+        elapsed = max(time.time() - start, 1e-6)
+        print("Exported %d message(s), %.1f MB in %.2fs (%.0f msg/s, %.2f MB/s), %d from cache." % (
+            count, total_bytes / 1e6, elapsed, count / elapsed,
+            total_bytes / 1e6 / elapsed, cached))
+
+    #----------------------------------------------------------------
+    def export_message(self, writer, raw_message, attrs):
+        flags = []
+        date = None
+
+        if attrs is not None:
+            flags = [flag.decode() for flag in attrs.get('FLAGS') or []]
+            date = parse_internaldate(attrs.get('INTERNALDATE'))
+
+        return writer.write(raw_message, flags, date)
+
+    #----------------------------------------------------------------
+    def watch_mailbox(self, client):
+        """
+            Watch the mailbox for changes, reporting each new, expunged
+            or flag-changed message until interrupted.
+
+            The UIDs of the mailbox are kept in sequence order so that
+            EXPUNGE and FETCH responses, which refer to messages by
+            sequence number, can be mapped back to UIDs.  Message
+            headers are kept in the header index, so that only new
+            messages need to be fetched.
+
+            If the connection is lost, it is reconnected and the UIDs
+            are listed again, see watch_resync().
+
+            Config Settings:
+                watch_poll_interval:
+                    The number of seconds between NOOP polls if the
+                    server does not support IDLE.
+        """
+
+        client.set_mailbox(self.config ['imap_mailbox'], True)
+        mailbox = client.get_mailbox()
+
+        index = self.open_header_index()
+        index.purge_stale(mailbox, client.uidvalidity)
+
+        uids = [int(uid) for uid in client.search(IMAPQuery().all())]
+
+        try:
+            while True:
+                try:
+                    if client.has_capability('IDLE'):
+                        responses = client.idle()
+                    else:
+                        time.sleep(self.config ['watch_poll_interval'])
+                        responses = client.noop()
+
+                except CONNECTION_ERRORS:
+                    uids = self.watch_resync(client, index, uids)
+                    continue
+
+                exists = len(uids)
+
+                for typ, data in responses:
+                    if typ == 'EXPUNGE':
+                        seq = int(data)
+                        if seq <= len(uids):
+                            uid = uids.pop(seq - 1)
+                            exists -= 1
+                            record = index.get(mailbox, client.uidvalidity, uid)
+                            index.remove(mailbox, client.uidvalidity, [uid])
+                            self.print_watch_event('expunged', uid, record)
+
+                    elif typ == 'EXISTS':
+                        exists = int(data)
+
+                    elif typ == 'FETCH':
+                        for seq, attrs in parse_fetch_response([data]):
+                            if seq > len(uids) or 'FLAGS' not in attrs:
+                                continue
+
+                            uid = uids[seq - 1]
+                            flags = [flag.decode() for flag in attrs ['FLAGS']]
+
+                            # Messages not yet indexed are summarized with
+                            # a single small fetch, so the event can be shown.
+                            if index.get(mailbox, client.uidvalidity, uid) is None:
+                                index.update(mailbox, client.uidvalidity,
+                                        [header_record(summary)
+                                         for summary in client.fetch_summaries([uid])])
+
+                            index.set_flags(mailbox, client.uidvalidity, uid, flags)
+                            self.print_watch_event('flags', uid,
+                                    index.get(mailbox, client.uidvalidity, uid))
+
+                if exists > len(uids):
+                    self.watch_new_messages(client, index, uids, exists)
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            index.close()
+
+    #----------------------------------------------------------------
+    def watch_resync(self, client, index, uids):
+        """
+            Reconnect after the connection was lost while watching, and
+            list the UIDs of the mailbox again, as sequence numbers from
+            the lost connection no longer apply.  Messages expunged or
+            added while disconnected are reported.
+
+            Returns the new list of UIDs in sequence order.
+        """
+
+        mailbox = client.get_mailbox()
+
+        # The search reconnects and selects the mailbox again.
+        client.lost = True
+        current = [int(uid) for uid in client.search(IMAPQuery().all())]
+
+        known = set(uids)
+        remaining = set(current)
+
+        for uid in uids:
+            if uid not in remaining:
+                record = index.get(mailbox, client.uidvalidity, uid)
+                index.remove(mailbox, client.uidvalidity, [uid])
+                self.print_watch_event('expunged', uid, record)
+
+        # New messages always have greater UIDs, so they follow the
+        # known messages in sequence order.
+        uids = [uid for uid in current if uid in known]
+        if len(current) > len(uids):
+            self.watch_new_messages(client, index, uids, len(current))
+
+        return uids
+
+    #----------------------------------------------------------------
+    def watch_new_messages(self, client, index, uids, exists):
+        """
+            Fetch the summaries of messages that have arrived since
+            the last event in a single FETCH, add them to the index
+            and report them.
+        """
+
+        mailbox = client.get_mailbox()
+        summaries = list(client.fetch_summaries(
+            range(len(uids) + 1, exists + 1), by_uid = False))
+        summaries.sort(key = lambda summary: summary ['seq'])
+
+        records = [header_record(summary) for summary in summaries]
+        index.update(mailbox, client.uidvalidity, records)
+
+        matches = None
+        if len(self.query.phrases) > 0 and records:
+            query = self.query.uid(uid_sequence_set(r ['uid'] for r in records))
+            matches = set(int(uid) for uid in client.search(query))
+
+        for record in records:
+            uids.append(record ['uid'])
+            if matches is None or record ['uid'] in matches:
+                self.print_watch_event('new', record ['uid'], record)
+
+    #----------------------------------------------------------------
+    def print_watch_event(self, event, uid, record):
+        """
+            Print a single watch event as text or as a JSON line.
+
+            Config Settings:
+                output_format:
+                    'text' to format events with watch_line_format,
+                    or 'jsonl' to print one JSON object per event.
+                watch_line_format:
+                    A format string used to display events, which may
+                    have any of the following:
+                        event:
+                            One of 'new', 'expunged' or 'flags'.
+                        uid:
+                            The UID of the message.
+                        flags:
+                            The flags of the message.
+                        sender_name, sender_addr, subject:
+                            As in 'line_format'.
+        """
+
+        if self.config ['output_format'] == 'jsonl':
+            if record is None:
+                line = json.dumps({'event': event, 'uid': uid})
+            else:
+                line = json.dumps(self.json_record(record, event = event))
+
+        else:
+            if record is None:
+                record = {'flags': '', 'sender_name': '', 'sender_addr': '', 'subject': ''}
+
+            template = Template(self.config ['watch_line_format'])
+            line = template.safe_substitute(
+                    event = event,
+                    uid = uid,
+                    flags = record ['flags'],
+                    sender_name = record ['sender_name'],
+                    sender_addr = record ['sender_addr'],
+                    subject = self.normalize(record ['subject'] or ''))
+
+        print(line, flush = True)
+
+#-------------------------------------------------------------------
+class ReadMailCommand(BaseCommand):
+    """
+        Read a mail message specified by UID.
+
+        Usage:
+            webmail read <options> UID
+
+        Options:
+            -u, --username <username>     (config: imap_username)
+                The IMAP username.  User will be prompted if missing.
+
+            -p, --password <password>     (config: imap_password)
+                The IMAP password.  User will be prompted if missing.
+
+            -H, --host <hostname>          (config: imap_hostname)
+                The IMAP server to connect to. Default is 'imap.gmail.com'.
+
+            -P, --port <port>                (config: imap_port)
+                The IMAP server port. Default is '993'.
+
+            -i, --inbox <inbox>             (config: imap_mailbox)
+                The IMAP mailbox from which to read.  Default is 'INBOX'.
+
+            -m, --mailpart <num>
+                The mailpart to be inspected.
+
+            --no-ssl                            (config: imap_ssl)
+                Disables IMAP SSL/TLS.  Not recommended, enabled by default.
+
+            --peek
+                Do not mark the message as read.
+
+            -s, --supress
+                Don't show the message header summary.
+
+            --header
+                Only show the message header summary, show no message parts.
+
+            --raw-header
+                Print the raw header instead of a summary.
+
+            -x, --extract <directory>
+                Save the attachments of the message, or the mailpart given
+                by --mailpart, to files in the given directory instead of
+                opening them.
+
+            -h, --help
+                Prints this help message.
+
+            UID
+                Required. The UID of the message to read.
+
+        For a list of available commands, type "webmail help".
+    """
+
+    PARAMETERS = 1
+
+    #----------------------------------------------------------------
+    def __init__(self, argv):
+        SHORTOPTS    = 'u:p:H:i:P:m:x:'
+        LONGOPTS     = ['username=', 'password=', 'host=', 'inbox=', 'port=', 'no-ssl', 'mailpart',
+                'extract=', 'save=']
+
+        self.message_uid = None
+        self.message_part = None
+        self.extract_dir = None
+
+        self.header_only = False
+        self.raw_header = False
+
+        BaseCommand.__init__(
+                self, argv, SHORTOPTS, LONGOPTS, {})
+
+    #----------------------------------------------------------------
+    def process_config(self, opts, args):
+        BaseCommand.process_config(self, opts, args)
+
+        if len(args) < 1:
+            raise Exception("No message UID specified to read.")
+
+        self.message_uid = args.pop(0)
+
+        if args:
+            self.message_part = int(args.pop(0))
+
+        for opt, val in opts:
+            if opt in ['-u', '--username']:
+                self.config ['imap_username'] = str(val)
+            elif opt in ['-p', '--password']:
+                self.config ['imap_password'] = str(val)
+            elif opt in ['-l', '--limit']:
+                self.config ['limit'] = int(val)
+            elif opt in ['-h', '--host']:
+                self.config ['imap_hostname'] = str(val)
             elif opt in ['-i', '--inbox']:
                 self.config ['imap_mailbox'] = str(val)
             elif opt in ['-P', '--port']:
@@ -1023,6 +2128,8 @@ class ReadMailCommand(BaseCommand):
                 self.header_only = True
             elif opt in ['--raw_header']:
                 self.raw_header = True
+            elif opt in ['-x', '--extract', '--save']:
+                self.extract_dir = str(val)
 
     #----------------------------------------------------------------
     def run(self):
@@ -1042,7 +2149,10 @@ class ReadMailCommand(BaseCommand):
             self.print_header_summary(message)
             print()
 
-        if self.message_part is None:
+        if self.extract_dir is not None:
+            self.extract_mailparts(message, self.extract_dir, self.message_part)
+
+        elif self.message_part is None:
             n = 0
             for part in message.mailparts:
                 if part.type == 'text/plain' and part.is_body:
@@ -1078,16 +2188,646 @@ class CountMailCommand(SearchMailCommand):
         if len(self.query.phrases) < 1:
             self.query = self.query.unseen()
 
-        uids = client.search(self.query)
-        uids.reverse()
+        # Every message matches ALL, so the count reported when the
+        # mailbox was selected is used rather than searching.
+        if str(self.query) == 'ALL':
+            print(message % client.exists)
+            return
+
+        print(message % client.count(self.query))
+
+#-------------------------------------------------------------------
+class CacheStatsCommand(BaseCommand):
+    """
+        Report the size of the message cache for an account, the
+        compression ratio achieved and the decode throughput.
+
+        Usage:
+            webmail --cache-stats <options>
+
+        For a list of available commands, type "webmail help".
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, argv):
+        BaseCommand.__init__(self, argv, '', [], {})
+
+    #----------------------------------------------------------------
+    def run(self):
+        stats = self.get_cache().stats()
+
+        mb = 1024.0 * 1024.0
+        ratio = 0.0
+        throughput = 0.0
+
+        if stats ['stored_bytes']:
+            ratio = stats ['raw_bytes'] / stats ['stored_bytes']
+        if stats ['decode_seconds']:
+            throughput = stats ['raw_bytes'] / mb / stats ['decode_seconds']
+
+        print("Messages:   %d" % stats ['messages'])
+        print("Stored:     %.1f MB" %(stats ['stored_bytes'] / mb))
+        print("Raw:        %.1f MB" %(stats ['raw_bytes'] / mb))
+        print("Ratio:      %.2f" % ratio)
+        print("Decode:     %.1f MB/s" % throughput)
+        print("Codecs:     %s" % ', '.join("%s: %d" % x for x in sorted(stats ['codecs'].items())))
+        print("Damaged:    %d" % stats ['corrupt'])
+
+#-------------------------------------------------------------------
+class CacheTrainCommand(BaseCommand):
+    """
+        Train a compression dictionary on the headers of the messages
+        in the cache.  Messages cached from then on are compressed with
+        the new dictionary, using the codec set by 'cache_compression'.
+
+        Usage:
+            webmail --cache-train <options>
+
+        For a list of available commands, type "webmail help".
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, argv):
+        BaseCommand.__init__(self, argv, '', [], {})
+
+    #----------------------------------------------------------------
+    def run(self):
+        dict_id = self.get_cache().train_dictionary()
+        print("Trained cache dictionary %08x." % dict_id)
+
+#-------------------------------------------------------------------
+class CacheCollectCommand(BaseCommand):
+    """
+        Evict messages from the message cache for an account to bring
+        it within the configured limits.
+
+        Usage:
+            webmail --cache-gc <options>
+
+        Options:
+            --max-bytes <bytes>             (config: cache_max_bytes)
+                The size budget of the cache.  When exceeded, messages
+                are evicted until the cache is below 90% of the budget.
+
+            --max-age <seconds>             (config: cache_max_age)
+                Evict messages which have not been read for this long.
+
+            --eviction <policy>             (config: cache_eviction)
+                'lru' to evict the least recently used messages first,
+                or 'lfu' to evict the least frequently used.  Default
+                is 'lru'.
+
+            --verify
+                Before evicting, check the checksum of every message and
+                remove those which are damaged.  When a message is read
+                from an uncompressed cache, only its headers are checked,
+                so silent damage to its body is only caught by this pass.
+
+        Notes:
+            Limits in an account's section of the config apply to that
+            account only, so each account may be given its own quota.
+
+        For a list of available commands, type "webmail help".
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, argv):
+        LONGOPTS = ['max-bytes=', 'max-age=', 'eviction=', 'verify']
+
+        self.verify = False
 
-        print(message % len(uids))
+        BaseCommand.__init__(self, argv, '', LONGOPTS, {})
+
+    #----------------------------------------------------------------
+    def process_config(self, opts, args):
+        BaseCommand.process_config(self, opts, args)
+
+        for opt, val in opts:
+            if opt in ['--max-bytes']:
+                self.config ['cache_max_bytes'] = int(val)
+            elif opt in ['--max-age']:
+                self.config ['cache_max_age'] = int(val)
+            elif opt in ['--eviction']:
+                self.config ['cache_eviction'] = str(val)
+            elif opt in ['--verify']:
+                self.verify = True
+
+    #----------------------------------------------------------------
+    def run(self):
+        if self.verify:
+            print("%d damaged message(s) removed." % self.get_cache().verify())
+
+        count, size, remaining = self.get_cache().collect(
+                max_bytes = self.config ['cache_max_bytes'],
+                max_age = self.config ['cache_max_age'],
+                policy = self.config ['cache_eviction'])
+
+        print("%d message(s) evicted (%d bytes), %d bytes remaining." %(count, size, remaining))
+
+#-------------------------------------------------------------------
+class CacheImportCommand(BaseCommand):
+    """
+        Seed the message cache from a local mbox file or Maildir
+        directory, so that messages already on disk need not be
+        downloaded again.
+
+        Usage:
+            webmail --cache-import mbox:FILE | maildir:DIR <options>
+
+        Options:
+            -i, --inbox <inbox>             (config: imap_mailbox)
+                The IMAP mailbox the archive was taken from.  Default
+                is 'INBOX'.
+
+        Notes:
+            Local messages are matched to server UIDs by Message-ID and
+            size, using a single FETCH of the Message-ID and size of
+            every message in the mailbox.  Messages without a
+            Message-ID, or which differ from the server's copy, are
+            not imported.
+
+        For a list of available commands, type "webmail help".
+    """
+
+    PARAMETERS = 1
+
+    #----------------------------------------------------------------
+    def __init__(self, argv):
+        BaseCommand.__init__(self, argv, '', [], {})
+
+    #----------------------------------------------------------------
+    def process_config(self, opts, args):
+        BaseCommand.process_config(self, opts, args)
+
+        if len(args) < 1:
+            raise Exception("No archive specified to import.")
+
+        self.archive = args.pop(0)
+
+        for opt, val in opts:
+            if opt in ['-i', '--inbox']:
+                self.config ['imap_mailbox'] = str(val)
+
+    #----------------------------------------------------------------
+    def run(self):
+        if not self.config ['cache_enabled']:
+            raise Exception("The cache is disabled.")
+
+        messages = open_archive(self.archive)
+
+        client = self.perform_imap_login()
+        client.set_mailbox(self.config ['imap_mailbox'], True)
+
+        server = {}
+        for uid, size, message_id in client.fetch_message_ids():
+            if message_id:
+                server.setdefault((message_id, size), []).append(uid)
+
+        cache = self.get_cache()
+        scanned = 0
+        imported = 0
+        present = 0
+        saved_bytes = 0
+
+        for raw_message in messages:
+            scanned += 1
+
+            # The server counts message sizes with CRLF line endings.
+            raw_message = raw_message.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+            header_end, body_start = find_header_end(raw_message, 0, len(raw_message))
+            message_id = parse_message_id(raw_message[:header_end])
+
+            uids = server.get((message_id, len(raw_message)))
+            if not message_id or not uids:
+                continue
+
+            key = self.cache_key(client, uids.pop(0))
+
+            with cache.lock(key):
+                if cache.has(key):
+                    present += 1
+                    continue
+
+                self.cache_save_message(key, raw_message)
+
+            imported += 1
+            saved_bytes += len(raw_message)
+
+        print("%d message(s) read, %d imported (%.1f MB), %d already cached, %d unmatched." % (
+            scanned, imported, saved_bytes / 1e6, present, scanned - imported - present))
+
+#-------------------------------------------------------------------
+class CacheIndexCommand(BaseCommand):
+    """
+        Add the messages in the cache to the header index, so that
+        listings and threads need not fetch their headers.  Messages
+        are read and parsed in a pool of worker processes.
+
+        Usage:
+            webmail --cache-index <options>
+
+        Options:
+            -i, --inbox <inbox>             (config: imap_mailbox)
+                The IMAP mailbox the cached messages belong to.
+                Default is 'INBOX'.
+
+            --processes <n>                 (config: parse_processes)
+                The number of worker processes.  Default is the number
+                of CPUs.
+
+        Notes:
+            The flags of each message are fetched from the server in a
+            single FETCH, and cached messages no longer on the server
+            are not indexed.  On Gmail, where messages are cached under
+            their X-GM-MSGID, the ids of every message in the mailbox
+            are fetched to find which cached messages belong to it.
+
+            Messages cached on Gmail under their UID, by versions which
+            did not use X-GM-MSGID, are moved to their X-GM-MSGID when
+            their size and Message-ID match the message in the mailbox.
+            Any left over are never read again, and are evicted first
+            by --cache-gc.
+
+        For a list of available commands, type "webmail help".
+    """
+
+    # The number of records written to the index at a time.
+    BATCH_SIZE = 1000
+
+    #----------------------------------------------------------------
+    def __init__(self, argv):
+        BaseCommand.__init__(self, argv, '', ['processes='], {})
+
+    #----------------------------------------------------------------
+    def process_config(self, opts, args):
+        BaseCommand.process_config(self, opts, args)
+
+        for opt, val in opts:
+            if opt in ['-i', '--inbox']:
+                self.config ['imap_mailbox'] = str(val)
+            elif opt in ['--processes']:
+                self.config ['parse_processes'] = int(val)
+
+    #----------------------------------------------------------------
+    def run(self):
+        if not self.config ['cache_enabled']:
+            raise Exception("The cache is disabled.")
+
+        client = self.perform_imap_login()
+        client.set_mailbox(self.config ['imap_mailbox'], True)
+        mailbox = client.get_mailbox()
+
+        cache = self.get_cache()
+        index = self.open_header_index()
+
+        try:
+            index.purge_stale(mailbox, client.uidvalidity)
+
+            # Map the cache keys of messages in this mailbox to their UIDs.
+            gmail = client.has_capability(GMAIL_CAPABILITY)
+            if gmail:
+                migrated = self.migrate_uid_keys(client, cache)
+                if migrated:
+                    print("%d message(s) cached by UID moved to their X-GM-MSGID." % migrated)
+
+                # The ids fetched by the migration are not fetched again.
+                uids = [int(uid) for uid in client.search(IMAPQuery().all())]
+                gmail_ids = client.fetch_gmail_ids(uids,
+                        max_length = self.config ['imap_max_sequence_set'])
+
+                by_key = dict(('gm/%d' % msgid, uid) for uid, msgid in gmail_ids.items())
+                uids_by_key = dict((key, by_key [key]) for key in cache.keys() if key in by_key)
+            else:
+                uids_by_key = dict((key, int(key)) for key in cache.keys() if key.isdigit())
+
+            keys_by_uid = dict((uid, key) for key, uid in uids_by_key.items())
+            indexed = index.get_many(mailbox, client.uidvalidity, sorted(keys_by_uid))
+            missing = [uid for uid in sorted(keys_by_uid) if uid not in indexed]
+
+            # The Gmail thread ids and labels are not in the messages
+            # themselves, so they are fetched with the flags.
+            flags = {}
+            gmail_fields = {}
+            for uid, attrs in client.fetch_attributes(missing,
+                    '(FLAGS X-GM-MSGID X-GM-THRID X-GM-LABELS)' if gmail else 'FLAGS',
+                    max_length = self.config ['imap_max_sequence_set']):
+                key = keys_by_uid [uid]
+                flags [key] = [flag.decode() for flag in attrs.get('FLAGS') or []]
+
+                if gmail:
+                    gmail_fields [key] = {
+                        'gm_msgid':     int(attrs ['X-GM-MSGID']) if 'X-GM-MSGID' in attrs else None,
+                        'gm_thrid':     int(attrs ['X-GM-THRID']) if 'X-GM-THRID' in attrs else None,
+                        'gm_labels':    json.dumps([label.decode('utf-8', 'replace')
+                                                    for label in attrs.get('X-GM-LABELS') or [] if label])
+                    }
+
+            records = []
+            added = 0
+            failed = 0
+
+            with ParsePool(self.config ['parse_processes'], cache.directory) as pool:
+                for key, result in pool.parse_cached(sorted(flags, key = uids_by_key.get),
+                                                     flags, uids = uids_by_key):
+                    if result is None:
+                        failed += 1
+                        continue
+
+                    result.update(gmail_fields.get(key, {}))
+                    records.append(result)
+                    if len(records) >= self.BATCH_SIZE:
+                        index.update(mailbox, client.uidvalidity, records)
+                        added += len(records)
+                        records = []
+
+            index.update(mailbox, client.uidvalidity, records)
+            added += len(records)
+
+        finally:
+            index.close()
+
+        print("%d message(s) indexed, %d already indexed, %d not on the server, %d unreadable." % (
+            added, len(indexed), len(missing) - len(flags), failed))
+
+    #----------------------------------------------------------------
+    def migrate_uid_keys(self, client, cache):
+        """
+            Move messages cached under their UID to their X-GM-MSGID,
+            fetching the size, Message-ID and X-GM-MSGID of every message
+            in the selected mailbox.  The cache is keyed by UID alone, so
+            a message is only moved if it matches the message with that
+            UID in this mailbox.  Returns the number of messages moved.
+        """
+
+        uid_keys = set(key for key in cache.keys() if key.isdigit())
+        moved = 0
+
+        for uid, size, message_id in client.fetch_message_ids():
+            if str(uid) not in uid_keys or uid not in client.gmail_ids:
+                continue
+
+            key = 'gm/%d' % client.gmail_ids [uid]
+
+            with cache.lock(key):
+                raw_message = cache.load(str(uid))
+                if raw_message is None or len(raw_message) != size:
+                    continue
+
+                header_end, body_start = find_header_end(raw_message, 0, len(raw_message))
+                if parse_message_id(raw_message[:header_end]) != message_id:
+                    continue
+
+                if not cache.has(key):
+                    self.cache_save_message(key, raw_message)
+                cache.remove(str(uid))
+
+            moved += 1
+
+        return moved
+
+#-------------------------------------------------------------------
+class SendMailCommand(BaseCommand):
+    """
+        Send messages over SMTP.  Messages are first queued in the
+        outbox, then everything due in the outbox is sent over a
+        single SMTP session.  Messages which cannot be sent yet stay
+        queued, and are sent again by a later --send.
+
+        Usage:
+            webmail --send [FILE ...] <options>
+
+        Options:
+            --to <address>
+                A recipient of the messages, which may be given more than
+                once.  By default, the To, Cc and Bcc headers of each
+                message are used.
+
+            --from <address>                (config: smtp_from)
+                The envelope sender.  Default is the SMTP username.
+
+            --subject <subject>
+                Treat the input as plain text, and compose a message with
+                this subject, encoded with 'smtp_text_enc'.
+
+            --queue
+                Only queue the messages, without sending.
+
+            --flush
+                Only send the messages already queued.
+
+            --sent <mailbox>                (config: imap_sent_mailbox)
+                Save a copy of each message sent to this IMAP mailbox,
+                flagged as seen.  The copies are uploaded together once
+                sending is finished.
+
+        Notes:
+            Each FILE is a complete RFC822 message, or plain text if
+            --subject is given.  With no FILE, a single message is read
+            from standard input.  FILEs and options may be given in any
+            order.
+
+        For a list of available commands, type "webmail help".
+    """
+
+    MIXED_ARGUMENTS = True
+
+    #----------------------------------------------------------------
+    def __init__(self, argv):
+        LONGOPTS = ['to=', 'from=', 'subject=', 'queue', 'flush', 'sent=']
+
+        self.recipients = []
+        self.subject = None
+        self.queue_only = False
+        self.flush_only = False
+        self.files = []
+
+        BaseCommand.__init__(self, argv, '', LONGOPTS, {})
+
+    #----------------------------------------------------------------
+    def process_config(self, opts, args):
+        BaseCommand.process_config(self, opts, args)
+
+        for opt, val in opts:
+            if opt in ['--to']:
+                self.recipients.append(str(val))
+            elif opt in ['--from']:
+                self.config ['smtp_from'] = str(val)
+            elif opt in ['--subject']:
+                self.subject = str(val)
+            elif opt in ['--queue']:
+                self.queue_only = True
+            elif opt in ['--flush']:
+                self.flush_only = True
+            elif opt in ['--sent']:
+                self.config ['imap_sent_mailbox'] = str(val)
+
+        self.files = list(args)
+
+    #----------------------------------------------------------------
+    def read_messages(self):
+        if not self.files:
+            yield sys.stdin.buffer.read()
+
+        for filename in self.files:
+            with open(os.path.expanduser(filename), 'rb') as f:
+                yield f.read()
+
+    #----------------------------------------------------------------
+    def compose(self, from_addr, text):
+        if not self.recipients:
+            raise Exception("No recipients specified, use --to.")
+
+        charset = self.config ['smtp_text_enc']
+        payload, mail_from, rcpt_to, msg_id = pyzmail.compose_mail(
+                from_addr, self.recipients, self.subject, charset,
+                (text.decode(charset, 'replace'), charset),
+                message_id_string = 'webmail')
+
+        return payload.encode('ascii')
+
+    #----------------------------------------------------------------
+    def run(self):
+        outbox = self.get_outbox()
+
+        if not self.flush_only:
+            from_addr = self.config ['smtp_from'] or \
+                    self.config ['smtp_username'] or self.config ['imap_username']
+            if not from_addr:
+                raise Exception("No sender address, use --from.")
+
+            queued = 0
+            for raw_message in self.read_messages():
+                if self.subject is not None:
+                    raw_message = self.compose(from_addr, raw_message)
+
+                recipients, raw_message = envelope_recipients(raw_message)
+                if self.recipients:
+                    recipients = self.recipients
+                if not recipients:
+                    raise Exception("No recipients specified, use --to.")
+
+                outbox.put(from_addr, recipients, raw_message)
+                queued += 1
+
+            print("%d message(s) queued." % queued, file = sys.stderr)
+
+        if self.queue_only or not outbox.ready():
+            return
+
+        sender = self.perform_smtp_login()
+
+        def log(name, outcome, error):
+            if error is not None:
+                print("%s %s: %s" % (name, outcome, error), file = sys.stderr)
+
+        sent = []
+        on_sent = None
+        if self.config ['imap_sent_mailbox']:
+            on_sent = lambda envelope, raw_message: sent.append(
+                    (raw_message, ['\\Seen'], None))
+
+        try:
+            counts = sender.send_outbox(outbox, log = log, on_sent = on_sent)
+        finally:
+            # Messages already sent are saved even if sending the rest
+            # failed, as they will not be sent again.
+            if sent:
+                self.save_sent(sent)
+
+        remaining = outbox.stats()
+
+        print("%d message(s) sent, %d deferred, %d failed, %d queued." % (
+            counts ['sent'], counts ['deferred'], counts ['failed'], remaining ['queue']))
+
+    #----------------------------------------------------------------
+    def save_sent(self, messages):
+        mailbox = self.config ['imap_sent_mailbox']
+
+        try:
+            client = self.perform_imap_login()
+            client.append(mailbox, messages, self.config ['append_batch_size'])
+
+        except Exception as e:
+            print("Could not save %d sent message(s) to %s: %s" % (
+                len(messages), mailbox, e), file = sys.stderr)
+
+#-------------------------------------------------------------------
+class RestoreCommand(BaseCommand):
+    """
+        Upload the messages in a local mbox file or Maildir directory
+        to an IMAP mailbox, e.g. to restore an archive made with
+        --export.
+
+        Usage:
+            webmail --restore mbox:FILE | maildir:DIR <options>
+
+        Options:
+            -i, --inbox <inbox>             (config: imap_mailbox)
+                The IMAP mailbox to upload to.  Default is 'INBOX'.
+
+            --batch-size <n>                (config: append_batch_size)
+                The most messages uploaded in one command, if the
+                server supports MULTIAPPEND.  Default is 100.
+
+        Notes:
+            Flags are restored from Maildir file names, and the
+            received date from the mbox "From " line or the Maildir
+            file time.  Maildir messages are read from disk as they
+            are uploaded.
+
+        For a list of available commands, type "webmail help".
+    """
+
+    PARAMETERS = 1
+
+    #----------------------------------------------------------------
+    def __init__(self, argv):
+        BaseCommand.__init__(self, argv, '', ['batch-size='], {})
+
+    #----------------------------------------------------------------
+    def process_config(self, opts, args):
+        BaseCommand.process_config(self, opts, args)
+
+        if len(args) < 1:
+            raise Exception("No archive specified to restore.")
+
+        self.archive = args.pop(0)
+
+        for opt, val in opts:
+            if opt in ['-i', '--inbox']:
+                self.config ['imap_mailbox'] = str(val)
+            elif opt in ['--batch-size']:
+                self.config ['append_batch_size'] = int(val)
+
+    #----------------------------------------------------------------
+    def run(self):
+        entries = open_archive_entries(self.archive)
+        restored = 0
+
+        def messages():
+            nonlocal restored
+            for entry in entries:
+                restored += 1
+                yield entry
+
+        client = self.perform_imap_login()
+        client.append(self.config ['imap_mailbox'], messages(),
+                      self.config ['append_batch_size'])
+
+        print("%d message(s) restored to %s." % (restored, self.config ['imap_mailbox']))
 
 #-------------------------------------------------------------------
 COMMAND_MAP = {
         "--search":        SearchMailCommand,
         "--count":         CountMailCommand,
-        "--read":          ReadMailCommand
+        "--read":          ReadMailCommand,
+        "--cache-stats":   CacheStatsCommand,
+        "--cache-train":   CacheTrainCommand,
+        "--cache-gc":      CacheCollectCommand,
+        "--cache-import":  CacheImportCommand,
+        "--cache-index":   CacheIndexCommand,
+        "--send":          SendMailCommand,
+        "--restore":       RestoreCommand
 }
 
 #-------------------------------------------------------------------
@@ -1113,7 +2853,27 @@ def main():
 
     try:
         app = cmd(argv)
-        app.run()
+        try:
+            app.run()
+        finally:
+            try:
+                app.close()
+            finally:
+                # The statistics and the profile are written even if the
+                # command failed, when they are most needed, but writing
+                # them must not hide the error.
+                if app.config ['print_stats']:
+                    try:
+                        app.print_command_stats()
+                    except Exception as e:
+                        print("Could not print command statistics: %s" % e, file=sys.stderr)
+                try:
+                    app.write_profile()
+                except Exception as e:
+                    print("Could not write profile: %s" % e, file=sys.stderr)
+
+        if app.config ['debug']:
+            app.print_transfer_stats()
 
     except Exception as e:
         import traceback
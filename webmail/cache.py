@@ -0,0 +1,879 @@
+#-------------------------------------------------------------------
+# webmail.cache
+#
+# Storage of downloaded messages on disk, with optional
+# per-message compression.
+#-------------------------------------------------------------------
+
+import collections
+import contextlib
+import mmap
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .mime import LazyMessage
+
+#-------------------------------------------------------------------
+# Cache files begin with a frame header: the magic number, a codec
+# byte, the id of the dictionary used, or zero, and the length and
+# CRC-32 of the message's header block if it is stored uncompressed.
+# They end with a footer holding the length and CRC-32 of everything
+# before it, so that truncated or damaged files are detected when
+# read.  Files without the magic number are uncompressed messages
+# written by earlier versions, as are frames with the first version
+# of the magic number, which have no header block CRC.
+#
+# Files are written under a temporary name and renamed into place,
+# so a torn write never appears under the final name.  Messages
+# opened lazily with open_message() therefore only have their
+# footer and the CRC-32 of their header block checked, as the
+# header is read anyway.  The CRC-32 of the whole file is checked
+# when messages are fully decoded, by stats() and by verify(), so
+# damage to the body of an uncompressed message is only detected
+# by those.
+FRAME_MAGIC = b'WMC\x02'
+FRAME_HEADER = struct.Struct('>4sBIQI')
+LEGACY_FRAME_MAGIC = b'WMC\x01'
+LEGACY_FRAME_HEADER = struct.Struct('>4sBI')
+FOOTER_MAGIC = b'WMF\x01'
+FRAME_FOOTER = struct.Struct('>4sQI')
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+CODECS = {
+    None:       CODEC_NONE,
+    'none':     CODEC_NONE,
+    'zlib':     CODEC_ZLIB,
+    'zstd':     CODEC_ZSTD
+}
+
+CACHE_EXTENSION = '.webmail'
+TEMP_EXTENSION = '.tmp'
+DICTIONARY_DIR = 'dictionaries'
+LOCK_DIR = 'locks'
+INDEX_FILENAME = 'cache.sqlite'
+
+# Writers lock one of a fixed number of lock files chosen by key,
+# so that processes only wait on each other when saving the same
+# (or a colliding) message.
+LOCK_STRIPES = 256
+
+# Temporary files older than this are left over from an
+# interrupted write and are removed by collect().
+STALE_TEMP_AGE = 86400
+
+# The size and access history of each cached message, used to
+# choose which messages to evict.
+INDEX_SCHEMA = """
+    PRAGMA journal_mode = WAL;
+    CREATE TABLE IF NOT EXISTS entries (
+        key             TEXT PRIMARY KEY,
+        size            INTEGER NOT NULL,
+        accessed        REAL NOT NULL,
+        hits            INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        name            TEXT PRIMARY KEY,
+        value           TEXT
+    );
+"""
+
+EVICTION_ORDER = {
+    'lru':      'accessed ASC',
+    'lfu':      'hits ASC, accessed ASC'
+}
+
+# Accesses are recorded in memory and written to the index in one
+# transaction when this many messages have been accessed, or when
+# the cache is closed, so that readers do not take the write lock
+# of the shared index for every message.
+ACCESS_BATCH_SIZE = 500
+
+# When the cache exceeds its size budget, messages are evicted
+# until it is this fraction of the budget, so that collection is
+# not needed again after every save.
+GC_LOW_WATERMARK = 0.9
+
+# zlib can only make use of the last 32KB of a preset dictionary.
+ZLIB_DICTIONARY_SIZE = 32768
+ZSTD_DICTIONARY_SIZE = 65536
+
+#-------------------------------------------------------------------
+class MailCacheException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+#-------------------------------------------------------------------
+class CorruptCacheEntry(MailCacheException):
+    def __init__(self, message):
+        MailCacheException.__init__(self, message)
+
+#-------------------------------------------------------------------
+def check_frame(buf, verify = True):
+    """
+        Validate the frame of a stored cache file.
+
+        Returns a tuple of (codec, dict_id, start, end), where start
+        and end are the offsets of the payload in buf.  Raises
+        CorruptCacheEntry if the file is framed but its footer is
+        missing or does not match its contents.  If verify is False,
+        only the CRC-32 of the header block is checked, so that the
+        rest of the payload is not read.
+    """
+
+    magic = buf[:len(FRAME_MAGIC)]
+    if magic == FRAME_MAGIC:
+        frame_header = FRAME_HEADER
+    elif magic == LEGACY_FRAME_MAGIC:
+        frame_header = LEGACY_FRAME_HEADER
+    else:
+        return CODEC_NONE, 0, 0, len(buf)
+
+    end = len(buf) - FRAME_FOOTER.size
+    if end < frame_header.size:
+        raise CorruptCacheEntry("Cache file is truncated.")
+
+    magic, length, crc = FRAME_FOOTER.unpack(buf[end:])
+    if magic != FOOTER_MAGIC or length != end:
+        raise CorruptCacheEntry("Cache file is truncated.")
+
+    fields = frame_header.unpack_from(buf)
+    codec, dict_id = fields[1], fields[2]
+    start = frame_header.size
+
+    with memoryview(buf) as view:
+        if verify:
+            with view[:end] as frame:
+                if zlib.crc32(frame) != crc:
+                    raise CorruptCacheEntry("Cache file checksum mismatch.")
+
+        elif frame_header is FRAME_HEADER and fields[3]:
+            header_length, header_crc = fields[3:]
+            if start + header_length > end:
+                raise CorruptCacheEntry("Cache file is truncated.")
+
+            with view[start:start + header_length] as header:
+                if zlib.crc32(header) != header_crc:
+                    raise CorruptCacheEntry("Cache file header checksum mismatch.")
+
+    return codec, dict_id, start, end
+
+#-------------------------------------------------------------------
+def split_header(raw):
+    """
+        Return the header block of a raw RFC822 message.
+    """
+
+    for separator in (b'\r\n\r\n', b'\n\n'):
+        n = raw.find(separator)
+        if n >= 0:
+            return raw[:n + len(separator)]
+
+    return raw
+
+#-------------------------------------------------------------------
+class MailCache():
+    """
+        A directory of cached messages, one file per message.
+
+        Messages may be stored compressed with zlib or, if the
+        zstandard module is installed, zstd.  Both codecs can use a
+        dictionary trained on the headers of cached messages, which
+        greatly improves the ratio for small messages.  Compression
+        is transparent to load(), which reads any stored format.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, directory, compression = None, level = 6,
+                 use_dictionary = True):
+        if compression not in CODECS:
+            raise MailCacheException("Unknown cache compression: %s" % compression)
+
+        if CODECS[compression] == CODEC_ZSTD and zstandard is None:
+            raise MailCacheException("The zstandard module is required for zstd cache compression.")
+
+        self.directory = directory
+        self.codec = CODECS[compression]
+        self.level = level
+        self.use_dictionary = use_dictionary
+        self.dictionaries = {}
+        self.db = None
+        self.accesses = {}
+        self.janitor = None
+
+    #----------------------------------------------------------------
+    def filename(self, key):
+        """
+            Determines the absolute path of the cache file for the
+            given key.
+        """
+
+        return os.path.join(self.directory, "%s%s" % (key, CACHE_EXTENSION))
+
+    #----------------------------------------------------------------
+    def has(self, key):
+        return os.path.exists(self.filename(key))
+
+    #----------------------------------------------------------------
+    def keys(self):
+        """
+            Yield the keys of all messages in the cache.
+        """
+
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in (DICTIONARY_DIR, LOCK_DIR):
+                if name in dirnames:
+                    dirnames.remove(name)
+
+            prefix = os.path.relpath(dirpath, self.directory)
+
+            for name in filenames:
+                if name.endswith(CACHE_EXTENSION):
+                    key = name[:-len(CACHE_EXTENSION)]
+                    if prefix != os.curdir:
+                        key = '/'.join(prefix.split(os.sep) + [key])
+                    yield key
+
+    #----------------------------------------------------------------
+    def load(self, key):
+        """
+            Load the raw message stored under the given key.
+            Returns None if the message is not in the cache.
+        """
+
+        data = self.read(key)
+        if data is None:
+            return None
+
+        try:
+            raw = self.decode(data)
+        except CorruptCacheEntry:
+            self.remove(key)
+            return None
+
+        self.touch(key, len(data))
+        return raw
+
+    #----------------------------------------------------------------
+    def read(self, key):
+        """
+            Read the stored form of the message under the given key,
+            without recording an access.  Returns None if the message
+            is not in the cache.
+        """
+
+        try:
+            with open(self.filename(key), 'rb') as in_file:
+                return in_file.read()
+
+        except FileNotFoundError:
+            return None
+
+    #----------------------------------------------------------------
+    def open_message(self, key):
+        """
+            Open the message stored under the given key as a LazyMessage.
+            Uncompressed messages are read through a read-only mmap of
+            the cache file, so that only the pages actually read are
+            loaded, and only the frame footer and the CRC-32 of the
+            header block are checked.  Compressed messages are decoded
+            into memory, and checked in full.
+
+            Returns None if the message is not in the cache, or if the
+            cache file is damaged, in which case it is removed.
+        """
+
+        try:
+            with open(self.filename(key), 'rb') as in_file:
+                size = os.fstat(in_file.fileno()).st_size
+                if size == 0:
+                    buf = b''
+                else:
+                    buf = mmap.mmap(in_file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        except FileNotFoundError:
+            return None
+
+        try:
+            codec, dict_id, start, end = check_frame(buf, verify = False)
+            if codec != CODEC_NONE:
+                try:
+                    raw = self.decode(buf[:])
+                finally:
+                    buf.close()
+
+        except CorruptCacheEntry:
+            buf.close()
+            self.remove(key)
+            return None
+
+        self.touch(key, size)
+
+        if codec == CODEC_NONE:
+            return LazyMessage(buf, start, end)
+
+        return LazyMessage(raw)
+
+    #----------------------------------------------------------------
+    def save(self, key, raw):
+        """
+            Save the raw message under the given key, compressing
+            it if compression is enabled.
+        """
+
+        self.make_directory()
+
+        data = self.encode(raw)
+        filename = self.filename(key)
+        dirname = os.path.dirname(filename)
+
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok = True)
+
+        # Write to a temporary file and rename it into place, so that
+        # readers never see a partially written message.
+        fd, temp_filename = tempfile.mkstemp(
+                prefix = '.' + os.path.basename(filename) + '.',
+                suffix = TEMP_EXTENSION, dir = dirname)
+
+        try:
+            with os.fdopen(fd, 'wb') as out_file:
+                out_file.write(data)
+            os.replace(temp_filename, filename)
+
+        except BaseException:
+            try:
+                os.unlink(temp_filename)
+            except FileNotFoundError:
+                pass
+            raise
+
+        self.touch(key, len(data), hit = False)
+
+    #----------------------------------------------------------------
+    @contextlib.contextmanager
+    def lock(self, key):
+        """
+            A context manager holding an exclusive lock on the given key
+            across processes, used to keep two processes from fetching
+            and saving the same message at once.  Locks are striped over
+            LOCK_STRIPES files, so unrelated keys rarely contend.
+        """
+
+        if fcntl is None:
+            yield
+            return
+
+        lock_dir = os.path.join(self.directory, LOCK_DIR)
+        os.makedirs(lock_dir, exist_ok = True)
+
+        stripe = zlib.crc32(key.encode()) % LOCK_STRIPES
+        with open(os.path.join(lock_dir, "%02x.lock" % stripe), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    #----------------------------------------------------------------
+    def remove(self, key):
+        """
+            Remove the message stored under the given key.
+        """
+
+        try:
+            os.unlink(self.filename(key))
+        except FileNotFoundError:
+            pass
+
+        self.accesses.pop(key, None)
+        self.get_index().execute("DELETE FROM entries WHERE key = ?", (key,))
+        self.get_index().commit()
+
+    #----------------------------------------------------------------
+    def get_index(self):
+        """
+            Open the index of cache entries used for eviction.
+        """
+
+        if self.db is None:
+            self.make_directory()
+            self.db = sqlite3.connect(os.path.join(self.directory, INDEX_FILENAME), timeout = 30)
+            self.db.executescript(INDEX_SCHEMA)
+            self.db.execute("PRAGMA synchronous = NORMAL")
+
+        return self.db
+
+    #----------------------------------------------------------------
+    def close(self):
+        """
+            Wait for the janitor to finish, write the accesses recorded
+            and close the index.
+        """
+
+        if self.janitor is not None:
+            self.janitor.join()
+            self.janitor = None
+
+        self.flush_accesses()
+
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    #----------------------------------------------------------------
+    def touch(self, key, size, hit = True):
+        """
+            Record an access to the given message, to be written to
+            the index by flush_accesses().
+        """
+
+        access = self.accesses.get(key)
+        if access is None:
+            access = self.accesses [key] = [size, 0.0, 0]
+
+        access[0] = size
+        access[1] = time.time()
+        if hit:
+            access[2] += 1
+
+        if len(self.accesses) >= ACCESS_BATCH_SIZE:
+            self.flush_accesses()
+
+    #----------------------------------------------------------------
+    def flush_accesses(self):
+        """
+            Write the accesses recorded by touch() to the index, in
+            a single transaction.
+        """
+
+        if not self.accesses:
+            return
+
+        db = self.get_index()
+        db.executemany("""
+            INSERT INTO entries (key, size, accessed, hits) VALUES (?, ?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                size = excluded.size,
+                accessed = excluded.accessed,
+                hits = hits + excluded.hits""",
+            ((key, size, accessed, hits) for key, (size, accessed, hits) in self.accesses.items()))
+        db.commit()
+
+        self.accesses = {}
+
+    #----------------------------------------------------------------
+    def make_directory(self):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                raise MailCacheException("Unable to create cache directory: %s" % str(e))
+
+    #----------------------------------------------------------------
+    def encode(self, raw):
+        """
+            Encode a raw message into the stored format.
+        """
+
+        dict_id, dictionary = 0, None
+        if self.use_dictionary and self.codec != CODEC_NONE:
+            dict_id, dictionary = self.current_dictionary()
+
+        # The header block of an uncompressed message has a CRC-32 of
+        # its own, checked when it is opened lazily.
+        header_length, header_crc = 0, 0
+
+        if self.codec == CODEC_NONE:
+            payload = raw
+            header = split_header(raw)
+            header_length, header_crc = len(header), zlib.crc32(header)
+
+        elif self.codec == CODEC_ZLIB:
+            if dictionary is not None:
+                compressor = zlib.compressobj(self.level, zdict = dictionary)
+            else:
+                compressor = zlib.compressobj(self.level)
+            payload = compressor.compress(raw) + compressor.flush()
+
+        else:
+            if dictionary is not None:
+                compressor = zstandard.ZstdCompressor(level = self.level,
+                        dict_data = zstandard.ZstdCompressionDict(dictionary))
+            else:
+                compressor = zstandard.ZstdCompressor(level = self.level)
+            payload = compressor.compress(raw)
+
+        frame = FRAME_HEADER.pack(FRAME_MAGIC, self.codec, dict_id,
+                                  header_length, header_crc) + payload
+        return frame + FRAME_FOOTER.pack(FOOTER_MAGIC, len(frame), zlib.crc32(frame))
+
+    #----------------------------------------------------------------
+    def decode(self, data):
+        """
+            Decode a stored message into the raw message.  Raises
+            CorruptCacheEntry if the stored message is damaged.
+        """
+
+        codec, dict_id, start, end = check_frame(data)
+        payload = data[start:end]
+
+        dictionary = None
+        if dict_id:
+            dictionary = self.load_dictionary(dict_id)
+
+        if codec == CODEC_NONE:
+            return payload
+
+        elif codec == CODEC_ZLIB:
+            if dictionary is not None:
+                decompressor = zlib.decompressobj(zdict = dictionary)
+            else:
+                decompressor = zlib.decompressobj()
+            return decompressor.decompress(payload) + decompressor.flush()
+
+        elif codec == CODEC_ZSTD:
+            if zstandard is None:
+                raise MailCacheException("The zstandard module is required to read zstd cache files.")
+
+            if dictionary is not None:
+                decompressor = zstandard.ZstdDecompressor(
+                        dict_data = zstandard.ZstdCompressionDict(dictionary))
+            else:
+                decompressor = zstandard.ZstdDecompressor()
+            return decompressor.decompress(payload)
+
+        raise MailCacheException("Unknown cache codec: %d" % codec)
+
+    #----------------------------------------------------------------
+    def collect(self, max_bytes = None, max_age = None, policy = 'lru'):
+        """
+            Evict messages from the cache.
+
+            max_bytes:
+                If specified, messages are evicted in the order given by
+                the policy until the cache is below GC_LOW_WATERMARK of
+                this many bytes.
+            max_age:
+                If specified, messages not accessed for this many seconds
+                are evicted.
+            policy:
+                'lru' to evict the least recently used messages first,
+                or 'lfu' to evict the least frequently used.
+
+            Returns a tuple of (messages evicted, bytes evicted, bytes
+            remaining).
+        """
+
+        if policy not in EVICTION_ORDER:
+            raise MailCacheException("Unknown cache eviction policy: %s" % policy)
+
+        db = self.get_index()
+        self.flush_accesses()
+        self.sync_index()
+
+        evicted = []
+
+        if max_age is not None:
+            evicted.extend(db.execute(
+                "SELECT key, size FROM entries WHERE accessed < ?",
+                (time.time() - max_age,)).fetchall())
+
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        total -= sum(size for key, size in evicted)
+
+        if max_bytes is not None and total > max_bytes:
+            target = max_bytes * GC_LOW_WATERMARK
+            expired = set(key for key, size in evicted)
+
+            for key, size in db.execute(
+                    "SELECT key, size FROM entries ORDER BY %s" % EVICTION_ORDER[policy]):
+                if total <= target:
+                    break
+                if key in expired:
+                    continue
+                evicted.append((key, size))
+                total -= size
+
+        for key, size in evicted:
+            try:
+                os.unlink(self.filename(key))
+            except FileNotFoundError:
+                pass
+
+        db.executemany("DELETE FROM entries WHERE key = ?", ((key,) for key, size in evicted))
+        db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('last_gc', ?)", (str(time.time()),))
+        db.commit()
+
+        return len(evicted), sum(size for key, size in evicted), total
+
+    #----------------------------------------------------------------
+    def verify(self):
+        """
+            Check the CRC-32 of every message in the cache, removing
+            those which are damaged.  Returns the number removed.
+        """
+
+        removed = 0
+
+        for key in self.keys():
+            data = self.read(key)
+            if data is None:
+                continue
+
+            try:
+                check_frame(data)
+            except CorruptCacheEntry:
+                self.remove(key)
+                removed += 1
+
+        return removed
+
+    #----------------------------------------------------------------
+    def sync_index(self):
+        """
+            Bring the index up to date with the files in the cache
+            directory, adding files written before the index existed
+            and dropping entries whose files have been removed.
+        """
+
+        db = self.get_index()
+        indexed = set(key for key, in db.execute("SELECT key FROM entries"))
+        found = set()
+        rows = []
+
+        self.remove_stale_temp_files()
+
+        for key in self.keys():
+            found.add(key)
+            if key not in indexed:
+                try:
+                    st = os.stat(self.filename(key))
+                except FileNotFoundError:
+                    continue
+                rows.append((key, st.st_size, max(st.st_atime, st.st_mtime)))
+
+        db.executemany("INSERT OR IGNORE INTO entries (key, size, accessed) VALUES (?, ?, ?)", rows)
+        db.executemany("DELETE FROM entries WHERE key = ?", ((key,) for key in indexed - found))
+        db.commit()
+
+    #----------------------------------------------------------------
+    def remove_stale_temp_files(self):
+        """
+            Remove temporary files left behind by interrupted writes.
+        """
+
+        now = time.time()
+
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.startswith('.') and name.endswith(TEMP_EXTENSION):
+                    filename = os.path.join(dirpath, name)
+                    try:
+                        if now - os.stat(filename).st_mtime > STALE_TEMP_AGE:
+                            os.unlink(filename)
+                    except FileNotFoundError:
+                        pass
+
+    #----------------------------------------------------------------
+    def start_janitor(self, max_bytes = None, max_age = None,
+                      policy = 'lru', interval = 3600):
+        """
+            Collect the cache in a background thread, if it has not been
+            collected within the last interval seconds and limits are
+            configured.  The thread uses its own connection to the index,
+            and is waited for by close().
+        """
+
+        if self.janitor is not None or (max_bytes is None and max_age is None):
+            return
+
+        row = self.get_index().execute("SELECT value FROM meta WHERE name = 'last_gc'").fetchone()
+        if row is not None and time.time() - float(row[0]) < interval:
+            return
+
+        def collect():
+            cache = MailCache(self.directory)
+            try:
+                cache.collect(max_bytes, max_age, policy)
+            finally:
+                cache.close()
+
+        self.janitor = threading.Thread(target = collect, name = 'webmail-cache-janitor')
+        self.janitor.start()
+
+    #----------------------------------------------------------------
+    def dictionary_filename(self, dict_id):
+        return os.path.join(self.directory, DICTIONARY_DIR, "%08x.dict" % dict_id)
+
+    #----------------------------------------------------------------
+    def load_dictionary(self, dict_id):
+        if dict_id not in self.dictionaries:
+            try:
+                with open(self.dictionary_filename(dict_id), 'rb') as in_file:
+                    self.dictionaries[dict_id] = in_file.read()
+            except FileNotFoundError:
+                raise MailCacheException("Cache dictionary %08x is missing." % dict_id)
+
+        return self.dictionaries[dict_id]
+
+    #----------------------------------------------------------------
+    def current_dictionary(self):
+        """
+            Get the id and content of the dictionary used to compress
+            new messages for the current codec, or (0, None) if no
+            dictionary has been trained.
+        """
+
+        filename = os.path.join(self.directory, DICTIONARY_DIR, "current.%d" % self.codec)
+
+        try:
+            with open(filename, 'r') as in_file:
+                dict_id = int(in_file.read().strip(), 16)
+        except FileNotFoundError:
+            return 0, None
+
+        return dict_id, self.load_dictionary(dict_id)
+
+    #----------------------------------------------------------------
+    def train_dictionary(self, max_samples = 5000):
+        """
+            Train a compression dictionary for the current codec on the
+            headers of the messages already in the cache, and use it
+            for messages saved from now on.  Messages compressed with
+            previous dictionaries remain readable.
+
+            Returns the id of the new dictionary.
+        """
+
+        if self.codec == CODEC_NONE:
+            raise MailCacheException("Cache compression is not enabled.")
+
+        samples = []
+        for key in self.keys():
+            data = self.read(key)
+            try:
+                if data is not None:
+                    samples.append(split_header(self.decode(data)))
+            except CorruptCacheEntry:
+                continue
+            if len(samples) >= max_samples:
+                break
+
+        if not samples:
+            raise MailCacheException("There are no cached messages to train a dictionary on.")
+
+        if self.codec == CODEC_ZLIB:
+            dictionary = build_zlib_dictionary(samples)
+        else:
+            dictionary = zstandard.train_dictionary(ZSTD_DICTIONARY_SIZE, samples).as_bytes()
+
+        dict_id = zlib.crc32(dictionary) or 1
+
+        dictionary_dir = os.path.join(self.directory, DICTIONARY_DIR)
+        if not os.path.isdir(dictionary_dir):
+            os.makedirs(dictionary_dir)
+
+        with open(self.dictionary_filename(dict_id), 'wb') as out_file:
+            out_file.write(dictionary)
+
+        with open(os.path.join(dictionary_dir, "current.%d" % self.codec), 'w') as out_file:
+            out_file.write("%08x\n" % dict_id)
+
+        self.dictionaries[dict_id] = dictionary
+        return dict_id
+
+    #----------------------------------------------------------------
+    def stats(self):
+        """
+            Measure the cache, decoding every message.  Returns a
+            dictionary with the number of messages, the bytes stored
+            and decoded, the count of messages per codec, the count of
+            damaged messages, and the time spent decoding.
+        """
+
+        stats = {
+            'messages':         0,
+            'stored_bytes':     0,
+            'raw_bytes':        0,
+            'decode_seconds':   0.0,
+            'corrupt':          0,
+            'codecs':           collections.Counter()
+        }
+
+        names = {code: name for name, code in CODECS.items() if name is not None}
+
+        for key in self.keys():
+            data = self.read(key)
+            if data is None:
+                continue
+
+            start = time.perf_counter()
+            try:
+                codec = check_frame(data)[0]
+                raw = self.decode(data)
+            except CorruptCacheEntry:
+                stats ['corrupt'] += 1
+                continue
+            stats ['decode_seconds'] += time.perf_counter() - start
+
+            stats ['messages'] += 1
+            stats ['stored_bytes'] += len(data)
+            stats ['raw_bytes'] += len(raw)
+            stats ['codecs'][names.get(codec, str(codec))] += 1
+
+        return stats
+
+#-------------------------------------------------------------------
+def build_zlib_dictionary(samples, size = ZLIB_DICTIONARY_SIZE):
+    """
+        Build a zlib preset dictionary from sample message headers.
+
+        Header lines which recur across messages are collected, most
+        common last, as zlib finds matches closest to the end of the
+        dictionary most cheaply.
+    """
+
+    counts = collections.Counter()
+
+    for sample in samples:
+        seen = set()
+        for line in sample.splitlines(True):
+            if line.strip() and line not in seen:
+                seen.add(line)
+                counts[line] += 1
+
+            name = line.split(b':', 1)[0] + b': '
+            if b':' in line and name not in seen:
+                seen.add(name)
+                counts[name] += 1
+
+    common = [line for line, count in counts.most_common() if count > 1]
+
+    dictionary = []
+    length = 0
+    for line in common:
+        if length + len(line) > size:
+            break
+        dictionary.append(line)
+        length += len(line)
+
+    dictionary.reverse()
+    return b''.join(dictionary)
@@ -0,0 +1,138 @@
+#-------------------------------------------------------------------
+# webmail.capabilities
+#
+# The capabilities advertised by an IMAP server, which decide the
+# strategy used for each operation, and an on-disk cache of them
+# so that they need not be asked for on every connection.
+#-------------------------------------------------------------------
+
+import json
+import os
+import tempfile
+import time
+
+#-------------------------------------------------------------------
+# How long the capabilities of a server are cached, in seconds.
+CAPABILITY_TTL = 86400
+
+#-------------------------------------------------------------------
+class Capabilities():
+    """
+        The set of capabilities advertised by a server, less any
+        which have been disabled, e.g. to force the client to use
+        the fallback for an extension when benchmarking.
+
+        names:
+            The capability names, e.g. ['IMAP4rev1', 'MOVE'].
+        disabled:
+            Names to treat as unsupported.  A name without a value
+            disables every value, e.g. 'THREAD' disables both
+            'THREAD=REFERENCES' and 'THREAD=ORDEREDSUBJECT'.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, names = (), disabled = ()):
+        self.names = [name.upper() for name in names]
+        self.disabled = set(name.upper() for name in disabled)
+
+    #----------------------------------------------------------------
+    def __contains__(self, name):
+        return self.has(name)
+
+    #----------------------------------------------------------------
+    def __iter__(self):
+        return (name for name in self.names if self.has(name))
+
+    #----------------------------------------------------------------
+    def has(self, name):
+        """
+            Determine if the server advertised the given capability
+            and it has not been disabled.
+        """
+
+        name = name.upper()
+        if name not in self.names:
+            return False
+
+        return name not in self.disabled and name.split('=', 1)[0] not in self.disabled
+
+    #----------------------------------------------------------------
+    def values(self, name):
+        """
+            Get the values advertised for a capability which takes
+            one, e.g. values('THREAD') gives ['REFERENCES'] for a
+            server advertising 'THREAD=REFERENCES'.
+        """
+
+        prefix = name.upper() + '='
+        return [capability [len(prefix):] for capability in self
+                if capability.startswith(prefix)]
+
+#-------------------------------------------------------------------
+class CapabilityCache():
+    """
+        Capabilities of each server, cached in a JSON file for up to
+        ttl seconds.  Both the capabilities before login and those
+        after, which are often different, are kept.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, filename, ttl = CAPABILITY_TTL):
+        self.filename = filename
+        self.ttl = ttl
+
+    #----------------------------------------------------------------
+    def load(self):
+        try:
+            with open(self.filename, 'r') as infile:
+                return json.load(infile)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    #----------------------------------------------------------------
+    def get(self, server):
+        """
+            Get the cached capabilities of the given server, e.g.
+            'imap.gmail.com:993', as a dictionary with 'greeting' and
+            'authenticated' lists.  Returns None if the server is not
+            cached or its entry has expired.
+        """
+
+        entry = self.load().get(server)
+
+        if entry is None or time.time() - entry.get('time', 0) > self.ttl:
+            return None
+
+        return entry
+
+    #----------------------------------------------------------------
+    def put(self, server, greeting, authenticated):
+        """
+            Cache the capabilities of the given server, before and
+            after login.
+        """
+
+        entries = self.load()
+        entries [server] = {
+            'time':             time.time(),
+            'greeting':         list(greeting),
+            'authenticated':    list(authenticated)
+        }
+
+        dirname = os.path.dirname(self.filename)
+        os.makedirs(dirname, exist_ok = True)
+
+        # Write to a temporary file and rename it into place, so that
+        # concurrent readers never see a partially written file.
+        fd, temp_filename = tempfile.mkstemp(prefix = '.capabilities.', dir = dirname)
+        try:
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(entries, outfile)
+            os.replace(temp_filename, self.filename)
+
+        except BaseException:
+            try:
+                os.unlink(temp_filename)
+            except FileNotFoundError:
+                pass
+            raise
@@ -9,12 +9,322 @@
 #
 #-------------------------------------------------------------------
 
+import datetime
+import email.parser
 import imaplib
 import pyzmail
+import random
+import re
+import time
+
+from . import timing, transport
+from .capabilities import Capabilities
 
 #-------------------------------------------------------------------
 IMAP_DATE_FORMAT = "%d-%b-%Y"
 
+# The maximum length of a UID sequence set sent in a single command.
+# Longer sets are split across several commands so that we stay well
+# below the command line limits imposed by most servers.
+MAX_SEQUENCE_SET_LENGTH = 4096
+
+# The header fields fetched to summarize a message without
+# downloading its body.
+SUMMARY_HEADER_FIELDS = ['DATE', 'FROM', 'TO', 'CC', 'SUBJECT',
+                         'MESSAGE-ID', 'IN-REPLY-TO', 'REFERENCES']
+
+# The number of message bodies requested in a single FETCH when
+# downloading many messages, bounding the memory held by imaplib.
+FETCH_BATCH_SIZE = 100
+
+# The capability of servers with Gmail's IMAP extensions.
+GMAIL_CAPABILITY = 'X-GM-EXT-1'
+
+# The most messages and bytes uploaded in a single MULTIAPPEND.  The
+# server stores all or none of the messages in a command.
+APPEND_BATCH_SIZE = 100
+APPEND_BATCH_BYTES = 32 * 1024 * 1024
+
+# The size of the chunks in which messages are read from files and
+# written to the connection when uploaded.
+APPEND_CHUNK_SIZE = 1024 * 1024
+
+# Servers may drop IDLE connections after 30 minutes of
+# inactivity, so IDLE is restarted before this interval elapses.
+IDLE_TIMEOUT = 29 * 60
+
+# The number of times an idempotent command is retried after the
+# connection is lost, and the initial and maximum delays in seconds
+# between attempts, which double with each attempt.
+RETRY_ATTEMPTS = 5
+RETRY_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+
+# Errors after which the connection is assumed lost and may be
+# reconnected.  imaplib raises IMAP4.abort for a closed connection.
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, OSError, EOFError)
+
+_HEADER_PARSER = email.parser.BytesHeaderParser()
+
+# A line feed not preceded by a carriage return.
+_BARE_LF_RE = re.compile(rb'(?<!\r)\n')
+
+# Tokens in IMAP response data.
+_FETCH_TOKEN_RE = re.compile(rb'''
+      (?P<space>\s+)
+    | (?P<open>\()
+    | (?P<close>\))
+    | "(?P<quoted>(?:[^"\\]|\\.)*)"
+    | \{(?P<literal>\d+)\}$
+    | (?P<atom>(?:[^\s()"\[]|\[[^\]]*\])+)
+''', re.VERBOSE)
+
+#-------------------------------------------------------------------
+def uid_sequence_set(uids):
+    """
+        Compress the given UIDs into an IMAP sequence set, collapsing
+        runs of consecutive UIDs into ranges, e.g. "1:4,7,9:12".
+    """
+
+    return ','.join(_uid_ranges(uids))
+
+#-------------------------------------------------------------------
+def chunk_sequence_sets(uids, max_length = MAX_SEQUENCE_SET_LENGTH):
+    """
+        Split the given UIDs into a series of compressed IMAP sequence
+        sets, each no longer than max_length characters.  Yields
+        (sequence_set, uids) tuples, where uids is the list of UIDs
+        covered by the sequence set.
+    """
+
+    ranges = []
+    covered = []
+    length = 0
+
+    for first, last in _uid_runs(uids):
+        item = str(first) if first == last else "%d:%d" % (first, last)
+
+        if ranges and length + len(item) + 1 > max_length:
+            yield ','.join(ranges), covered
+            ranges = []
+            covered = []
+            length = 0
+
+        ranges.append(item)
+        covered.extend(range(first, last + 1))
+        length += len(item) + 1
+
+    if ranges:
+        yield ','.join(ranges), covered
+
+#-------------------------------------------------------------------
+def _uid_runs(uids):
+    uids = sorted(set(int(uid) for uid in uids))
+    if not uids:
+        return
+
+    first = last = uids[0]
+    for uid in uids[1:]:
+        if uid == last + 1:
+            last = uid
+        else:
+            yield first, last
+            first = last = uid
+
+    yield first, last
+
+#-------------------------------------------------------------------
+def parse_fetch_response(response):
+    """
+        Parse the data returned by imaplib for a FETCH command.
+
+        Returns a list of (seq, attrs) tuples, where attrs maps
+        upper-case data item names to values.  Atoms and strings are
+        returned as bytes, parenthesized lists as lists, and NIL as None.
+    """
+
+    tokens = []
+    for item in response:
+        if item is None:
+            continue
+        elif isinstance(item, tuple):
+            tokens.extend(_tokenize(item[0]))
+            tokens.append(item[1])
+        else:
+            tokens.extend(_tokenize(item))
+
+    results = []
+    pos = 0
+
+    while pos < len(tokens):
+        seq = tokens[pos]
+        if seq is _OPEN or seq is _CLOSE or not seq.isdigit():
+            pos += 1
+            continue
+
+        pos += 1
+        if pos < len(tokens) and tokens[pos] == b'FETCH':
+            pos += 1
+
+        if pos >= len(tokens) or tokens[pos] is not _OPEN:
+            continue
+
+        values, pos = _parse_list(tokens, pos + 1)
+
+        attrs = {}
+        for n in range(0, len(values) - 1, 2):
+            attrs [values[n].decode().upper()] = values[n + 1]
+
+        results.append((int(seq), attrs))
+
+    return results
+
+#-------------------------------------------------------------------
+def parse_internaldate(value):
+    """
+        Parse an INTERNALDATE value, e.g. b'17-Jul-1996 02:44:25 -0700',
+        into an aware datetime.  Returns None if it cannot be parsed.
+    """
+
+    if value is None:
+        return None
+
+    try:
+        return datetime.datetime.strptime(value.decode().strip(), '%d-%b-%Y %H:%M:%S %z')
+    except ValueError:
+        return None
+
+#-------------------------------------------------------------------
+def parse_message_id(header):
+    """
+        Get the Message-ID from the given raw header bytes, with
+        surrounding whitespace removed, or '' if there is none.
+    """
+
+    message = _HEADER_PARSER.parsebytes(header)
+    return ' '.join(str(message.get('Message-ID', '')).split())
+
+#-------------------------------------------------------------------
+_OPEN = object()
+_CLOSE = object()
+
+#-------------------------------------------------------------------
+def _tokenize(data):
+    tokens = []
+
+    for m in _FETCH_TOKEN_RE.finditer(data):
+        if m.group('open') is not None:
+            tokens.append(_OPEN)
+        elif m.group('close') is not None:
+            tokens.append(_CLOSE)
+        elif m.group('quoted') is not None:
+            tokens.append(re.sub(rb'\\(.)', rb'\1', m.group('quoted')))
+        elif m.group('atom') is not None:
+            atom = m.group('atom')
+            tokens.append(None if atom.upper() == b'NIL' else atom)
+
+    return tokens
+
+#-------------------------------------------------------------------
+def _parse_list(tokens, pos):
+    values = []
+
+    while pos < len(tokens):
+        token = tokens[pos]
+        pos += 1
+
+        if token is _CLOSE:
+            break
+        elif token is _OPEN:
+            value, pos = _parse_list(tokens, pos)
+            values.append(value)
+        else:
+            values.append(token)
+
+    return values, pos
+
+#-------------------------------------------------------------------
+def _thread_node(items):
+    # In "(3 6 (4 23)(44 7 96))", 6 is the only reply to 3 and the
+    # threads in parentheses are replies to 6.
+    uids = [int(item) for item in items if not isinstance(item, list)]
+    children = [_thread_node(item) for item in items if isinstance(item, list)]
+
+    if not uids:
+        return (None, children)
+
+    node = (uids[-1], children)
+    for uid in reversed(uids[:-1]):
+        node = (uid, [node])
+
+    return node
+
+#-------------------------------------------------------------------
+def _parse_sequence_set(s):
+    uids = []
+
+    for item in s.split(','):
+        if ':' in item:
+            first, last = item.split(':')
+            uids.extend(range(int(first), int(last) + 1))
+        else:
+            uids.append(int(item))
+
+    return uids
+
+#-------------------------------------------------------------------
+def _crlf_chunks(f, chunk_size = APPEND_CHUNK_SIZE):
+    """
+        Read a binary file in chunks, converting bare line feeds to
+        CRLF as required for messages uploaded to the server.
+    """
+
+    last = b''
+
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+
+        if last == b'\r' and chunk [:1] == b'\n':
+            yield b'\n' + _BARE_LF_RE.sub(b'\r\n', chunk [1:])
+        else:
+            yield _BARE_LF_RE.sub(b'\r\n', chunk)
+
+        last = chunk [-1:]
+
+#-------------------------------------------------------------------
+def message_literal(message, chunk_size = APPEND_CHUNK_SIZE):
+    """
+        Prepare a message for upload.  The message is either the raw
+        bytes of the message, or the name of a file holding it, which
+        is then read in chunks rather than all at once.
+
+        Returns a tuple of (size, chunks), where chunks is a function
+        returning an iterator over the message with CRLF line endings.
+    """
+
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        data = _BARE_LF_RE.sub(b'\r\n', bytes(message))
+        return len(data), lambda: iter([data])
+
+    def chunks():
+        with open(message, 'rb') as f:
+            for chunk in _crlf_chunks(f, chunk_size):
+                yield chunk
+
+    # The size of the literal must be sent first, so the file is read
+    # twice rather than held in memory.
+    return sum(len(chunk) for chunk in chunks()), chunks
+
+#-------------------------------------------------------------------
+def _uid_ranges(uids):
+    for first, last in _uid_runs(uids):
+        if first == last:
+            yield str(first)
+        else:
+            yield "%d:%d" % (first, last)
+
 #-------------------------------------------------------------------
 class MailClientException(Exception):
     def __init__(self, message):
@@ -25,22 +335,187 @@ class MailClient():
     """
         An object for accessing and manipulating messages in an
         IMAP email inbox.
+
+        capability_cache:
+            An optional CapabilityCache, so that the capabilities of
+            a server need not be asked for on every connection.
+        disabled_capabilities:
+            Capabilities to treat as unsupported, forcing the fallback
+            for each, e.g. ['MOVE', 'LITERAL+'].
     """
 
     #----------------------------------------------------------------
-    def __init__(self):
+    def __init__(self, retries = RETRY_ATTEMPTS, retry_delay = RETRY_DELAY,
+                 retry_max_delay = RETRY_MAX_DELAY, capability_cache = None,
+                 disabled_capabilities = ()):
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.capability_cache = capability_cache
+        self.disabled_capabilities = list(disabled_capabilities)
+        self.capabilities = None
+        self.gmail_ids = {}
+        self.login_args = None
+        self.lost = False
+        self.reconnects = 0
         self.imap = None
         self.mailbox = None
+        self.readonly = None
+        self.uidvalidity = None
+        self.uidnext = None
+        self.exists = None
+        self.highestmodseq = None
 
     #----------------------------------------------------------------
     def connect(self, username, password,
                 hostname = "imap.gmail.com",
-                port = 993, ssl = True):
-        if ssl:
-            self.imap = imaplib.IMAP4_SSL(hostname, port)
+                port = 993, ssl = True, compress = True):
+        """
+            Connect and log in to the IMAP server.  If compress is set
+            and the server supports COMPRESS=DEFLATE, compression is
+            enabled once logged in.
+        """
+
+        self.login_args = (username, password, hostname, port, ssl, compress)
+        self.capabilities = None
+
+        server = '%s:%d' % (hostname, port)
+        cached = None
+        if self.capability_cache is not None:
+            cached = self.capability_cache.get(server)
+
+        known = cached ['greeting'] if cached is not None else None
+
+        with timing.phase('connect'):
+            if ssl:
+                self.imap = transport.IMAP4_SSL(hostname, port, capabilities = known)
+            else:
+                self.imap = transport.IMAP4(hostname, port, capabilities = known)
+
+        with timing.phase('login'):
+            greeting = self.imap.capabilities
             self.imap.login(username, password)
+            self.negotiate(server, greeting, cached)
+
+            if compress and self.has_capability('COMPRESS=DEFLATE'):
+                self.imap.compress()
+
+    #----------------------------------------------------------------
+    def negotiate(self, server, greeting, cached):
+        """
+            Determine the capabilities of the server after login, which
+            are often more than those in the greeting.  They are taken
+            from the LOGIN response if the server lists them there, or
+            else from the capability cache, and are only asked for with
+            CAPABILITY if neither has them.
+        """
+
+        code, data = self.imap.response('CAPABILITY')
+
+        if data and data [-1]:
+            names = data [-1].decode('ascii', 'replace').upper().split()
+        elif cached is not None:
+            names = cached ['authenticated']
         else:
-            raise NotImplementedError("Non-SSL IMAP connection not yet implemented.")
+            status, data = self.imap.capability()
+            names = data [-1].decode('ascii', 'replace').upper().split()
+
+        if self.capability_cache is not None and (cached is None or
+                cached ['greeting'] != list(greeting) or cached ['authenticated'] != names):
+            self.capability_cache.put(server, greeting, names)
+
+        self.imap.capabilities = tuple(names)
+        self.capabilities = Capabilities(names, self.disabled_capabilities)
+
+    #----------------------------------------------------------------
+    def reconnect(self):
+        """
+            Replace a lost connection with a new one, logging in again
+            and selecting the mailbox that was selected before.
+
+            Raises MailClientException if the UIDVALIDITY of the
+            mailbox has changed, as UIDs from the lost connection
+            no longer refer to the same messages.
+        """
+
+        if self.login_args is None:
+            raise MailClientException("Cannot reconnect, never connected.")
+
+        mailbox, readonly, uidvalidity = self.mailbox, self.readonly, self.uidvalidity
+
+        if self.imap is not None:
+            try:
+                self.imap.shutdown()
+            except Exception:
+                pass
+
+        self.mailbox = None
+        self.readonly = None
+        self.connect(*self.login_args)
+        self.reconnects += 1
+
+        if mailbox is not None:
+            self._select(mailbox, readonly)
+
+            if uidvalidity and self.uidvalidity != uidvalidity:
+                raise MailClientException("UIDVALIDITY of %s changed while reconnecting." % mailbox)
+
+        self.lost = False
+
+    #----------------------------------------------------------------
+    def retry(self, operation):
+        """
+            Run an idempotent operation, such as a SEARCH or a FETCH by
+            UID, returning its result.  If the connection is lost, it is
+            reconnected and the operation is run again, up to 'retries'
+            times, waiting between attempts with exponential backoff.
+        """
+
+        attempt = 0
+
+        while True:
+            try:
+                if self.lost:
+                    self.reconnect()
+                return operation()
+
+            except imaplib.IMAP4.readonly:
+                raise
+
+            except CONNECTION_ERRORS:
+                self.lost = True
+                if self.login_args is None or attempt >= self.retries:
+                    raise
+
+                delay = min(self.retry_max_delay, self.retry_delay * 2 ** attempt)
+                attempt += 1
+
+                # Jitter keeps many clients from reconnecting in step.
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+    #----------------------------------------------------------------
+    def call(self, name, *args):
+        """
+            Call the imaplib method with the given name, reconnecting
+            and retrying as for retry().  Only for idempotent commands.
+        """
+
+        return self.retry(lambda: getattr(self.imap, name)(*args))
+
+    #----------------------------------------------------------------
+    def transfer_stats(self):
+        """
+            Get the number of bytes sent and received over the
+            connection, both on the wire and after decompression.
+        """
+
+        return {
+            'compressed':           self.imap.is_compressed(),
+            'bytes_sent':           self.imap.bytes_sent,
+            'bytes_received':       self.imap.bytes_received,
+            'wire_bytes_sent':      self.imap.wire_bytes_sent,
+            'wire_bytes_received':  self.imap.wire_bytes_received
+        }
 
     #----------------------------------------------------------------
     def fetch_message_body(self, id):
@@ -48,7 +523,8 @@ class MailClient():
             Fetch the raw RFC822 body for the given message UID.
         """
 
-        status, response = self.imap.uid('fetch', id, '(RFC822)')
+        with timing.phase('fetch'):
+            status, response = self.call('uid', 'fetch', id, '(RFC822)')
         if response[0] is None:
             return None
 
@@ -60,7 +536,8 @@ class MailClient():
             Fetch the size of the given message in bytes.
         """
 
-        status, response = self.imap.uid('fetch', id, '(RFC822.SIZE)')
+        with timing.phase('fetch'):
+            status, response = self.call('uid', 'fetch', id, '(RFC822.SIZE)')
         if response[0] is None:
             return None
 
@@ -72,12 +549,14 @@ class MailClient():
             Fetch the size of the given message in bytes.
         """
 
-        status, response = self.imap.uid('fetch', id, '(RFC822.HEADER)')
+        with timing.phase('fetch'):
+            status, response = self.call('uid', 'fetch', id, '(RFC822.HEADER)')
 
         if response[0] is None:
             return None
 
-        return pyzmail.PyzMessage.factory(response[0][1])
+        with timing.phase('parse'):
+            return pyzmail.PyzMessage.factory(response[0][1])
 
     #----------------------------------------------------------------
     def fetch_message(self, id):
@@ -91,7 +570,202 @@ class MailClient():
         if body is None:
             return None
 
-        return pyzmail.PyzMessage.factory(self.fetch_message_body(id))
+        with timing.phase('parse'):
+            return pyzmail.PyzMessage.factory(body)
+
+    #----------------------------------------------------------------
+    def fetch_attributes(self, uids, items, batch_size = None,
+                         max_length = MAX_SEQUENCE_SET_LENGTH):
+        """
+            Fetch the given data items for many messages by UID.
+
+            uids:
+                A list of message UIDs.
+            items:
+                The data items to fetch, e.g. '(FLAGS INTERNALDATE)'.
+                UID is always fetched.
+            batch_size:
+                If specified, at most this many messages are fetched
+                in a single command.
+
+            Yields a (uid, attrs) tuple for each message found, in
+            ascending UID order, where attrs is as returned by
+            parse_fetch_response().
+        """
+
+        uids = sorted(set(int(uid) for uid in uids))
+        items = '(UID %s)' % items.strip('()')
+
+        if batch_size is None:
+            batch_size = max(len(uids), 1)
+
+        for n in range(0, len(uids), batch_size):
+            for sequence_set, chunk in chunk_sequence_sets(uids[n:n + batch_size], max_length):
+                with timing.phase('fetch'):
+                    status, response = self.call('uid', 'fetch', sequence_set, items)
+                if status != 'OK':
+                    raise MailClientException("Could not fetch messages: %s" % response)
+
+                with timing.phase('parse'):
+                    results = [(int(attrs ['UID']), attrs)
+                            for seq, attrs in parse_fetch_response(response)
+                            if 'UID' in attrs]
+                    results.sort(key = lambda result: result[0])
+
+                for uid, attrs in results:
+                    self.track_gmail_id(uid, attrs)
+
+                for result in results:
+                    yield result
+
+    #----------------------------------------------------------------
+    def fetch_message_bodies(self, uids, batch_size = FETCH_BATCH_SIZE,
+                             max_length = MAX_SEQUENCE_SET_LENGTH):
+        """
+            Download the raw RFC822 bodies of many messages, fetching
+            batch_size messages per command.  The \\Seen flag is not set.
+
+            Yields a (uid, body) tuple for each message found, in
+            ascending UID order.
+        """
+
+        for uid, attrs in self.fetch_attributes(uids, 'BODY.PEEK[]',
+                batch_size, max_length):
+            body = attrs.get('BODY[]')
+            if isinstance(body, bytes):
+                yield uid, body
+
+    #----------------------------------------------------------------
+    def fetch_summaries(self, ids, by_uid = True,
+                        max_length = MAX_SEQUENCE_SET_LENGTH):
+        """
+            Fetch the flags, size and summary headers of many messages,
+            using one FETCH command per chunk of the sequence set.
+
+            ids:
+                A list of message UIDs, or sequence numbers if
+                by_uid is False.
+
+            Yields a dictionary for each message found with the keys
+            'seq', 'uid', 'flags', 'size' and 'header', where header
+            is the raw bytes of the SUMMARY_HEADER_FIELDS.
+
+            On Gmail, the keys 'gm_msgid', 'gm_thrid' and 'gm_labels'
+            hold the X-GM-MSGID, X-GM-THRID and X-GM-LABELS of each
+            message.  Otherwise they are None.
+        """
+
+        items = '(UID FLAGS RFC822.SIZE %sBODY.PEEK[HEADER.FIELDS (%s)])' % (
+                'X-GM-MSGID X-GM-THRID X-GM-LABELS ' if self.has_capability(GMAIL_CAPABILITY) else '',
+                ' '.join(SUMMARY_HEADER_FIELDS))
+
+        for sequence_set, chunk in chunk_sequence_sets(ids, max_length):
+            with timing.phase('fetch'):
+                if by_uid:
+                    status, response = self.call('uid', 'fetch', sequence_set, items)
+                else:
+                    # Sequence numbers may change if the connection is
+                    # lost, so the fetch cannot simply be repeated.
+                    status, response = self.imap.fetch(sequence_set, items)
+
+            if status != 'OK':
+                raise MailClientException("Could not fetch messages: %s" % response)
+
+            with timing.phase('parse'):
+                parsed = parse_fetch_response(response)
+
+            for seq, attrs in parsed:
+                if 'UID' not in attrs:
+                    continue
+
+                header = b''
+                for key, value in attrs.items():
+                    if key.startswith('BODY[') and isinstance(value, bytes):
+                        header = value
+
+                uid = int(attrs ['UID'])
+                self.track_gmail_id(uid, attrs)
+
+                labels = attrs.get('X-GM-LABELS')
+                if labels is not None:
+                    labels = [label.decode('utf-8', 'replace') for label in labels if label]
+
+                yield {
+                    'seq':          seq,
+                    'uid':          uid,
+                    'flags':        [flag.decode() for flag in attrs.get('FLAGS', [])],
+                    'size':         int(attrs.get('RFC822.SIZE', 0)),
+                    'header':       header,
+                    'gm_msgid':     self.gmail_ids.get(uid),
+                    'gm_thrid':     int(attrs ['X-GM-THRID']) if 'X-GM-THRID' in attrs else None,
+                    'gm_labels':    labels
+                }
+
+    #----------------------------------------------------------------
+    def track_gmail_id(self, uid, attrs):
+        if 'X-GM-MSGID' in attrs:
+            self.gmail_ids [uid] = int(attrs ['X-GM-MSGID'])
+
+    #----------------------------------------------------------------
+    def fetch_gmail_ids(self, uids, max_length = MAX_SEQUENCE_SET_LENGTH):
+        """
+            Get the X-GM-MSGID of the given messages, which on Gmail
+            identifies a message in every mailbox (label) it is in.
+            Only the ids not already seen by an earlier fetch from the
+            selected mailbox are fetched.
+
+            Returns a dictionary mapping integer UIDs to ids, which is
+            empty if the server is not Gmail.
+        """
+
+        if not self.has_capability(GMAIL_CAPABILITY):
+            return {}
+
+        uids = [int(uid) for uid in uids]
+        missing = [uid for uid in uids if uid not in self.gmail_ids]
+
+        if missing:
+            for uid, attrs in self.fetch_attributes(missing, 'X-GM-MSGID',
+                    max_length = max_length):
+                pass
+
+        return dict((uid, self.gmail_ids [uid]) for uid in uids if uid in self.gmail_ids)
+
+    #----------------------------------------------------------------
+    def fetch_message_ids(self):
+        """
+            Fetch the UID, size and Message-ID of every message in the
+            current mailbox in a single FETCH command.
+
+            Returns a list of (uid, size, message_id) tuples, where
+            message_id is '' for messages without a Message-ID.
+        """
+
+        with timing.phase('fetch'):
+            status, response = self.call('uid', 'fetch', '1:*',
+                    '(UID RFC822.SIZE %sBODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])' % (
+                        'X-GM-MSGID ' if self.has_capability(GMAIL_CAPABILITY) else ''))
+
+        if status != 'OK':
+            raise MailClientException("Could not fetch messages: %s" % response)
+
+        results = []
+
+        for seq, attrs in parse_fetch_response(response):
+            if 'UID' not in attrs:
+                continue
+
+            header = b''
+            for key, value in attrs.items():
+                if key.startswith('BODY[') and isinstance(value, bytes):
+                    header = value
+
+            self.track_gmail_id(int(attrs ['UID']), attrs)
+            results.append((int(attrs ['UID']),
+                            int(attrs.get('RFC822.SIZE', 0)),
+                            parse_message_id(header)))
+
+        return results
 
     #----------------------------------------------------------------
     def fetch_unread_ids(self):
@@ -99,7 +773,7 @@ class MailClient():
             Fetch a string list of the UIDs of all messages in the
             current mailbox marked as unread.
         """
-        status, id_pairs = self.imap.uid('search', '(UNSEEN)')
+        status, id_pairs = self.call('uid', 'search', '(UNSEEN)')
         ids = []
 
         for id_pair in id_pairs:
@@ -115,7 +789,15 @@ class MailClient():
             for messages matching the given criterion.
         """
 
-        status, id_pairs = self.imap.uid('search', str(q))
+        if self.has_capability('ESEARCH'):
+            # The results are returned as a compressed sequence set,
+            # rather than every UID in full (RFC 4731).
+            result = self.esearch(q, 'ALL')
+            return [str(uid) for uid in _parse_sequence_set(result ['ALL'])] \
+                    if 'ALL' in result else []
+
+        with timing.phase('search'):
+            status, id_pairs = self.call('uid', 'search', str(q))
         ids = []
 
         for id_pair in id_pairs:
@@ -123,13 +805,79 @@ class MailClient():
 
         return ids
 
+    #----------------------------------------------------------------
+    def count(self, q):
+        """
+            Count the messages matching a query.  Only the count is
+            returned by the server if it supports ESEARCH.
+        """
+
+        if self.has_capability('ESEARCH'):
+            return int(self.esearch(q, 'COUNT').get('COUNT', 0))
+
+        return len(self.search(q))
+
+    #----------------------------------------------------------------
+    def esearch(self, q, *options):
+        """
+            Search with ESEARCH, returning a dictionary of the result
+            options requested, e.g. esearch(q, 'MIN', 'COUNT') gives
+            {'MIN': '17', 'COUNT': '3'}.  Options without results, such
+            as ALL when nothing matched, are left out.
+        """
+
+        with timing.phase('search'):
+            status, response = self.call('uid', 'search',
+                    'RETURN (%s)' % ' '.join(options), str(q))
+
+        if status != 'OK':
+            raise MailClientException("Could not search: %s" % response)
+
+        code, data = self.imap.response('ESEARCH')
+        result = {}
+
+        for item in data:
+            if not item:
+                continue
+
+            tokens, pos = _parse_list(_tokenize(item), 0)
+            tokens = [token for token in tokens if not isinstance(token, list)]
+            for n in range(len(tokens) - 1):
+                name = tokens [n].decode().upper()
+                if name in options:
+                    result [name] = tokens [n + 1].decode()
+
+        return result
+
+    #----------------------------------------------------------------
+    def thread(self, q, algorithm = 'REFERENCES', charset = 'UTF-8'):
+        """
+            Thread the messages matching the given IMAPQuery on the
+            server, which must support the THREAD extension (RFC 5256)
+            with the given algorithm.
+
+            Returns a list of threads, each a (uid, children) tuple
+            where children is a list of replies in the same form.  The
+            UID is None for a missing message with several replies.
+        """
+
+        with timing.phase('search'):
+            status, response = self.call('uid', 'THREAD', algorithm, charset, str(q))
+        if status != 'OK':
+            raise MailClientException("Could not thread messages: %s" % response)
+
+        data = b' '.join(item for item in response if item)
+        items, pos = _parse_list(_tokenize(data), 0)
+
+        return [_thread_node(item) for item in items if isinstance(item, list)]
+
     #----------------------------------------------------------------
     def flag(self, uid, *flags):
         """
             Mark a message in an IMAP inbox with the given flags.
         """
 
-        self.imap.uid('store', uid, '+FLAGS', *flags)
+        self.store_flags(str(uid).split(','), flags)
 
     #----------------------------------------------------------------
     def unflag(self, uid, *flags):
@@ -137,23 +885,483 @@ class MailClient():
             Remove the given flags from a message in an IMAP inbox.
         """
 
-        self.imap.uid('store', uid, '-FLAGS', *flags)
+        self.store_flags(str(uid).split(','), flags, add = False)
+
+    #----------------------------------------------------------------
+    def store_flags(self, uids, flags, add = True, silent = True,
+                    unchanged_since = None,
+                    max_length = MAX_SEQUENCE_SET_LENGTH):
+        """
+            Add or remove flags on many messages at once.
+
+            The UIDs are compressed into sequence sets and split into
+            chunks of at most max_length characters, so that tens of
+            thousands of messages can be flagged in a handful of
+            commands.  With silent set, the server is asked not to
+            send back an untagged FETCH for every message changed.
+
+            uids:
+                A list of message UIDs.
+            flags:
+                A list of flags, e.g. ['\\Seen'].
+            add:
+                True to add the flags, False to remove them.
+            silent:
+                Use +FLAGS.SILENT/-FLAGS.SILENT.
+            unchanged_since:
+                If specified and the server supports CONDSTORE, only
+                messages whose mod-sequence is not greater than this
+                value are modified.
+
+            Returns a tuple of (stored, modified), where stored is the
+            list of UIDs that were updated and modified is the list of
+            UIDs the server refused to update because they were changed
+            since unchanged_since.
+        """
+
+        item = '%sFLAGS%s' % ('+' if add else '-', '.SILENT' if silent else '')
+        flag_list = '(%s)' % ' '.join(flags)
+
+        args = [item, flag_list]
+        if unchanged_since is not None:
+            if not self.has_capability('CONDSTORE'):
+                raise MailClientException("Server does not support CONDSTORE, cannot use UNCHANGEDSINCE.")
+            args.insert(0, '(UNCHANGEDSINCE %d)' % int(unchanged_since))
+
+        stored = []
+        modified = []
+
+        for sequence_set, chunk in chunk_sequence_sets(uids, max_length):
+            if unchanged_since is None:
+                # Adding or removing flags is idempotent, unless the
+                # store is conditional, where a repeated store would
+                # find the messages modified by the first.
+                status, response = self.call('uid', 'store', sequence_set, *args)
+            else:
+                status, response = self.imap.uid('store', sequence_set, *args)
+
+            if status != 'OK':
+                raise MailClientException("Could not store flags: %s" % response)
+
+            failed = set()
+            code, data = self.imap.response('MODIFIED')
+            for sequence in data:
+                if sequence:
+                    failed.update(_parse_sequence_set(sequence.decode()))
+
+            for uid in chunk:
+                if uid in failed:
+                    modified.append(uid)
+                else:
+                    stored.append(uid)
+
+        return stored, modified
+
+    #----------------------------------------------------------------
+    def copy_messages(self, uids, mailbox, create = False,
+                      max_length = MAX_SEQUENCE_SET_LENGTH):
+        """
+            Copy messages in the selected mailbox to another mailbox on
+            the server, with UID COPY over compressed sequence sets.
+
+            uids:
+                A list of message UIDs.
+            mailbox:
+                The mailbox to copy the messages to.
+            create:
+                If set, the mailbox is created if it does not exist.
+
+            Returns a tuple of (uidvalidity, uid_map), where uid_map
+            is a dictionary mapping each UID copied to its UID in the
+            target mailbox, whose UIDVALIDITY is given.  These are only
+            known if the server supports UIDPLUS (RFC 4315), otherwise
+            (None, {}) is returned.
+        """
+
+        return self._transfer('copy', uids, mailbox, create, max_length)
+
+    #----------------------------------------------------------------
+    def move_messages(self, uids, mailbox, create = False,
+                      max_length = MAX_SEQUENCE_SET_LENGTH):
+        """
+            Move messages in the selected mailbox to another mailbox on
+            the server.  UID MOVE is used if the server supports MOVE
+            (RFC 6851), otherwise the messages are copied, flagged as
+            \\Deleted and removed with UID EXPUNGE.
+
+            If the server supports neither MOVE nor UIDPLUS, the messages
+            are copied and flagged as \\Deleted, but not expunged, as
+            EXPUNGE would also remove every other message in the mailbox
+            flagged as \\Deleted, see can_move_messages().
+
+            Returns a tuple of (uidvalidity, uid_map) as for
+            copy_messages().
+        """
+
+        if self.has_capability('MOVE'):
+            return self._transfer('move', uids, mailbox, create, max_length)
+
+        uidvalidity, uid_map = self._transfer('copy', uids, mailbox, create, max_length)
+        self.store_flags(uids, ['\\Deleted'], max_length = max_length)
+        if self.has_capability('UIDPLUS'):
+            self.expunge_messages(uids, max_length)
+
+        return uidvalidity, uid_map
+
+    #----------------------------------------------------------------
+    def can_move_messages(self):
+        """
+            Whether move_messages() removes the messages from the
+            selected mailbox, i.e. the server supports MOVE or UIDPLUS.
+        """
+
+        return self.has_capability('MOVE') or self.has_capability('UIDPLUS')
+
+    #----------------------------------------------------------------
+    def _transfer(self, command, uids, mailbox, create, max_length):
+        # COPY and MOVE are not retried, as a copy made just before
+        # the connection was lost would be made twice.
+        uidvalidity = None
+        uid_map = {}
+
+        for sequence_set, chunk in chunk_sequence_sets(uids, max_length):
+            status, response = self.imap.uid(command, sequence_set, '"%s"' % mailbox)
+
+            if status == 'NO' and create and b'[TRYCREATE]' in b' '.join(response):
+                self.create_mailbox(mailbox)
+                create = False
+                status, response = self.imap.uid(command, sequence_set, '"%s"' % mailbox)
+
+            if status != 'OK':
+                raise MailClientException("Could not %s messages to %s: %s" % (
+                    command, mailbox, response))
+
+            code, data = self.imap.response('COPYUID')
+            for item in data:
+                if item:
+                    validity, source, target = item.decode().split()
+                    uidvalidity = int(validity)
+                    uid_map.update(zip(_parse_sequence_set(source),
+                                       _parse_sequence_set(target)))
+
+            if command == 'move':
+                self._track_expunged()
+
+        return uidvalidity, uid_map
+
+    #----------------------------------------------------------------
+    def expunge_messages(self, uids, max_length = MAX_SEQUENCE_SET_LENGTH):
+        """
+            Permanently remove messages flagged as \\Deleted from the
+            selected mailbox.  If the server supports UIDPLUS, only the
+            given messages are removed, with UID EXPUNGE.  Otherwise,
+            EXPUNGE removes every message in the mailbox flagged as
+            \\Deleted.
+        """
+
+        if not self.has_capability('UIDPLUS'):
+            status, response = self.call('expunge')
+            if status != 'OK':
+                raise MailClientException("Could not expunge messages: %s" % response)
+            self.track_changes([('EXPUNGE', item) for item in response if item])
+            return
+
+        for sequence_set, chunk in chunk_sequence_sets(uids, max_length):
+            status, response = self.call('uid', 'expunge', sequence_set)
+            if status != 'OK':
+                raise MailClientException("Could not expunge messages: %s" % response)
+
+            self._track_expunged()
+
+    #----------------------------------------------------------------
+    def _track_expunged(self):
+        code, data = self.imap.response('EXPUNGE')
+        self.track_changes([('EXPUNGE', item) for item in data if item])
+
+    #----------------------------------------------------------------
+    def create_mailbox(self, mailbox):
+        """
+            Create a mailbox on the server.
+        """
+
+        status, response = self.imap.create('"%s"' % mailbox)
+        if status != 'OK':
+            raise MailClientException("Could not create mailbox %s: %s" % (mailbox, response))
+
+    #----------------------------------------------------------------
+    def append(self, mailbox, messages, batch_size = APPEND_BATCH_SIZE,
+               batch_bytes = APPEND_BATCH_BYTES):
+        """
+            Upload messages to the given mailbox.
+
+            messages:
+                An iterable of (message, flags, date) tuples, where
+                message is the raw bytes of the message or the name of
+                a file holding it, flags is a list of flags, and date is
+                the datetime to use as the INTERNALDATE, or None.
+            batch_size, batch_bytes:
+                The most messages and bytes sent in one APPEND, if the
+                server supports MULTIAPPEND (RFC 3502).
+
+            If the server supports LITERAL+ (RFC 7888), messages are
+            sent without waiting for the server to accept each one, so
+            an upload is bound by bandwidth rather than round trips.
+            Without MULTIAPPEND, an APPEND per message is sent, and
+            with LITERAL+ these are pipelined.
+
+            Returns the list of UIDs assigned to the messages if the
+            server supports UIDPLUS (RFC 4315), or an empty list.
+            Raises MailClientException if the server refuses a batch,
+            in which case earlier batches have been stored.
+        """
+
+        if not self.is_connected():
+            raise MailClientException("Cannot append, not connected.")
+
+        literal_plus = self.has_capability('LITERAL+')
+        multiple = self.has_capability('MULTIAPPEND')
+        uids = []
+
+        for batch in self._append_batches(messages, batch_size, batch_bytes):
+            if multiple:
+                tags = [self._send_append(mailbox, batch, literal_plus)]
+            elif literal_plus:
+                tags = [self._send_append(mailbox, [item], literal_plus) for item in batch]
+            else:
+                tags = []
+                for item in batch:
+                    tags.append(self._send_append(mailbox, [item], literal_plus))
+                    self._complete_append(tags.pop(), uids)
+
+            for tag in tags:
+                self._complete_append(tag, uids)
+
+        return uids
+
+    #----------------------------------------------------------------
+    def _append_batches(self, messages, batch_size, batch_bytes):
+        batch = []
+        size = 0
+
+        for message, flags, date in messages:
+            literal_size, chunks = message_literal(message)
+
+            if batch and (len(batch) >= batch_size or size + literal_size > batch_bytes):
+                yield batch
+                batch = []
+                size = 0
+
+            batch.append((literal_size, chunks, flags, date))
+            size += literal_size
+
+        if batch:
+            yield batch
 
     #----------------------------------------------------------------
-    def set_mailbox(self, mailbox, readonly = False):
+    def _send_append(self, mailbox, batch, literal_plus):
+        imap = self.imap
+        tag = imap._new_tag()
+
+        imap.begin_command('APPEND', tag)
+        imap.send(tag + (' APPEND "%s"' % mailbox).encode('utf-8'))
+
+        for literal_size, chunks, flags, date in batch:
+            line = ' '
+            flags = [flag for flag in flags if flag != '\\Recent']
+            if flags:
+                line += '(%s) ' % ' '.join(flags)
+            if date is not None:
+                line += imaplib.Time2Internaldate(date) + ' '
+            line += '{%d%s}\r\n' % (literal_size, '+' if literal_plus else '')
+
+            imap.send(line.encode('utf-8'))
+
+            if not literal_plus:
+                # Wait for the server to ask for the literal.  If it
+                # refuses the command instead, it is completed here.
+                while imap._get_response():
+                    if imap.tagged_commands [tag]:
+                        typ, data = imap._command_complete('APPEND', tag)
+                        raise MailClientException("Could not append messages: %s" % data)
+
+            for chunk in chunks():
+                imap.send(chunk)
+
+        imap.send(b'\r\n')
+        return tag
+
+    #----------------------------------------------------------------
+    def _complete_append(self, tag, uids):
+        typ, data = self.imap._command_complete('APPEND', tag)
+
+        if typ != 'OK':
+            raise MailClientException("Could not append messages: %s" % data)
+
+        code, data = self.imap.response('APPENDUID')
+        for item in data:
+            if item:
+                uidvalidity, sequence_set = item.decode().split()
+                uids.extend(_parse_sequence_set(sequence_set))
+
+    #----------------------------------------------------------------
+    def set_mailbox(self, mailbox, readonly = False, force = False):
+        """
+            Select the given mailbox, with EXAMINE if readonly is set
+            or SELECT otherwise.  Nothing is sent if the mailbox is
+            already selected in the same mode, unless force is set.
+
+            The EXISTS, UIDNEXT, UIDVALIDITY and HIGHESTMODSEQ values
+            reported by the server are kept as attributes of the same
+            names, and are None if not reported.
+        """
+
         if not self.is_connected():
             raise MailClientException("Cannot set mailbox, not connected.")
 
-        self.mailbox = mailbox
-        status, message = self.imap.select("\"%s\"" % self.mailbox, readonly)
+        if not force and mailbox == self.mailbox and readonly == self.readonly \
+                and self.imap.state == 'SELECTED':
+            return
+
+        self.retry(lambda: self._select(mailbox, readonly))
+
+    #----------------------------------------------------------------
+    def _select(self, mailbox, readonly):
+        previous = (self.mailbox, self.uidvalidity)
+        self.mailbox = None
+        self.readonly = None
+
+        with timing.phase('select'):
+            status, message = self.imap.select("\"%s\"" % mailbox, readonly)
 
         if status == 'NO':
             raise MailClientException("Could not change mailboxes: %s" % message)
 
+        self.mailbox = mailbox
+        self.readonly = readonly
+        self.exists = int(message[0]) if message and message[0] else 0
+
+        code, data = self.imap.response('UIDVALIDITY')
+        self.uidvalidity = int(data[0]) if data and data[0] else 0
+
+        code, data = self.imap.response('UIDNEXT')
+        self.uidnext = int(data[0]) if data and data[0] else None
+
+        code, data = self.imap.response('HIGHESTMODSEQ')
+        self.highestmodseq = int(data[0]) if data and data[0] else None
+
+        if (mailbox, self.uidvalidity) != previous:
+            self.gmail_ids = {}
+
+    #----------------------------------------------------------------
+    def track_changes(self, responses):
+        """
+            Update the message count of the selected mailbox from
+            the EXISTS and EXPUNGE responses given, as returned by
+            idle() and noop().
+        """
+
+        for typ, data in responses:
+            if typ == 'EXISTS':
+                self.exists = int(data)
+            elif typ == 'EXPUNGE' and self.exists:
+                self.exists -= 1
+
+        return responses
+
+    #----------------------------------------------------------------
+    def idle(self, timeout = IDLE_TIMEOUT):
+        """
+            Enter IDLE and wait up to timeout seconds for the server
+            to report a change to the selected mailbox.  IDLE is ended
+            as soon as the first response arrives.
+
+            Returns a list of (type, data) tuples for the EXISTS,
+            EXPUNGE and FETCH responses received, in order.  The list
+            is empty if the timeout elapsed without any changes.
+        """
+
+        if not self.has_capability('IDLE'):
+            raise MailClientException("Server does not support IDLE.")
+
+        imap = self.imap
+        tag = imap._new_tag()
+        imap.begin_command('IDLE', tag)
+        imap.send(tag + b' IDLE\r\n')
+
+        responses = []
+
+        while True:
+            line = imap.readline()
+            if line.startswith(b'+'):
+                break
+            elif line.startswith(tag + b' '):
+                imap.end_command(tag, 'NO')
+                raise MailClientException("IDLE rejected: %s" % line.decode().strip())
+            responses.append(line)
+
+        deadline = time.time() + timeout
+        while not responses:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not imap.wait_readable(remaining):
+                break
+            responses.append(imap.readline())
+
+        imap.send(b'DONE\r\n')
+
+        while True:
+            line = imap.readline()
+            if line.startswith(tag + b' '):
+                break
+            responses.append(line)
+
+        status = line [len(tag) + 1:].split(b' ', 1)[0].decode('ascii', 'replace')
+        imap.end_command(tag, status)
+
+        if status != 'OK':
+            raise MailClientException("IDLE failed: %s" % line.decode().strip())
+
+        return self.track_changes([r for r in map(transport.parse_untagged, responses)
+                if r is not None and r[0] in ('EXISTS', 'EXPUNGE', 'FETCH')])
+
+    #----------------------------------------------------------------
+    def noop(self):
+        """
+            Poll the server with NOOP.  Returns a list of (type, data)
+            tuples for the EXISTS, EXPUNGE and FETCH responses received,
+            in order.
+        """
+
+        self.imap.record_unsolicited = True
+        try:
+            self.imap.noop()
+        finally:
+            self.imap.record_unsolicited = False
+
+        for typ in ('EXISTS', 'EXPUNGE', 'FETCH', 'RECENT'):
+            self.imap.untagged_responses.pop(typ, None)
+
+        return self.track_changes(self.imap.take_unsolicited())
+
     #----------------------------------------------------------------
     def get_mailbox(self):
         return self.mailbox
 
+    #----------------------------------------------------------------
+    def has_capability(self, name):
+        """
+            Determine if the server advertised the given capability,
+            and it has not been disabled.  Each operation which has a
+            faster strategy for an extension checks for it here.
+        """
+
+        if not self.is_connected():
+            return False
+
+        if self.capabilities is None:
+            return Capabilities(self.imap.capabilities, self.disabled_capabilities).has(name)
+
+        return self.capabilities.has(name)
+
     #----------------------------------------------------------------
     def is_connected(self):
         if self.imap is None:
@@ -0,0 +1,333 @@
+#-------------------------------------------------------------------
+# webmail.export
+#
+# Readers and writers for local mbox files and Maildir
+# directories, used to export messages and to seed the cache.
+#-------------------------------------------------------------------
+
+import datetime
+import email.utils
+import os
+import re
+import socket
+import time
+
+#-------------------------------------------------------------------
+# The size of the buffer used for reading and writing archive files.
+BUFFER_SIZE = 1024 * 1024
+
+# Lines which must be quoted in an mboxrd file.
+MBOX_FROM_RE = re.compile(rb'^(>*From )', re.MULTILINE)
+
+# Quoted lines in an mboxrd file.
+MBOX_QUOTED_FROM_RE = re.compile(rb'^>(>*From )', re.MULTILINE)
+
+# Maildir info flags for IMAP system flags, in the order they are
+# written (Maildir flags must be in ASCII order).
+MAILDIR_FLAGS = [
+    ('\\Draft',     'D'),
+    ('\\Flagged',   'F'),
+    ('\\Answered',  'R'),
+    ('\\Seen',      'S'),
+    ('\\Deleted',   'T')
+]
+
+#-------------------------------------------------------------------
+class ExportException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+#-------------------------------------------------------------------
+class MboxWriter():
+    """
+        Writes messages to an mbox file in the mboxrd format, where
+        any line in a message body beginning with "From ", preceded
+        by any number of '>', is quoted with an additional '>'.
+        Messages are appended if the file already exists.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, filename, buffer_size = BUFFER_SIZE):
+        self.filename = filename
+        self.file = open(filename, 'ab', buffering = buffer_size)
+
+    #----------------------------------------------------------------
+    def write(self, raw_message, flags = (), date = None):
+        """
+            Append a message to the file.  Returns the number of
+            bytes written.
+
+            raw_message:
+                The raw RFC822 bytes of the message.
+            flags:
+                The IMAP flags of the message, unused in mbox files.
+            date:
+                The datetime the message was received, used for the
+                "From " separator line.  Defaults to now.
+        """
+
+        message = raw_message.replace(b'\r\n', b'\n')
+        message = MBOX_FROM_RE.sub(rb'>\1', message)
+
+        if not message.endswith(b'\n'):
+            message += b'\n'
+
+        data = b''.join([
+            self.separator(message, date),
+            message,
+            b'\n'])
+
+        self.file.write(data)
+        return len(data)
+
+    #----------------------------------------------------------------
+    def separator(self, message, date):
+        sender = b'MAILER-DAEMON'
+        header_end = message.find(b'\n\n')
+        m = re.search(rb'^(?:Return-Path|From):(.*)$',
+                message[:header_end if header_end >= 0 else len(message)],
+                re.MULTILINE | re.IGNORECASE)
+
+        if m is not None:
+            name, addr = email.utils.parseaddr(m.group(1).decode('ascii', 'replace'))
+            if addr and not re.search(r'\s', addr):
+                sender = addr.encode('ascii', 'replace')
+
+        if date is None:
+            timestamp = time.time()
+        else:
+            timestamp = date.timestamp()
+
+        return b'From ' + sender + b' ' + time.asctime(time.gmtime(timestamp)).encode() + b'\n'
+
+    #----------------------------------------------------------------
+    def close(self):
+        self.file.close()
+
+#-------------------------------------------------------------------
+class MaildirWriter():
+    """
+        Writes messages to a Maildir directory, creating it if
+        necessary.  Each message is written to 'tmp' and renamed
+        into 'cur' with its flags, or into 'new' if it has no
+        flags at all.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, directory, buffer_size = BUFFER_SIZE):
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.count = 0
+        self.hostname = socket.gethostname().replace('/', '\\057').replace(':', '\\072')
+
+        for subdir in ['tmp', 'new', 'cur']:
+            os.makedirs(os.path.join(directory, subdir), exist_ok = True)
+
+    #----------------------------------------------------------------
+    def write(self, raw_message, flags = (), date = None):
+        """
+            Add a message to the Maildir.  Returns the number of
+            bytes written.
+
+            raw_message:
+                The raw RFC822 bytes of the message.
+            flags:
+                The IMAP flags of the message.
+            date:
+                The datetime the message was received, which is set
+                as the modification time of the file.
+        """
+
+        self.count += 1
+        basename = '%d.P%dQ%d.%s' % (time.time(), os.getpid(), self.count, self.hostname)
+        tmp_filename = os.path.join(self.directory, 'tmp', basename)
+
+        message = raw_message.replace(b'\r\n', b'\n')
+
+        with open(tmp_filename, 'xb', buffering = self.buffer_size) as f:
+            f.write(message)
+
+        if date is not None:
+            timestamp = date.timestamp()
+            os.utime(tmp_filename, (timestamp, timestamp))
+
+        info = ''.join(letter for flag, letter in MAILDIR_FLAGS if flag in flags)
+
+        # Unseen messages go to 'new' only if they have no other flags,
+        # as messages there have no info to hold them.
+        if info:
+            filename = os.path.join(self.directory, 'cur', basename + ':2,' + info)
+        else:
+            filename = os.path.join(self.directory, 'new', basename)
+
+        os.rename(tmp_filename, filename)
+        return len(message)
+
+    #----------------------------------------------------------------
+    def close(self):
+        pass
+
+#-------------------------------------------------------------------
+def iter_mbox(filename, buffer_size = BUFFER_SIZE):
+    """
+        Read the messages in an mbox file one at a time.  Yields the
+        raw bytes of each message with LF line endings, with the
+        "From " separator line removed and mboxrd quoting undone.
+    """
+
+    for message, flags, date in iter_mbox_entries(filename, buffer_size):
+        yield message
+
+#-------------------------------------------------------------------
+def iter_mbox_entries(filename, buffer_size = BUFFER_SIZE):
+    """
+        As for iter_mbox(), but yields (message, flags, date) tuples,
+        where date is taken from the "From " separator line.  Flags
+        are not kept in mbox files, so are always empty.
+    """
+
+    lines = None
+    date = None
+
+    with open(filename, 'rb', buffering = buffer_size) as f:
+        for line in f:
+            if line.startswith(b'From '):
+                if lines is not None:
+                    yield _mbox_message(lines), [], date
+                lines = []
+                date = _mbox_date(line)
+
+            elif lines is not None:
+                lines.append(line)
+
+    if lines is not None:
+        yield _mbox_message(lines), [], date
+
+#-------------------------------------------------------------------
+def _mbox_date(line):
+    # The separator ends with the date in asctime() format, in UTC.
+    try:
+        date = datetime.datetime.strptime(
+                ' '.join(line.decode('ascii', 'replace').split()[-5:]),
+                '%a %b %d %H:%M:%S %Y')
+    except ValueError:
+        return None
+
+    return date.replace(tzinfo = datetime.timezone.utc)
+
+#-------------------------------------------------------------------
+def _mbox_message(lines):
+    # The blank line before the next separator belongs to the file.
+    if lines and lines[-1] in (b'\n', b'\r\n'):
+        lines.pop()
+
+    message = b''.join(lines).replace(b'\r\n', b'\n')
+    return MBOX_QUOTED_FROM_RE.sub(rb'\1', message)
+
+#-------------------------------------------------------------------
+def iter_maildir(directory):
+    """
+        Read the messages in a Maildir directory one at a time,
+        yielding the raw bytes of each message.
+    """
+
+    for filename, flags, date in iter_maildir_entries(directory):
+        with open(filename, 'rb') as f:
+            yield f.read()
+
+#-------------------------------------------------------------------
+def iter_maildir_entries(directory):
+    """
+        List the messages in a Maildir directory without reading them.
+        Yields (filename, flags, date) tuples, where flags are the IMAP
+        flags given by the Maildir info of each message, and date is
+        the modification time of its file.
+    """
+
+    letters = dict((letter, flag) for flag, letter in MAILDIR_FLAGS)
+
+    for subdir in ['cur', 'new']:
+        path = os.path.join(directory, subdir)
+        if not os.path.isdir(path):
+            continue
+
+        for name in sorted(os.listdir(path)):
+            if name.startswith('.'):
+                continue
+
+            filename = os.path.join(path, name)
+            basename, sep, info = name.rpartition(':2,')
+            flags = [letters [letter] for letter in info if letter in letters] if sep else []
+            date = datetime.datetime.fromtimestamp(os.stat(filename).st_mtime,
+                                                   datetime.timezone.utc)
+
+            yield filename, flags, date
+
+#-------------------------------------------------------------------
+def parse_spec(spec, verb = 'export'):
+    """
+        Split an archive specification, which is either "mbox:FILENAME"
+        or "maildir:DIRECTORY", into a (kind, path) tuple.
+    """
+
+    kind, sep, path = spec.partition(':')
+
+    if not sep or not path:
+        raise ExportException("Invalid %s \"%s\", expected mbox:FILE or maildir:DIR." % (verb, spec))
+
+    kind = kind.lower()
+    if kind not in ('mbox', 'maildir'):
+        raise ExportException("Unknown %s format \"%s\", expected mbox or maildir." % (verb, kind))
+
+    return kind, os.path.abspath(os.path.expanduser(path))
+
+#-------------------------------------------------------------------
+def open_export(spec):
+    """
+        Open a writer for the given export specification, which is
+        either "mbox:FILENAME" or "maildir:DIRECTORY".
+    """
+
+    kind, path = parse_spec(spec)
+
+    if kind == 'mbox':
+        return MboxWriter(path)
+    else:
+        return MaildirWriter(path)
+
+#-------------------------------------------------------------------
+def open_archive(spec):
+    """
+        Open an mbox file or Maildir directory for reading, given a
+        specification as for open_export().  Returns an iterator over
+        the raw bytes of each message.
+    """
+
+    kind, path = parse_spec(spec, 'import')
+
+    if not os.path.exists(path):
+        raise ExportException("No such archive: %s" % path)
+
+    if kind == 'mbox':
+        return iter_mbox(path)
+    else:
+        return iter_maildir(path)
+
+#-------------------------------------------------------------------
+def open_archive_entries(spec):
+    """
+        As for open_archive(), but returns an iterator over (message,
+        flags, date) tuples as taken by MailClient.append().  Messages
+        in a Maildir are given as filenames, to be read as they are
+        uploaded.
+    """
+
+    kind, path = parse_spec(spec, 'restore')
+
+    if not os.path.exists(path):
+        raise ExportException("No such archive: %s" % path)
+
+    if kind == 'mbox':
+        return iter_mbox_entries(path)
+    else:
+        return iter_maildir_entries(path)
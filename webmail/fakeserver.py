@@ -0,0 +1,1408 @@
+#-------------------------------------------------------------------
+# webmail.fakeserver
+#
+# An in-process IMAP4rev1 server holding mailboxes in memory, and a
+# generator of synthetic messages, so that the client can be tested
+# and measured without a network or a real account.
+#-------------------------------------------------------------------
+
+import base64
+import bisect
+import datetime
+import email.parser
+import email.utils
+import itertools
+import random
+import re
+import select
+import socket
+import socketserver
+import threading
+import time
+import zlib
+
+from .mime import scan_message
+
+#-------------------------------------------------------------------
+DEFAULT_CAPABILITIES = ['IMAP4rev1', 'IDLE', 'CONDSTORE', 'LITERAL+', 'COMPRESS=DEFLATE',
+                        'MULTIAPPEND', 'UIDPLUS', 'MOVE', 'ESEARCH']
+
+# The capabilities of a server with Gmail's IMAP extensions.
+GMAIL_CAPABILITIES = DEFAULT_CAPABILITIES + ['X-GM-EXT-1']
+
+SYSTEM_FLAGS = ['\\Answered', '\\Flagged', '\\Deleted', '\\Seen', '\\Draft']
+
+INTERNALDATE_FORMAT = '%d-%b-%Y %H:%M:%S %z'
+
+# How often an idling session checks for new notifications.
+IDLE_POLL_INTERVAL = 0.05
+
+_TOKEN_RE = re.compile(r'''
+      (?P<space>\s+)
+    | (?P<open>\()
+    | (?P<close>\))
+    | "(?P<quoted>(?:[^"\\]|\\.)*)"
+    | (?P<atom>(?:[^\s()"\[]|\[[^\]]*\])+)
+''', re.VERBOSE)
+
+_LITERAL_RE = re.compile(rb'\{(\d+)(\+?)\}\r?\n$')
+
+_BODY_SECTION_RE = re.compile(r'^BODY(\.PEEK)?\[([^\]]*)\](?:<(\d+)(?:\.(\d+))?>)?$', re.IGNORECASE)
+
+_HEADER_PARSER = email.parser.BytesHeaderParser()
+
+_OPEN = object()
+_CLOSE = object()
+
+# Message ids shared by every copy of a message, as for X-GM-MSGID.
+_MESSAGE_IDS = itertools.count(1 << 40)
+
+#-------------------------------------------------------------------
+class BadCommand(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+#-------------------------------------------------------------------
+class FakeMessage():
+    """
+        A message stored in a FakeMailbox.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, uid, raw, flags = (), internaldate = None, modseq = 1,
+                 message_id = None, labels = ()):
+        if internaldate is None:
+            internaldate = datetime.datetime.now(datetime.timezone.utc)
+
+        self.uid = uid
+        self.raw = raw
+        self.flags = list(flags)
+        self.internaldate = internaldate
+        self.modseq = modseq
+        self.message_id = message_id or next(_MESSAGE_IDS)
+        self.labels = list(labels)
+        self._headers = None
+        self._skeleton = None
+
+        n = raw.find(b'\r\n\r\n')
+        self.header_end = len(raw) if n < 0 else n + 4
+
+    #----------------------------------------------------------------
+    def get_header(self):
+        return self.raw [:self.header_end]
+
+    #----------------------------------------------------------------
+    def get_text(self):
+        return self.raw [self.header_end:]
+
+    #----------------------------------------------------------------
+    def get_headers(self):
+        if self._headers is None:
+            self._headers = _HEADER_PARSER.parsebytes(self.get_header())
+        return self._headers
+
+    #----------------------------------------------------------------
+    def get_section(self, section):
+        """
+            Get the content of a numeric body section, e.g. '2.1'.
+        """
+
+        if self._skeleton is None:
+            self._skeleton = scan_message(self.raw)
+
+        part, offsets = self._skeleton
+        for n in section.split('.'):
+            payload = part.get_payload()
+            if not isinstance(payload, list):
+                if n == '1':
+                    continue
+                return b''
+            if int(n) < 1 or int(n) > len(payload):
+                return b''
+            part = payload [int(n) - 1]
+
+        start, end = offsets.get(id(part), (0, 0))
+        return self.raw [start:end]
+
+#-------------------------------------------------------------------
+class FakeMailbox():
+    """
+        A mailbox of FakeMessages, kept in UID order.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, name, uidvalidity = None):
+        self.name = name
+        self.uidvalidity = uidvalidity or int(time.time())
+        self.uidnext = 1
+        self.highestmodseq = 1
+        self.messages = []
+        self.uids = []
+
+    #----------------------------------------------------------------
+    def append(self, raw, flags = (), internaldate = None, message_id = None, labels = ()):
+        self.highestmodseq += 1
+        message = FakeMessage(self.uidnext, raw, flags, internaldate, self.highestmodseq,
+                              message_id, labels)
+        self.messages.append(message)
+        self.uids.append(message.uid)
+        self.uidnext += 1
+        return message
+
+    #----------------------------------------------------------------
+    def expunge(self, uids = None):
+        """
+            Remove messages flagged \\Deleted, only those with the
+            given UIDs if specified.  Returns the sequence numbers of
+            the removed messages, as they are to be reported.
+        """
+
+        return self.remove([message.uid for message in self.messages
+                if '\\Deleted' in message.flags and (uids is None or message.uid in uids)])
+
+    #----------------------------------------------------------------
+    def remove(self, uids):
+        """
+            Remove the messages with the given UIDs, regardless of
+            their flags.  Returns sequence numbers as for expunge().
+        """
+
+        uids = set(uids)
+        removed = []
+        kept = []
+
+        for message in self.messages:
+            if message.uid in uids:
+                removed.append(len(kept) + 1)
+            else:
+                kept.append(message)
+
+        self.messages = kept
+        self.uids = [message.uid for message in kept]
+        return removed
+
+    #----------------------------------------------------------------
+    def resolve(self, sequence_set, by_uid):
+        """
+            Resolve a sequence set into a list of (seq, message)
+            tuples in ascending order.
+        """
+
+        if not self.messages:
+            return []
+
+        largest = self.uids [-1] if by_uid else len(self.messages)
+        indices = set()
+
+        for item in sequence_set.split(','):
+            first, sep, last = item.partition(':')
+            first = largest if first == '*' else int(first)
+            last = first if not sep else (largest if last == '*' else int(last))
+            if first > last:
+                first, last = last, first
+
+            if by_uid:
+                indices.update(range(bisect.bisect_left(self.uids, first),
+                                     bisect.bisect_right(self.uids, last)))
+            else:
+                indices.update(range(max(first, 1) - 1, min(last, len(self.messages))))
+
+        return [(n + 1, self.messages [n]) for n in sorted(indices)]
+
+#-------------------------------------------------------------------
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """
+        An IMAP4rev1 server for tests and benchmarks, which runs in
+        a background thread of the current process.
+
+        Supports LOGIN, SELECT/EXAMINE, SEARCH (with ESEARCH's RETURN
+        options MIN, MAX, ALL and COUNT), FETCH (including
+        partial and HEADER.FIELDS sections), STORE (with CONDSTORE's
+        UNCHANGEDSINCE), EXPUNGE, IDLE, APPEND (with MULTIAPPEND),
+        COPY, MOVE, CREATE, UIDPLUS's APPENDUID, COPYUID and UID
+        EXPUNGE, and COMPRESS=DEFLATE.  With GMAIL_CAPABILITIES, the
+        X-GM-MSGID, X-GM-THRID and X-GM-LABELS FETCH items are also
+        supported, where every copy of a message has the same id.
+
+        latency:
+            Seconds added before each command completes, to simulate
+            the round trip to a remote server.
+        bandwidth:
+            If specified, the bytes per second at which responses
+            are sent.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    #----------------------------------------------------------------
+    def __init__(self, username = 'user', password = 'password',
+                 latency = 0.0, bandwidth = None,
+                 capabilities = DEFAULT_CAPABILITIES,
+                 hostname = '127.0.0.1', port = 0):
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.capabilities = list(capabilities)
+        self.mailboxes = {'INBOX': FakeMailbox('INBOX')}
+        self.sessions = set()
+        self.faults = {}
+        self.lock = threading.RLock()
+        self.thread = None
+        self.reset_stats()
+
+        socketserver.ThreadingTCPServer.__init__(self, (hostname, port), FakeIMAPHandler)
+
+    #----------------------------------------------------------------
+    def __enter__(self):
+        return self.start()
+
+    #----------------------------------------------------------------
+    def __exit__(self, *args):
+        self.stop()
+
+    #----------------------------------------------------------------
+    def start(self):
+        """
+            Start serving in a background thread.
+        """
+
+        self.thread = threading.Thread(target = self.serve_forever, daemon = True)
+        self.thread.start()
+        return self
+
+    #----------------------------------------------------------------
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    #----------------------------------------------------------------
+    @property
+    def hostname(self):
+        return self.server_address [0]
+
+    #----------------------------------------------------------------
+    @property
+    def port(self):
+        return self.server_address [1]
+
+    #----------------------------------------------------------------
+    def reset_stats(self):
+        """
+            Reset the counts of connections, commands and bytes.
+        """
+
+        self.stats = {
+            'connections':      0,
+            'commands':         0,
+            'bytes_sent':       0,
+            'bytes_received':   0,
+            'verbs':            {}
+        }
+
+    #----------------------------------------------------------------
+    def count(self, name, n = 1):
+        with self.lock:
+            self.stats [name] += n
+
+    #----------------------------------------------------------------
+    def drop_connection(self, verb, times = 1):
+        """
+            Close the connection instead of answering the next times
+            commands with the given verb, e.g. 'FETCH', to simulate
+            a lost connection.
+        """
+
+        with self.lock:
+            self.faults [verb.upper()] = self.faults.get(verb.upper(), 0) + times
+
+    #----------------------------------------------------------------
+    def take_fault(self, verb):
+        with self.lock:
+            remaining = self.faults.get(verb, 0)
+            if remaining > 0:
+                self.faults [verb] = remaining - 1
+                return True
+
+        return False
+
+    #----------------------------------------------------------------
+    def get_mailbox(self, name, create = False):
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+
+        with self.lock:
+            if name not in self.mailboxes and create:
+                self.mailboxes [name] = FakeMailbox(name)
+            return self.mailboxes.get(name)
+
+    #----------------------------------------------------------------
+    def deliver(self, raw, mailbox = 'INBOX', flags = (), internaldate = None):
+        """
+            Add a message to a mailbox, notifying any session which
+            has the mailbox selected.  Returns the new FakeMessage.
+        """
+
+        with self.lock:
+            box = self.get_mailbox(mailbox, create = True)
+            message = box.append(raw, flags, internaldate)
+            self.notify(box, '* %d EXISTS' % len(box.messages))
+
+        return message
+
+    #----------------------------------------------------------------
+    def populate(self, count, mailbox = 'INBOX', seed = 0, **kwargs):
+        """
+            Add count synthetic messages to a mailbox, see
+            generate_messages() for the keyword arguments.
+        """
+
+        with self.lock:
+            box = self.get_mailbox(mailbox, create = True)
+            for raw, flags, internaldate in generate_messages(count, seed, **kwargs):
+                box.append(raw, flags, internaldate)
+
+        return box
+
+    #----------------------------------------------------------------
+    def notify(self, mailbox, line, exclude = None):
+        with self.lock:
+            for session in self.sessions:
+                if session is not exclude and session.mailbox is mailbox:
+                    session.pending.append(line)
+
+#-------------------------------------------------------------------
+class FakeIMAPHandler(socketserver.BaseRequestHandler):
+    """
+        A single client connection to a FakeIMAPServer.
+    """
+
+    #----------------------------------------------------------------
+    def setup(self):
+        # Responses are written a line at a time, which would
+        # otherwise be held back waiting for delayed ACKs.
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self.inbuf = bytearray()
+        self.compressor = None
+        self.decompressor = None
+        self.authenticated = False
+        self.mailbox = None
+        self.readonly = False
+        self.pending = []
+
+        with self.server.lock:
+            self.server.sessions.add(self)
+        self.server.count('connections')
+
+    #----------------------------------------------------------------
+    def finish(self):
+        with self.server.lock:
+            self.server.sessions.discard(self)
+
+    #----------------------------------------------------------------
+    def handle(self):
+        self.send_line('* OK [CAPABILITY %s] Fake IMAP4rev1 server ready' %
+                ' '.join(self.server.capabilities))
+
+        try:
+            while True:
+                tokens = self.read_command()
+                if tokens is None or not self.dispatch(tokens):
+                    break
+
+        except (ConnectionError, EOFError):
+            pass
+
+    #----------------------------------------------------------------
+    def dispatch(self, tokens):
+        """
+            Run a single command.  Returns False once the connection
+            is to be closed.
+        """
+
+        if len(tokens) < 2 or not isinstance(tokens [0], str) or not isinstance(tokens [1], str):
+            self.send_line('* BAD Invalid command')
+            return True
+
+        tag, verb, args = tokens [0], tokens [1].upper(), tokens [2:]
+        by_uid = False
+
+        if verb == 'UID' and args:
+            by_uid = True
+            verb, args = str(args [0]).upper(), args [1:]
+
+        self.server.count('commands')
+        with self.server.lock:
+            verbs = self.server.stats ['verbs']
+            verbs [verb] = verbs.get(verb, 0) + 1
+
+        if self.server.take_fault(verb):
+            return False
+
+        method = getattr(self, 'do_' + verb.replace('.', '_'), None)
+        if method is None:
+            self.complete(tag, 'BAD', 'Unknown command %s' % verb)
+            return True
+
+        if verb not in ('CAPABILITY', 'LOGIN', 'LOGOUT', 'NOOP') and not self.authenticated:
+            self.complete(tag, 'NO', 'Not authenticated')
+            return True
+
+        try:
+            return method(tag, args, by_uid) is not False
+        except BadCommand as e:
+            self.complete(tag, 'BAD', str(e))
+        except (IndexError, ValueError) as e:
+            self.complete(tag, 'BAD', 'Invalid arguments: %s' % e)
+
+        return True
+
+    #----------------------------------------------------------------
+    def complete(self, tag, status, text):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_line('%s %s %s' % (tag, status, text))
+
+    #----------------------------------------------------------------
+    def require_mailbox(self):
+        if self.mailbox is None:
+            raise BadCommand('No mailbox selected')
+        return self.mailbox
+
+    #----------------------------------------------------------------
+    def flush_pending(self):
+        with self.server.lock:
+            pending, self.pending = self.pending, []
+
+        for line in pending:
+            self.send_line(line)
+
+    #----------------------------------------------------------------
+    # I/O
+    #----------------------------------------------------------------
+    def send(self, data):
+        self.server.count('bytes_sent', len(data))
+
+        if self.compressor is not None:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        if self.server.bandwidth:
+            time.sleep(len(data) / self.server.bandwidth)
+
+        self.request.sendall(data)
+
+    #----------------------------------------------------------------
+    def send_line(self, line):
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        self.send(line + b'\r\n')
+
+    #----------------------------------------------------------------
+    def fill(self):
+        data = self.request.recv(65536)
+        if not data:
+            raise EOFError()
+
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+
+        self.server.count('bytes_received', len(data))
+        self.inbuf.extend(data)
+
+    #----------------------------------------------------------------
+    def readline(self):
+        while True:
+            n = self.inbuf.find(b'\n')
+            if n >= 0:
+                line = bytes(self.inbuf [:n + 1])
+                del self.inbuf [:n + 1]
+                return line
+            self.fill()
+
+    #----------------------------------------------------------------
+    def read(self, size):
+        while len(self.inbuf) < size:
+            self.fill()
+
+        data = bytes(self.inbuf [:size])
+        del self.inbuf [:size]
+        return data
+
+    #----------------------------------------------------------------
+    def is_readable(self, timeout):
+        if self.inbuf:
+            return True
+
+        readable, writable, errors = select.select([self.request], [], [], timeout)
+        return bool(readable)
+
+    #----------------------------------------------------------------
+    def read_command(self):
+        """
+            Read a command, including any literals, and parse it into
+            a nested list of tokens.  Atoms and quoted strings are str,
+            literals are bytes and parenthesized lists are lists.
+        """
+
+        tokens = []
+
+        while True:
+            try:
+                line = self.readline()
+            except EOFError:
+                return None
+
+            m = _LITERAL_RE.search(line)
+            if m is None:
+                tokens.extend(_tokenize(line.rstrip(b'\r\n')))
+                break
+
+            tokens.extend(_tokenize(line [:m.start()]))
+            if not m.group(2):
+                self.send_line('+ Ready for literal data')
+
+            tokens.append(self.read(int(m.group(1))))
+
+        nested, pos = _nest(tokens, 0)
+        return nested
+
+    #----------------------------------------------------------------
+    # Commands
+    #----------------------------------------------------------------
+    def do_CAPABILITY(self, tag, args, by_uid):
+        self.send_line('* CAPABILITY %s' % ' '.join(self.server.capabilities))
+        self.complete(tag, 'OK', 'CAPABILITY completed')
+
+    #----------------------------------------------------------------
+    def do_NOOP(self, tag, args, by_uid):
+        self.flush_pending()
+        self.complete(tag, 'OK', 'NOOP completed')
+
+    do_CHECK = do_NOOP
+
+    #----------------------------------------------------------------
+    def do_LOGOUT(self, tag, args, by_uid):
+        self.send_line('* BYE Logging out')
+        self.complete(tag, 'OK', 'LOGOUT completed')
+        return False
+
+    #----------------------------------------------------------------
+    def do_LOGIN(self, tag, args, by_uid):
+        username, password = [_string(arg) for arg in args [:2]]
+
+        if username != self.server.username or password != self.server.password:
+            self.complete(tag, 'NO', '[AUTHENTICATIONFAILED] Invalid credentials')
+            return
+
+        self.authenticated = True
+        self.complete(tag, 'OK', 'LOGIN completed')
+
+    #----------------------------------------------------------------
+    def do_COMPRESS(self, tag, args, by_uid):
+        if 'COMPRESS=DEFLATE' not in self.server.capabilities or \
+                not args or str(args [0]).upper() != 'DEFLATE':
+            raise BadCommand('Unsupported compression')
+
+        if self.compressor is not None:
+            self.complete(tag, 'NO', '[COMPRESSIONACTIVE] Already compressing')
+            return
+
+        self.complete(tag, 'OK', 'DEFLATE active')
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+
+        if self.inbuf:
+            self.inbuf = bytearray(self.decompressor.decompress(bytes(self.inbuf)))
+
+    #----------------------------------------------------------------
+    def do_SELECT(self, tag, args, by_uid, readonly = False):
+        mailbox = self.server.get_mailbox(_string(args [0]))
+
+        if mailbox is None:
+            self.mailbox = None
+            self.complete(tag, 'NO', 'No such mailbox')
+            return
+
+        with self.server.lock:
+            self.mailbox = mailbox
+            self.readonly = readonly
+            self.pending = []
+
+            unseen = [seq for seq, message in enumerate(mailbox.messages, 1)
+                      if '\\Seen' not in message.flags]
+
+            self.send_line('* FLAGS (%s)' % ' '.join(SYSTEM_FLAGS))
+            self.send_line('* OK [PERMANENTFLAGS (%s \\*)] Flags permitted' % ' '.join(SYSTEM_FLAGS))
+            self.send_line('* %d EXISTS' % len(mailbox.messages))
+            self.send_line('* 0 RECENT')
+            if unseen:
+                self.send_line('* OK [UNSEEN %d] First unseen' % unseen [0])
+            self.send_line('* OK [UIDVALIDITY %d] UIDs valid' % mailbox.uidvalidity)
+            self.send_line('* OK [UIDNEXT %d] Predicted next UID' % mailbox.uidnext)
+            if 'CONDSTORE' in self.server.capabilities:
+                self.send_line('* OK [HIGHESTMODSEQ %d] Highest' % mailbox.highestmodseq)
+
+        self.complete(tag, 'OK', '[%s] %s completed' % (
+            'READ-ONLY' if readonly else 'READ-WRITE',
+            'EXAMINE' if readonly else 'SELECT'))
+
+    #----------------------------------------------------------------
+    def do_EXAMINE(self, tag, args, by_uid):
+        self.do_SELECT(tag, args, by_uid, readonly = True)
+
+    #----------------------------------------------------------------
+    def do_CLOSE(self, tag, args, by_uid):
+        mailbox = self.require_mailbox()
+
+        if not self.readonly:
+            with self.server.lock:
+                mailbox.expunge()
+
+        self.mailbox = None
+        self.complete(tag, 'OK', 'CLOSE completed')
+
+    #----------------------------------------------------------------
+    def do_EXPUNGE(self, tag, args, by_uid):
+        mailbox = self.require_mailbox()
+        if self.readonly:
+            self.complete(tag, 'NO', 'Mailbox is read-only')
+            return
+
+        uids = None
+        if by_uid:
+            uids = set(message.uid for seq, message in mailbox.resolve(str(args [0]), True))
+
+        with self.server.lock:
+            expunged = mailbox.expunge(uids)
+            for seq in expunged:
+                self.server.notify(mailbox, '* %d EXPUNGE' % seq, exclude = self)
+
+        for seq in expunged:
+            self.send_line('* %d EXPUNGE' % seq)
+
+        self.complete(tag, 'OK', 'EXPUNGE completed')
+
+    #----------------------------------------------------------------
+    def do_APPEND(self, tag, args, by_uid):
+        mailbox = self.server.get_mailbox(_string(args [0]))
+        if mailbox is None:
+            self.complete(tag, 'NO', '[TRYCREATE] No such mailbox')
+            return
+
+        messages = []
+        flags = ()
+        internaldate = None
+
+        for arg in args [1:]:
+            if isinstance(arg, list):
+                flags = [str(flag) for flag in arg]
+            elif isinstance(arg, bytes):
+                messages.append((arg, flags, internaldate))
+                flags = ()
+                internaldate = None
+            else:
+                internaldate = datetime.datetime.strptime(str(arg), INTERNALDATE_FORMAT)
+
+        if not messages or (len(messages) > 1 and 'MULTIAPPEND' not in self.server.capabilities):
+            raise BadCommand('Invalid APPEND')
+
+        with self.server.lock:
+            uids = [mailbox.append(raw, flags, internaldate).uid
+                    for raw, flags, internaldate in messages]
+            self.server.notify(mailbox, '* %d EXISTS' % len(mailbox.messages))
+
+        code = ''
+        if 'UIDPLUS' in self.server.capabilities:
+            code = '[APPENDUID %d %s] ' % (mailbox.uidvalidity,
+                    '%d:%d' % (uids [0], uids [-1]) if len(uids) > 1 else uids [0])
+
+        self.complete(tag, 'OK', code + 'APPEND completed')
+
+    #----------------------------------------------------------------
+    def do_CREATE(self, tag, args, by_uid):
+        name = _string(args [0])
+
+        with self.server.lock:
+            if self.server.get_mailbox(name) is not None:
+                self.complete(tag, 'NO', '[ALREADYEXISTS] Mailbox exists')
+                return
+            self.server.get_mailbox(name, create = True)
+
+        self.complete(tag, 'OK', 'CREATE completed')
+
+    #----------------------------------------------------------------
+    def do_COPY(self, tag, args, by_uid, move = False):
+        mailbox = self.require_mailbox()
+        if move and self.readonly:
+            self.complete(tag, 'NO', 'Mailbox is read-only')
+            return
+
+        target = self.server.get_mailbox(_string(args [1]))
+        if target is None:
+            self.complete(tag, 'NO', '[TRYCREATE] No such mailbox')
+            return
+
+        with self.server.lock:
+            messages = [message for seq, message in mailbox.resolve(str(args [0]), by_uid)]
+            copies = [target.append(message.raw, message.flags, message.internaldate,
+                                    message.message_id, message.labels)
+                      for message in messages]
+            if copies:
+                self.server.notify(target, '* %d EXISTS' % len(target.messages), exclude = self)
+
+            expunged = []
+            if move:
+                expunged = mailbox.remove(message.uid for message in messages)
+                for seq in expunged:
+                    self.server.notify(mailbox, '* %d EXPUNGE' % seq, exclude = self)
+
+        code = ''
+        if copies and 'UIDPLUS' in self.server.capabilities:
+            code = '[COPYUID %d %s %s] ' % (target.uidvalidity,
+                    ','.join(str(message.uid) for message in messages),
+                    ','.join(str(message.uid) for message in copies))
+
+        if move:
+            # MOVE reports the new UIDs before the messages are expunged.
+            if code:
+                self.send_line('* OK %sMoved' % code)
+                code = ''
+            for seq in expunged:
+                self.send_line('* %d EXPUNGE' % seq)
+
+        self.complete(tag, 'OK', code + ('MOVE' if move else 'COPY') + ' completed')
+
+    #----------------------------------------------------------------
+    def do_MOVE(self, tag, args, by_uid):
+        if 'MOVE' not in self.server.capabilities:
+            raise BadCommand('MOVE not supported')
+
+        self.do_COPY(tag, args, by_uid, move = True)
+
+    #----------------------------------------------------------------
+    def do_IDLE(self, tag, args, by_uid):
+        self.send_line('+ idling')
+
+        while True:
+            self.flush_pending()
+
+            if self.is_readable(IDLE_POLL_INTERVAL):
+                line = self.readline()
+                if line.strip().upper() == b'DONE':
+                    break
+                self.complete(tag, 'BAD', 'Expected DONE')
+                return
+
+        self.flush_pending()
+        self.complete(tag, 'OK', 'IDLE terminated')
+
+    #----------------------------------------------------------------
+    def do_SEARCH(self, tag, args, by_uid):
+        mailbox = self.require_mailbox()
+
+        options = None
+        if args and str(args [0]).upper() == 'RETURN':
+            if 'ESEARCH' not in self.server.capabilities:
+                raise BadCommand('ESEARCH not supported')
+            options = [str(option).upper() for option in args [1]] or ['ALL']
+            args = args [2:]
+
+        if args and str(args [0]).upper() == 'CHARSET':
+            args = args [2:]
+
+        with self.server.lock:
+            messages = list(enumerate(mailbox.messages, 1))
+            criteria = _SearchCriteria(args, mailbox, messages)
+            matches = [message.uid if by_uid else seq
+                       for seq, message in messages if criteria.match(seq, message)]
+
+        if options is None:
+            self.send_line('* SEARCH' + ''.join(' %d' % n for n in matches))
+        else:
+            line = '* ESEARCH (TAG "%s")%s' % (tag, ' UID' if by_uid else '')
+            if matches and 'MIN' in options:
+                line += ' MIN %d' % matches [0]
+            if matches and 'MAX' in options:
+                line += ' MAX %d' % matches [-1]
+            if matches and 'ALL' in options:
+                line += ' ALL %s' % _sequence_set(matches)
+            if 'COUNT' in options:
+                line += ' COUNT %d' % len(matches)
+            self.send_line(line)
+
+        self.complete(tag, 'OK', 'SEARCH completed')
+
+    #----------------------------------------------------------------
+    def do_FETCH(self, tag, args, by_uid):
+        mailbox = self.require_mailbox()
+        items = args [1]
+
+        if not isinstance(items, list):
+            items = {
+                'ALL':  ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE'],
+                'FAST': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE'],
+                'FULL': ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE']
+            }.get(str(items).upper(), [items])
+
+        items = [str(item) for item in items]
+        if by_uid and 'UID' not in [item.upper() for item in items]:
+            items.insert(0, 'UID')
+
+        changed_since = None
+        if len(args) > 2 and isinstance(args [2], list):
+            modifiers = args [2]
+            for n in range(0, len(modifiers) - 1, 2):
+                if str(modifiers [n]).upper() == 'CHANGEDSINCE':
+                    changed_since = int(modifiers [n + 1])
+
+        with self.server.lock:
+            selected = mailbox.resolve(str(args [0]), by_uid)
+
+        for seq, message in selected:
+            if changed_since is not None and message.modseq <= changed_since:
+                continue
+
+            parts = []
+            seen = False
+
+            for item in items:
+                data, sets_seen = self.fetch_item(message, item)
+                parts.append(data)
+                seen = seen or sets_seen
+
+            if seen and not self.readonly and '\\Seen' not in message.flags:
+                with self.server.lock:
+                    message.flags.append('\\Seen')
+                    mailbox.highestmodseq += 1
+                    message.modseq = mailbox.highestmodseq
+                if 'FLAGS' not in [item.upper() for item in items]:
+                    parts.append(b'FLAGS (' + ' '.join(message.flags).encode() + b')')
+
+            self.send(b'* %d FETCH (' % seq + b' '.join(parts) + b')\r\n')
+
+        self.complete(tag, 'OK', 'FETCH completed')
+
+    #----------------------------------------------------------------
+    def fetch_item(self, message, item):
+        """
+            Render a single FETCH data item.  Returns a tuple of the
+            response data and whether fetching it sets \\Seen.
+        """
+
+        name = item.upper()
+
+        if name == 'UID':
+            return b'UID %d' % message.uid, False
+        elif name == 'FLAGS':
+            return b'FLAGS (' + ' '.join(message.flags).encode() + b')', False
+        elif name == 'RFC822.SIZE':
+            return b'RFC822.SIZE %d' % len(message.raw), False
+        elif name == 'INTERNALDATE':
+            return b'INTERNALDATE "' + message.internaldate.strftime(INTERNALDATE_FORMAT).encode() + b'"', False
+        elif name == 'MODSEQ':
+            return b'MODSEQ (%d)' % message.modseq, False
+        elif name in ('X-GM-MSGID', 'X-GM-THRID', 'X-GM-LABELS') and \
+                'X-GM-EXT-1' in self.server.capabilities:
+            if name == 'X-GM-LABELS':
+                return b'X-GM-LABELS (' + ' '.join(_quote(label) for label in message.labels).encode() + b')', False
+            # Every message is the first of its own thread.
+            return name.encode() + b' %d' % message.message_id, False
+        elif name == 'RFC822':
+            return _literal(b'RFC822', message.raw), True
+        elif name == 'RFC822.HEADER':
+            return _literal(b'RFC822.HEADER', message.get_header()), False
+        elif name == 'RFC822.TEXT':
+            return _literal(b'RFC822.TEXT', message.get_text()), True
+
+        m = _BODY_SECTION_RE.match(item)
+        if m is None:
+            raise BadCommand('Unsupported FETCH item %s' % item)
+
+        peek, section, offset, length = m.groups()
+        section_name = section.upper()
+
+        if section_name == '':
+            data = message.raw
+        elif section_name == 'HEADER':
+            data = message.get_header()
+        elif section_name == 'TEXT':
+            data = message.get_text()
+        elif section_name.startswith('HEADER.FIELDS'):
+            names = section_name.split('(', 1)[-1].rstrip(')').split()
+            data = _header_fields(message.get_header(), names,
+                    exclude = section_name.startswith('HEADER.FIELDS.NOT'))
+        elif re.match(r'^\d+(\.\d+)*$', section_name):
+            data = message.get_section(section_name)
+        else:
+            raise BadCommand('Unsupported section %s' % section)
+
+        key = 'BODY[%s]' % section
+        if offset is not None:
+            offset = int(offset)
+            data = data [offset:]
+            if length is not None:
+                data = data [:int(length)]
+            key += '<%d>' % offset
+
+        return _literal(key.encode(), data), peek is None
+
+    #----------------------------------------------------------------
+    def do_STORE(self, tag, args, by_uid):
+        mailbox = self.require_mailbox()
+        if self.readonly:
+            self.complete(tag, 'NO', 'Mailbox is read-only')
+            return
+
+        sequence_set, args = str(args [0]), args [1:]
+
+        unchanged_since = None
+        if isinstance(args [0], list):
+            modifiers, args = args [0], args [1:]
+            for n in range(0, len(modifiers) - 1, 2):
+                if str(modifiers [n]).upper() == 'UNCHANGEDSINCE':
+                    unchanged_since = int(modifiers [n + 1])
+
+        action = str(args [0]).upper()
+        flags = args [1] if len(args) == 2 and isinstance(args [1], list) else args [1:]
+        flags = [_string(flag) for flag in flags]
+
+        silent = action.endswith('.SILENT')
+        action = action [:-len('.SILENT')] if silent else action
+        if action not in ('FLAGS', '+FLAGS', '-FLAGS'):
+            raise BadCommand('Invalid STORE action %s' % action)
+
+        modified = []
+        changed = []
+
+        with self.server.lock:
+            for seq, message in mailbox.resolve(sequence_set, by_uid):
+                if unchanged_since is not None and message.modseq > unchanged_since:
+                    modified.append(message.uid if by_uid else seq)
+                    continue
+
+                if action == 'FLAGS':
+                    new_flags = list(flags)
+                elif action == '+FLAGS':
+                    new_flags = message.flags + [flag for flag in flags if flag not in message.flags]
+                else:
+                    new_flags = [flag for flag in message.flags if flag not in flags]
+
+                if new_flags != message.flags:
+                    message.flags = new_flags
+                    mailbox.highestmodseq += 1
+                    message.modseq = mailbox.highestmodseq
+                    changed.append((seq, message))
+
+            for seq, message in changed:
+                self.server.notify(mailbox, '* %d FETCH (FLAGS (%s))' % (
+                    seq, ' '.join(message.flags)), exclude = self)
+
+        if not silent:
+            for seq, message in changed:
+                line = '* %d FETCH (FLAGS (%s)' % (seq, ' '.join(message.flags))
+                if by_uid:
+                    line += ' UID %d' % message.uid
+                if unchanged_since is not None:
+                    line += ' MODSEQ (%d)' % message.modseq
+                self.send_line(line + ')')
+
+        if modified:
+            self.complete(tag, 'OK', '[MODIFIED %s] Conditional STORE failed' %
+                    ','.join(str(n) for n in modified))
+        else:
+            self.complete(tag, 'OK', 'STORE completed')
+
+#-------------------------------------------------------------------
+class _SearchCriteria():
+    """
+        A compiled SEARCH program.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, args, mailbox, messages):
+        self.mailbox = mailbox
+        self.messages = messages
+        self.predicates = []
+
+        pos = 0
+        while pos < len(args):
+            predicate, pos = self.parse_key(args, pos)
+            self.predicates.append(predicate)
+
+    #----------------------------------------------------------------
+    def match(self, seq, message):
+        for predicate in self.predicates:
+            if not predicate(seq, message):
+                return False
+        return True
+
+    #----------------------------------------------------------------
+    def parse_key(self, args, pos):
+        arg = args [pos]
+        pos += 1
+
+        if isinstance(arg, list):
+            criteria = _SearchCriteria(arg, self.mailbox, self.messages)
+            return criteria.match, pos
+
+        key = _string(arg).upper()
+
+        flag_keys = {
+            'ANSWERED': '\\Answered', 'DELETED': '\\Deleted', 'DRAFT': '\\Draft',
+            'FLAGGED': '\\Flagged', 'SEEN': '\\Seen'
+        }
+
+        if key in ('ALL', 'OLD'):
+            return (lambda seq, message: True), pos
+        elif key == 'RECENT':
+            return (lambda seq, message: False), pos
+        elif key == 'NEW':
+            return (lambda seq, message: False), pos
+        elif key in flag_keys:
+            flag = flag_keys [key]
+            return (lambda seq, message: flag in message.flags), pos
+        elif key.startswith('UN') and key [2:] in flag_keys:
+            flag = flag_keys [key [2:]]
+            return (lambda seq, message: flag not in message.flags), pos
+        elif key in ('KEYWORD', 'UNKEYWORD'):
+            flag = _string(args [pos])
+            if key == 'KEYWORD':
+                return (lambda seq, message: flag in message.flags), pos + 1
+            return (lambda seq, message: flag not in message.flags), pos + 1
+        elif key == 'NOT':
+            predicate, pos = self.parse_key(args, pos)
+            return (lambda seq, message: not predicate(seq, message)), pos
+        elif key == 'OR':
+            first, pos = self.parse_key(args, pos)
+            second, pos = self.parse_key(args, pos)
+            return (lambda seq, message: first(seq, message) or second(seq, message)), pos
+        elif key in ('BCC', 'CC', 'FROM', 'TO', 'SUBJECT'):
+            return _header_contains(key, _string(args [pos])), pos + 1
+        elif key == 'HEADER':
+            return _header_contains(_string(args [pos]), _string(args [pos + 1])), pos + 2
+        elif key == 'BODY':
+            needle = _string(args [pos]).lower().encode('utf-8')
+            return (lambda seq, message: needle in message.get_text().lower()), pos + 1
+        elif key == 'TEXT':
+            needle = _string(args [pos]).lower().encode('utf-8')
+            return (lambda seq, message: needle in message.raw.lower()), pos + 1
+        elif key in ('LARGER', 'SMALLER'):
+            size = int(_string(args [pos]))
+            if key == 'LARGER':
+                return (lambda seq, message: len(message.raw) > size), pos + 1
+            return (lambda seq, message: len(message.raw) < size), pos + 1
+        elif key in ('BEFORE', 'ON', 'SINCE'):
+            return _date_compare(key, _string(args [pos]),
+                    lambda message: message.internaldate.date()), pos + 1
+        elif key in ('SENTBEFORE', 'SENTON', 'SENTSINCE'):
+            return _date_compare(key [4:], _string(args [pos]), _sent_date), pos + 1
+        elif key == 'MODSEQ':
+            modseq = int(_string(args [pos]))
+            return (lambda seq, message: message.modseq >= modseq), pos + 1
+        elif key == 'UID':
+            uids = set(message.uid for seq, message in self.mailbox.resolve(_string(args [pos]), True))
+            return (lambda seq, message: message.uid in uids), pos + 1
+        elif re.match(r'^[\d*:,]+$', key):
+            seqs = set(seq for seq, message in self.mailbox.resolve(key, False))
+            return (lambda seq, message: seq in seqs), pos
+
+        raise BadCommand('Unsupported search key %s' % key)
+
+#-------------------------------------------------------------------
+def _header_contains(name, needle):
+    needle = needle.lower()
+
+    def predicate(seq, message):
+        return any(needle in str(value).lower()
+                   for value in message.get_headers().get_all(name, []))
+
+    return predicate
+
+#-------------------------------------------------------------------
+def _sent_date(message):
+    date = email.utils.parsedate_tz(message.get_headers().get('Date', ''))
+    if date is None:
+        return message.internaldate.date()
+    return datetime.date(*date [:3])
+
+#-------------------------------------------------------------------
+def _date_compare(key, value, get_date):
+    date = datetime.datetime.strptime(value, '%d-%b-%Y').date()
+
+    if key == 'BEFORE':
+        return lambda seq, message: get_date(message) < date
+    elif key == 'ON':
+        return lambda seq, message: get_date(message) == date
+    return lambda seq, message: get_date(message) >= date
+
+#-------------------------------------------------------------------
+def _header_fields(header, names, exclude = False):
+    names = set(name.upper() for name in names)
+    lines = []
+    keep = False
+
+    for line in header.split(b'\r\n'):
+        if not line:
+            continue
+        if line [:1] not in (b' ', b'\t'):
+            name = line.split(b':', 1)[0].decode('ascii', 'replace').strip().upper()
+            keep = (name in names) != exclude
+        if keep:
+            lines.append(line + b'\r\n')
+
+    return b''.join(lines) + b'\r\n'
+
+#-------------------------------------------------------------------
+def _literal(key, data):
+    return key + b' {%d}\r\n' % len(data) + data
+
+#-------------------------------------------------------------------
+def _sequence_set(numbers):
+    ranges = []
+
+    for n in numbers:
+        if ranges and n == ranges [-1][1] + 1:
+            ranges [-1][1] = n
+        else:
+            ranges.append([n, n])
+
+    return ','.join(str(first) if first == last else '%d:%d' % (first, last)
+                    for first, last in ranges)
+
+#-------------------------------------------------------------------
+def _quote(s):
+    return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
+
+#-------------------------------------------------------------------
+def _string(token):
+    if isinstance(token, bytes):
+        return token.decode('utf-8', 'replace')
+    return str(token)
+
+#-------------------------------------------------------------------
+def _tokenize(data):
+    tokens = []
+
+    for m in _TOKEN_RE.finditer(data.decode('utf-8', 'surrogateescape')):
+        if m.group('open') is not None:
+            tokens.append(_OPEN)
+        elif m.group('close') is not None:
+            tokens.append(_CLOSE)
+        elif m.group('quoted') is not None:
+            tokens.append(re.sub(r'\\(.)', r'\1', m.group('quoted')))
+        elif m.group('atom') is not None:
+            tokens.append(m.group('atom'))
+
+    return tokens
+
+#-------------------------------------------------------------------
+def _nest(tokens, pos):
+    values = []
+
+    while pos < len(tokens):
+        token = tokens [pos]
+        pos += 1
+
+        if token is _CLOSE:
+            break
+        elif token is _OPEN:
+            value, pos = _nest(tokens, pos)
+            values.append(value)
+        else:
+            values.append(token)
+
+    return values, pos
+
+#-------------------------------------------------------------------
+# Synthetic messages
+#-------------------------------------------------------------------
+_FIRST_NAMES = ['Alice', 'Bob', 'Carol', 'Dave', 'Erin', 'Frank', 'Grace',
+                'Heidi', 'Ivan', 'Judy', 'Mallory', 'Niaj', 'Olivia',
+                'Peggy', 'Rupert', 'Sybil', 'Trent', 'Victor', 'Walter',
+                'Zoë', 'José', 'Łukasz']
+
+_LAST_NAMES = ['Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson',
+               'Johnson', 'Davies', 'Robinson', 'Wright', 'Thompson',
+               'Evans', 'Walker', 'White', 'Roberts', 'Green', 'Müller']
+
+_DOMAINS = ['example.com', 'example.org', 'example.net', 'mail.example.com',
+            'lists.example.org']
+
+_WORDS = ('the of and to in is that for it as was with be by on not he this '
+          'are or his from at which but have an they you were her she there '
+          'report meeting budget release schedule review draft invoice '
+          'project deadline update question proposal server backup quarterly '
+          'agenda notes summary feedback design launch contract travel').split()
+
+_ATTACHMENT_TYPES = [
+    ('application/pdf', 'pdf'),
+    ('image/png', 'png'),
+    ('image/jpeg', 'jpg'),
+    ('application/zip', 'zip'),
+    ('text/csv', 'csv')
+]
+
+#-------------------------------------------------------------------
+def generate_messages(count, seed = 0, start = None,
+                      html_ratio = 0.4, attachment_ratio = 0.05,
+                      attachment_size = 16384, reply_ratio = 0.4,
+                      seen_ratio = 0.7):
+    """
+        Generate count synthetic messages with realistic MIME
+        structure: plain text, multipart/alternative with HTML, and
+        multipart/mixed with base64 attachments, with encoded
+        headers, replies threaded by References, and a mix of flags.
+        The same seed always produces the same messages.
+
+        Yields (raw, flags, internaldate) tuples, oldest first, with
+        CRLF line endings as a server would send them.
+    """
+
+    rng = random.Random(seed)
+
+    if start is None:
+        start = datetime.datetime(2020, 1, 1, tzinfo = datetime.timezone.utc)
+
+    people = ['%s %s' % (first, last) for first in _FIRST_NAMES for last in _LAST_NAMES]
+    date = start
+    recent = []
+
+    for n in range(count):
+        date += datetime.timedelta(seconds = rng.randint(30, 7200))
+
+        sender = rng.choice(people)
+        recipients = rng.sample(people, rng.randint(1, 3))
+        message_id = '<%d.%d@%s>' % (seed, n, rng.choice(_DOMAINS))
+
+        headers = [
+            ('Date', email.utils.format_datetime(date)),
+            ('From', _address(sender)),
+            ('To', ', '.join(_address(name) for name in recipients)),
+            ('Message-ID', message_id)
+        ]
+
+        if rng.random() < 0.2:
+            headers.append(('Cc', _address(rng.choice(people))))
+
+        if recent and rng.random() < reply_ratio:
+            parent_id, parent_refs, subject = rng.choice(recent)
+            refs = (parent_refs + [parent_id]) [-10:]
+            headers.append(('Subject', _encode_header('Re: ' + subject)))
+            headers.append(('In-Reply-To', parent_id))
+            headers.append(('References', ' '.join(refs)))
+        else:
+            refs = []
+            subject = ' '.join(rng.choice(_WORDS) for x in range(rng.randint(2, 8))).capitalize()
+            if rng.random() < 0.1:
+                subject += ' ' + rng.choice(_FIRST_NAMES)
+            headers.append(('Subject', _encode_header(subject)))
+
+        recent.append((message_id, refs, subject))
+        if len(recent) > 200:
+            recent.pop(0)
+
+        headers.append(('MIME-Version', '1.0'))
+
+        text = _paragraphs(rng)
+        if rng.random() < html_ratio:
+            body = _alternative(rng, text)
+        else:
+            body = _text_part(text)
+
+        if rng.random() < attachment_ratio:
+            body = _mixed(rng, body, attachment_size)
+
+        raw = ''.join('%s: %s\r\n' % header for header in headers).encode('utf-8') + body
+
+        flags = []
+        if rng.random() < seen_ratio:
+            flags.append('\\Seen')
+            if rng.random() < 0.2:
+                flags.append('\\Answered')
+        if rng.random() < 0.05:
+            flags.append('\\Flagged')
+
+        yield raw, flags, date
+
+#-------------------------------------------------------------------
+def _address(name):
+    local = name.split()[0].lower().encode('ascii', 'ignore').decode() or 'user'
+    domain = _DOMAINS [len(name) % len(_DOMAINS)]
+    return '%s <%s@%s>' % (_encode_header(name), local, domain)
+
+#-------------------------------------------------------------------
+def _encode_header(value):
+    try:
+        value.encode('ascii')
+        return value
+    except UnicodeEncodeError:
+        return '=?utf-8?b?%s?=' % base64.b64encode(value.encode('utf-8')).decode()
+
+#-------------------------------------------------------------------
+def _paragraphs(rng):
+    paragraphs = []
+
+    for p in range(rng.randint(1, 6)):
+        words = [rng.choice(_WORDS) for x in range(rng.randint(10, 80))]
+        lines = []
+        for i in range(0, len(words), 12):
+            lines.append(' '.join(words [i:i + 12]))
+        paragraphs.append('\r\n'.join(lines).capitalize() + '.')
+
+    return '\r\n\r\n'.join(paragraphs)
+
+#-------------------------------------------------------------------
+def _text_part(text):
+    return (b'Content-Type: text/plain; charset="utf-8"\r\n'
+            b'Content-Transfer-Encoding: 7bit\r\n\r\n' + text.encode('utf-8') + b'\r\n')
+
+#-------------------------------------------------------------------
+def _alternative(rng, text):
+    boundary = '=_alt_%016x' % rng.getrandbits(64)
+    html = '<html><body>%s</body></html>' % ''.join(
+            '<p>%s</p>' % p.replace('\r\n', ' ') for p in text.split('\r\n\r\n'))
+
+    return ('Content-Type: multipart/alternative; boundary="%s"\r\n\r\n'
+            '--%s\r\n'
+            'Content-Type: text/plain; charset="utf-8"\r\n'
+            'Content-Transfer-Encoding: 7bit\r\n\r\n'
+            '%s\r\n'
+            '--%s\r\n'
+            'Content-Type: text/html; charset="utf-8"\r\n'
+            'Content-Transfer-Encoding: quoted-printable\r\n\r\n'
+            '%s\r\n'
+            '--%s--\r\n' % (boundary, boundary, text, boundary,
+                            _quoted_printable(html), boundary)).encode('utf-8')
+
+#-------------------------------------------------------------------
+def _quoted_printable(text):
+    lines = []
+    text = text.replace('=', '=3D')
+
+    while len(text) > 75:
+        lines.append(text [:75] + '=')
+        text = text [75:]
+    lines.append(text)
+
+    return '\r\n'.join(lines)
+
+#-------------------------------------------------------------------
+def _mixed(rng, body, attachment_size):
+    boundary = '=_mixed_%016x' % rng.getrandbits(64)
+    content_type, ext = rng.choice(_ATTACHMENT_TYPES)
+    size = rng.randint(attachment_size // 4, attachment_size * 2)
+    data = base64.encodebytes(rng.getrandbits(size * 8).to_bytes(size, 'little'))
+    filename = '%s-%d.%s' % (rng.choice(_WORDS), rng.randint(1, 999), ext)
+
+    # The body, with its own content headers, becomes the first part.
+    return (b'Content-Type: multipart/mixed; boundary="' + boundary.encode() + b'"\r\n\r\n' +
+            b'--' + boundary.encode() + b'\r\n' + body + b'\r\n' +
+            b'--' + boundary.encode() + b'\r\n' +
+            b'Content-Type: ' + content_type.encode() + b'; name="' + filename.encode() + b'"\r\n' +
+            b'Content-Disposition: attachment; filename="' + filename.encode() + b'"\r\n' +
+            b'Content-Transfer-Encoding: base64\r\n\r\n' +
+            data.replace(b'\n', b'\r\n') +
+            b'--' + boundary.encode() + b'--\r\n')
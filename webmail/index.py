@@ -0,0 +1,230 @@
+#-------------------------------------------------------------------
+# webmail.index
+#
+# A local index of message headers and flags, so that listings
+# and notifications can be produced without refetching headers.
+#-------------------------------------------------------------------
+
+import email.utils
+import json
+import sqlite3
+
+import pyzmail
+
+#-------------------------------------------------------------------
+INDEX_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS headers (
+        mailbox         TEXT NOT NULL,
+        uidvalidity     INTEGER NOT NULL,
+        uid             INTEGER NOT NULL,
+        flags           TEXT NOT NULL,
+        size            INTEGER NOT NULL,
+        date            INTEGER,
+        sender_name     TEXT,
+        sender_addr     TEXT,
+        recipients      TEXT,
+        subject         TEXT,
+        message_id      TEXT,
+        in_reply_to     TEXT,
+        refs            TEXT,
+        gm_msgid        INTEGER,
+        gm_thrid        INTEGER,
+        gm_labels       TEXT,
+        PRIMARY KEY (mailbox, uidvalidity, uid)
+    );
+"""
+
+INDEX_FIELDS = ['uid', 'flags', 'size', 'date', 'sender_name',
+                'sender_addr', 'recipients', 'subject', 'message_id',
+                'in_reply_to', 'refs', 'gm_msgid', 'gm_thrid', 'gm_labels']
+
+# Columns added since the index was first created, which are added
+# to existing indexes when opened.
+ADDED_COLUMNS = [
+    ('gm_msgid',    'INTEGER'),
+    ('gm_thrid',    'INTEGER'),
+    ('gm_labels',   'TEXT')
+]
+
+#-------------------------------------------------------------------
+def header_record(summary):
+    """
+        Build an index record from a message summary, as yielded
+        by MailClient.fetch_summaries().
+    """
+
+    message = pyzmail.PyzMessage.factory(summary ['header'])
+
+    sender_name, sender_addr = message.get_address('from')
+    recipients = ', '.join(addr for name, addr in
+            message.get_addresses('to') + message.get_addresses('cc'))
+
+    date = None
+    date_ts = email.utils.parsedate_tz(message.get_decoded_header('Date'))
+    if date_ts is not None:
+        date = email.utils.mktime_tz(date_ts)
+
+    # Gmail labels may contain spaces, so are kept as a JSON list.
+    labels = summary.get('gm_labels')
+    if labels is not None:
+        labels = json.dumps(labels)
+
+    return {
+        'uid':          summary ['uid'],
+        'flags':        ' '.join(summary ['flags']),
+        'size':         summary ['size'],
+        'date':         date,
+        'sender_name':  sender_name,
+        'sender_addr':  sender_addr,
+        'recipients':   recipients,
+        'subject':      message.get_subject(),
+        'message_id':   message.get_decoded_header('Message-ID').strip(),
+        'in_reply_to':  message.get_decoded_header('In-Reply-To').strip(),
+        'refs':         ' '.join(message.get_decoded_header('References').split()),
+        'gm_msgid':     summary.get('gm_msgid'),
+        'gm_thrid':     summary.get('gm_thrid'),
+        'gm_labels':    labels
+    }
+
+#-------------------------------------------------------------------
+class HeaderIndex():
+    """
+        An index of message headers and flags stored in an SQLite
+        database, keyed by mailbox, UIDVALIDITY and UID.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, filename = ':memory:'):
+        self.db = sqlite3.connect(filename, timeout = 30)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(INDEX_SCHEMA)
+
+        columns = set(row ['name'] for row in self.db.execute("PRAGMA table_info(headers)"))
+        for name, column_type in ADDED_COLUMNS:
+            if name not in columns:
+                self.db.execute("ALTER TABLE headers ADD COLUMN %s %s" % (name, column_type))
+        self.db.commit()
+
+    #----------------------------------------------------------------
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    #----------------------------------------------------------------
+    def get(self, mailbox, uidvalidity, uid):
+        """
+            Get the record for the given message, or None if the
+            message is not in the index.
+        """
+
+        return self.get_many(mailbox, uidvalidity, [uid]).get(int(uid))
+
+    #----------------------------------------------------------------
+    def get_many(self, mailbox, uidvalidity, uids):
+        """
+            Get the records for the given messages.  Returns a
+            dictionary mapping integer UIDs to records.
+        """
+
+        records = {}
+        uids = [int(uid) for uid in uids]
+
+        for n in range(0, len(uids), 500):
+            chunk = uids[n:n + 500]
+            cursor = self.db.execute(
+                    "SELECT %s FROM headers WHERE mailbox = ? AND uidvalidity = ? AND uid IN (%s)" % (
+                        ', '.join(INDEX_FIELDS), ', '.join('?' * len(chunk))),
+                    [mailbox, uidvalidity] + chunk)
+
+            for row in cursor:
+                records [row['uid']] = dict(row)
+
+        return records
+
+    #----------------------------------------------------------------
+    def update(self, mailbox, uidvalidity, records):
+        """
+            Insert or replace the given records in the index.
+        """
+
+        self.db.executemany(
+                "INSERT OR REPLACE INTO headers (mailbox, uidvalidity, %s) VALUES (?, ?, %s)" % (
+                    ', '.join(INDEX_FIELDS), ', '.join('?' * len(INDEX_FIELDS))),
+                ([mailbox, uidvalidity] + [record[field] for field in INDEX_FIELDS]
+                    for record in records))
+        self.db.commit()
+
+    #----------------------------------------------------------------
+    def set_flags(self, mailbox, uidvalidity, uid, flags):
+        """
+            Replace the flags of a message in the index.
+        """
+
+        self.db.execute(
+                "UPDATE headers SET flags = ? WHERE mailbox = ? AND uidvalidity = ? AND uid = ?",
+                (' '.join(flags), mailbox, uidvalidity, int(uid)))
+        self.db.commit()
+
+    #----------------------------------------------------------------
+    def update_flags(self, mailbox, uidvalidity, uids, flags, add = True):
+        """
+            Add or remove flags on the given messages in the index.
+        """
+
+        records = self.get_many(mailbox, uidvalidity, uids)
+        rows = []
+
+        for uid, record in records.items():
+            current = record['flags'].split()
+            if add:
+                current.extend(flag for flag in flags if flag not in current)
+            else:
+                current = [flag for flag in current if flag not in flags]
+            rows.append((' '.join(current), mailbox, uidvalidity, uid))
+
+        self.db.executemany(
+                "UPDATE headers SET flags = ? WHERE mailbox = ? AND uidvalidity = ? AND uid = ?",
+                rows)
+        self.db.commit()
+
+    #----------------------------------------------------------------
+    def remove(self, mailbox, uidvalidity, uids):
+        """
+            Remove the given messages from the index.
+        """
+
+        self.db.executemany(
+                "DELETE FROM headers WHERE mailbox = ? AND uidvalidity = ? AND uid = ?",
+                ((mailbox, uidvalidity, int(uid)) for uid in uids))
+        self.db.commit()
+
+    #----------------------------------------------------------------
+    def relocate(self, mailbox, uidvalidity, uid_map,
+                 new_mailbox, new_uidvalidity, keep = False):
+        """
+            Copy the records of messages moved or copied to another
+            mailbox, where uid_map maps each UID to its new UID.  Unless
+            keep is set, the original records are removed.
+        """
+
+        records = self.get_many(mailbox, uidvalidity, uid_map.keys())
+
+        for uid, record in records.items():
+            record ['uid'] = uid_map [uid]
+
+        self.update(new_mailbox, new_uidvalidity, records.values())
+        if not keep:
+            self.remove(mailbox, uidvalidity, records.keys())
+
+    #----------------------------------------------------------------
+    def purge_stale(self, mailbox, uidvalidity):
+        """
+            Remove all records for the mailbox which were indexed
+            under a different UIDVALIDITY, as their UIDs no longer
+            refer to the same messages.
+        """
+
+        self.db.execute(
+                "DELETE FROM headers WHERE mailbox = ? AND uidvalidity != ?",
+                (mailbox, uidvalidity))
+        self.db.commit()
@@ -0,0 +1,315 @@
+#-------------------------------------------------------------------
+# webmail.mime
+#
+# A lightweight MIME structure scanner, which records the offsets
+# of each part in a raw message and decodes parts only on demand.
+#-------------------------------------------------------------------
+
+import binascii
+import email
+import email.parser
+import quopri
+
+import pyzmail
+import pyzmail.parse
+
+#-------------------------------------------------------------------
+_HEADER_PARSER = email.parser.BytesHeaderParser()
+
+# The number of undecoded bytes processed at a time when streaming
+# a part payload to a file.
+CHUNK_SIZE = 1024 * 1024
+
+# Every byte outside the base64 alphabet, which decoders ignore.
+_BASE64_JUNK = bytes(set(range(256)) - set(
+        b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='))
+
+#-------------------------------------------------------------------
+def find_header_end(buf, start, end):
+    """
+        Find the end of the header block beginning at start.
+        Returns a tuple of (header_end, body_start), where header_end
+        is the offset just past the last header line.
+    """
+
+    if buf[start:start + 2] == b'\r\n':
+        return start, start + 2
+    elif buf[start:start + 1] == b'\n':
+        return start, start + 1
+
+    # Messages from IMAP use CRLF, so once the CRLF separator is found,
+    # only the headers before it are searched for a bare LF separator,
+    # rather than the rest of the message.
+    crlf = buf.find(b'\r\n\r\n', start, end)
+    lf = buf.find(b'\n\n', start, crlf + 4 if crlf >= 0 else end)
+
+    if crlf >= 0 and (lf < 0 or crlf <= lf):
+        return crlf + 2, crlf + 4
+    elif lf >= 0:
+        return lf + 1, lf + 2
+
+    return end, end
+
+#-------------------------------------------------------------------
+def decode_base64(data):
+    """
+        Decode a base64 body, ignoring bytes outside the alphabet and
+        missing padding at the end.
+    """
+
+    data = data.translate(None, _BASE64_JUNK)
+
+    # A single leftover character holds less than a byte.
+    if len(data) % 4 == 1:
+        data = data[:-1]
+
+    try:
+        return binascii.a2b_base64(data + b'=' * (-len(data) % 4))
+    except binascii.Error:
+        # Let the email package deal with broken padding.
+        message = email.message_from_bytes(b'Content-Transfer-Encoding: base64\n\n' + data)
+        return message.get_payload(decode = True)
+
+#-------------------------------------------------------------------
+def scan_message(buf, start = 0, end = None, offsets = None):
+    """
+        Scan the MIME structure of a raw message without decoding
+        any part bodies.
+
+        Returns a tuple of (skeleton, offsets).  The skeleton is an
+        email.message.Message tree with the headers of every part
+        but no leaf payloads, and offsets maps the id() of each
+        leaf in the skeleton to the (start, end) of its body in buf.
+    """
+
+    if end is None:
+        end = len(buf)
+    if offsets is None:
+        offsets = {}
+
+    header_end, body_start = find_header_end(buf, start, end)
+    part = _HEADER_PARSER.parsebytes(bytes(buf[start:header_end]))
+    boundary = part.get_boundary()
+
+    if part.get_content_maintype() == 'multipart' and boundary:
+        part.set_payload([])
+
+        for child_start, child_end in _scan_boundaries(
+                buf, boundary.encode('ascii', 'replace'), body_start, end):
+            child, offsets = scan_message(buf, child_start, child_end, offsets)
+            part.attach(child)
+
+    else:
+        part.set_payload('')
+        offsets[id(part)] = (body_start, end)
+
+    return part, offsets
+
+#-------------------------------------------------------------------
+def _scan_boundaries(buf, boundary, start, end):
+    delimiter = b'--' + boundary
+    size = len(delimiter)
+
+    if buf[start:start + size] == delimiter:
+        pos = start
+    else:
+        pos = _find_delimiter(buf, delimiter, start, end)
+
+    while pos >= 0:
+        if buf[pos + size:pos + size + 2] == b'--':
+            break
+
+        line_end = buf.find(b'\n', pos, end)
+        if line_end < 0:
+            break
+
+        part_start = line_end + 1
+        next_pos = _find_delimiter(buf, delimiter, part_start, end)
+
+        if next_pos < 0:
+            part_end = end
+        else:
+            # The line break before a delimiter belongs to the delimiter.
+            part_end = next_pos - 1
+            if part_end > part_start and buf[part_end - 1:part_end] == b'\r':
+                part_end -= 1
+
+        yield part_start, max(part_start, part_end)
+        pos = next_pos
+
+#-------------------------------------------------------------------
+def _find_delimiter(buf, delimiter, start, end):
+    pos = start
+
+    while True:
+        n = buf.find(b'\n' + delimiter, pos, end)
+        if n < 0:
+            return -1
+
+        n += 1
+        following = buf[n + len(delimiter):n + len(delimiter) + 1]
+        if following in (b'', b'\r', b'\n', b' ', b'\t', b'-'):
+            return n
+
+        pos = n
+
+#-------------------------------------------------------------------
+class LazyMailPart(pyzmail.parse.MailPart):
+    """
+        A mailpart whose payload is decoded from the underlying
+        message buffer only when requested.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, mailpart, buf, start, end):
+        self.__dict__.update(mailpart.__dict__)
+        self.buf = buf
+        self.start = start
+        self.end = end
+
+    #----------------------------------------------------------------
+    def get_encoding(self):
+        return self.part.get('Content-Transfer-Encoding', '7bit').strip().lower()
+
+    #----------------------------------------------------------------
+    def get_raw_payload(self):
+        """
+            Get the undecoded body of the part.
+        """
+
+        return bytes(self.buf[self.start:self.end])
+
+    #----------------------------------------------------------------
+    def iter_payload(self, chunk_size = CHUNK_SIZE):
+        """
+            Decode the payload incrementally, yielding decoded chunks
+            for at most chunk_size undecoded bytes at a time, so that
+            memory use does not depend on the size of the part.
+        """
+
+        encoding = self.get_encoding()
+        if self.type.startswith('message/'):
+            encoding = '8bit'
+
+        pending = b''
+
+        for pos in range(self.start, self.end, chunk_size):
+            chunk = pending + bytes(self.buf[pos:min(pos + chunk_size, self.end)])
+
+            if encoding == 'base64':
+                # Drop line breaks and any stray bytes before splitting
+                # into whole 4 byte groups, so that a stray byte does
+                # not shift every group after it.
+                chunk = chunk.translate(None, _BASE64_JUNK)
+                n = len(chunk) - len(chunk) % 4
+                chunk, pending = chunk[:n], chunk[n:]
+                if chunk:
+                    yield decode_base64(chunk)
+
+            elif encoding == 'quoted-printable':
+                # Only decode complete lines, as soft line breaks and
+                # escapes may be split across chunks.
+                n = chunk.rfind(b'\n') + 1
+                chunk, pending = chunk[:n], chunk[n:]
+                if chunk:
+                    yield binascii.a2b_qp(chunk)
+
+            else:
+                yield chunk
+
+        if pending:
+            if encoding == 'base64':
+                yield decode_base64(pending)
+            elif encoding == 'quoted-printable':
+                yield binascii.a2b_qp(pending)
+
+    #----------------------------------------------------------------
+    def write_payload(self, out_file, chunk_size = CHUNK_SIZE):
+        """
+            Decode the payload into the given binary file object in
+            chunks.  Returns the number of bytes written.
+        """
+
+        written = 0
+        for data in self.iter_payload(chunk_size):
+            out_file.write(data)
+            written += len(data)
+
+        return written
+
+    #----------------------------------------------------------------
+    def get_payload(self):
+        body = self.get_raw_payload()
+
+        if self.type.startswith('message/'):
+            return body
+
+        encoding = self.get_encoding()
+
+        if encoding == 'base64':
+            return decode_base64(body)
+
+        elif encoding == 'quoted-printable':
+            return quopri.decodestring(body)
+
+        return body
+
+#-------------------------------------------------------------------
+class LazyMessage():
+    """
+        A read-only view of a raw message, providing the header
+        accessors and mailparts of a PyzMessage.  Only the top-level
+        headers are parsed up front; part bodies are located by
+        scanning for MIME boundaries and decoded on demand.
+
+        The buffer may be a bytes object or an mmap of a cache file,
+        in which case the message lies between start and end.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, buf, start = 0, end = None):
+        if end is None:
+            end = len(buf)
+
+        self.buf = buf
+        self.start = start
+        self.end = end
+
+        header_end, body_start = find_header_end(buf, start, end)
+        self.headers = pyzmail.PyzMessage.factory(bytes(buf[start:header_end]))
+
+        skeleton, offsets = scan_message(buf, start, end)
+        self.mailparts = []
+
+        for mailpart in pyzmail.parse.get_mail_parts(skeleton):
+            part_start, part_end = offsets.get(id(mailpart.part), (body_start, body_start))
+            self.mailparts.append(LazyMailPart(mailpart, buf, part_start, part_end))
+
+    #----------------------------------------------------------------
+    def close(self):
+        """
+            Release the underlying buffer, closing it if it is an mmap.
+        """
+
+        if hasattr(self.buf, 'close'):
+            self.buf.close()
+
+    #----------------------------------------------------------------
+    def get_address(self, name):
+        return self.headers.get_address(name)
+
+    #----------------------------------------------------------------
+    def get_addresses(self, name):
+        return self.headers.get_addresses(name)
+
+    #----------------------------------------------------------------
+    def get_subject(self, default = ''):
+        return self.headers.get_subject(default)
+
+    #----------------------------------------------------------------
+    def get_decoded_header(self, name, default = ''):
+        return self.headers.get_decoded_header(name, default)
+
+    #----------------------------------------------------------------
+    def as_bytes(self):
+        return bytes(self.buf[self.start:self.end])
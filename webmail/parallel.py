@@ -0,0 +1,179 @@
+#-------------------------------------------------------------------
+# webmail.parallel
+#
+# A pool of worker processes which parse raw messages into index
+# records, text and attachment metadata, for bulk operations that
+# would otherwise be bound to a single core.
+#-------------------------------------------------------------------
+
+import multiprocessing
+import os
+
+from .cache import MailCache, MailCacheException
+from .index import header_record
+from .mime import LazyMessage, find_header_end
+
+#-------------------------------------------------------------------
+# The number of messages sent to a worker at a time.  Larger chunks
+# reduce the overhead of passing work between processes.
+CHUNK_SIZE = 64
+
+# The cache read by each worker process, see _init_worker().
+_worker_cache = None
+
+#-------------------------------------------------------------------
+def parse_message(uid, raw_message, flags = (), include_text = False):
+    """
+        Parse a raw message into a compact dictionary, holding the
+        fields of its header index record (see header_record()) and:
+
+            attachments:
+                A list of (filename, type, size) tuples, where size is
+                that of the encoded part.
+            text:
+                The decoded text/plain body, if include_text is set.
+    """
+
+    header_end, body_start = find_header_end(raw_message, 0, len(raw_message))
+
+    result = header_record({
+        'uid':      int(uid),
+        'flags':    list(flags),
+        'size':     len(raw_message),
+        'header':   raw_message[:header_end]
+    })
+
+    message = LazyMessage(raw_message)
+    attachments = []
+    text = []
+
+    for mailpart in message.mailparts:
+        if mailpart.is_body is None or mailpart.filename:
+            attachments.append((mailpart.filename, mailpart.type,
+                                mailpart.end - mailpart.start))
+
+        elif include_text and mailpart.is_body == 'text/plain':
+            text.append(mailpart.get_payload().decode(
+                mailpart.charset or 'us-ascii', 'replace'))
+
+    result ['attachments'] = attachments
+    if include_text:
+        result ['text'] = '\n'.join(text)
+
+    return result
+
+#-------------------------------------------------------------------
+def _init_worker(cache_directory):
+    global _worker_cache
+
+    if cache_directory is not None:
+        _worker_cache = MailCache(cache_directory)
+
+#-------------------------------------------------------------------
+def _parse_item(item):
+    key, uid, raw_message, flags, include_text = item
+
+    if raw_message is None:
+        # Read from the cache without recording an access, as the
+        # access index belongs to the parent process.
+        try:
+            data = _worker_cache.read(key)
+            raw_message = _worker_cache.decode(data) if data is not None else None
+        except MailCacheException:
+            raw_message = None
+
+        if raw_message is None:
+            return key, None
+
+    try:
+        return key, parse_message(uid, raw_message, flags, include_text)
+    except Exception:
+        return key, None
+
+#-------------------------------------------------------------------
+class ParsePool():
+    """
+        Parses messages in a pool of worker processes.  Results are
+        yielded as soon as they are ready, which is not necessarily
+        in the order the messages were given.
+
+        processes:
+            The number of worker processes.  Defaults to the number
+            of CPUs.  With 1, messages are parsed in this process.
+        cache_directory:
+            The cache directory, if messages are to be read from the
+            cache by the workers with parse_cached().
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, processes = None, cache_directory = None,
+                 chunk_size = CHUNK_SIZE):
+        if processes is None:
+            processes = os.cpu_count() or 1
+
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.pool = None
+
+        if processes > 1:
+            self.pool = multiprocessing.Pool(processes,
+                    initializer = _init_worker, initargs = (cache_directory,))
+        else:
+            _init_worker(cache_directory)
+
+    #----------------------------------------------------------------
+    def __enter__(self):
+        return self
+
+    #----------------------------------------------------------------
+    def __exit__(self, *args):
+        self.close()
+
+    #----------------------------------------------------------------
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    #----------------------------------------------------------------
+    def map(self, items):
+        if self.pool is None:
+            return map(_parse_item, items)
+
+        return self.pool.imap_unordered(_parse_item, items, self.chunk_size)
+
+    #----------------------------------------------------------------
+    def parse(self, messages, include_text = False):
+        """
+            Parse raw messages, given as an iterable of (uid, raw, flags)
+            tuples.  Yields a (uid, result) tuple for each, where result
+            is as for parse_message(), or None if it could not be parsed.
+        """
+
+        return self.map((uid, uid, raw, flags, include_text)
+                for uid, raw, flags in messages)
+
+    #----------------------------------------------------------------
+    def parse_cached(self, keys, flags = None, include_text = False, uids = None):
+        """
+            Parse messages in the cache, which are read by the worker
+            processes so that only the results are passed back.
+
+            keys:
+                The cache keys of the messages.
+            flags:
+                An optional dictionary mapping keys to the IMAP flags
+                of each message.
+            uids:
+                An optional dictionary mapping keys to the UID of each
+                message, for keys which are not UIDs themselves, e.g.
+                the X-GM-MSGID keys used on Gmail.
+
+            Yields (key, result) tuples as for parse().
+        """
+
+        flags = flags or {}
+        uids = uids or {}
+        return self.map((key, uids.get(key, key), None, flags.get(key, ()), include_text)
+                for key in keys)
@@ -0,0 +1,494 @@
+#-------------------------------------------------------------------
+# webmail.sender
+#
+# Sending mail over SMTP, with a persistent pipelined session and
+# an on-disk outbox from which queued messages are sent in batches.
+#-------------------------------------------------------------------
+
+import email.parser
+import email.utils
+import json
+import os
+import random
+import re
+import smtplib
+import time
+
+#-------------------------------------------------------------------
+# The number of times a message is attempted before it is moved to
+# the failed directory of the outbox, and the initial and maximum
+# delays in seconds before retrying, which double with each attempt.
+SEND_ATTEMPTS = 10
+RETRY_DELAY = 60.0
+RETRY_MAX_DELAY = 3600.0
+
+# Seconds after which a message claimed for sending by a process
+# that has since died is returned to the queue.
+STALE_CLAIM_AGE = 3600
+
+# Errors after which the SMTP session is assumed lost.
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, OSError)
+
+_CRLF = b'\r\n'
+
+# Line endings to be normalized to CRLF in a message sent over SMTP.
+_EOL_RE = re.compile(rb'\r\n|\n|\r(?!\n)')
+
+# Lines which must be dot-stuffed in the DATA of a message.
+_PERIOD_RE = re.compile(rb'^\.', re.MULTILINE)
+
+# A Bcc header, with any continuation lines.
+_BCC_RE = re.compile(rb'^Bcc:.*(?:\r?\n[ \t].*)*\r?\n', re.MULTILINE | re.IGNORECASE)
+
+#-------------------------------------------------------------------
+class MailSenderException(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+
+#-------------------------------------------------------------------
+class Outbox():
+    """
+        A directory of messages waiting to be sent.
+
+        Each message is a file holding a line of JSON with its
+        envelope, followed by the raw message.  Files are written to
+        'tmp' and renamed into 'queue'.  A sender claims a message by
+        renaming it into 'active', so that concurrent senders never
+        send the same message, and messages which cannot be sent are
+        moved into 'failed'.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, directory):
+        self.directory = directory
+        self.count = 0
+
+        for subdir in ['tmp', 'queue', 'active', 'failed']:
+            os.makedirs(os.path.join(directory, subdir), exist_ok = True)
+
+    #----------------------------------------------------------------
+    def path(self, subdir, name):
+        return os.path.join(self.directory, subdir, name)
+
+    #----------------------------------------------------------------
+    def write(self, subdir, name, envelope, raw_message):
+        tmp_filename = self.path('tmp', name)
+
+        with open(tmp_filename, 'wb') as f:
+            f.write(json.dumps(envelope).encode('utf-8') + b'\n')
+            f.write(raw_message)
+
+        os.rename(tmp_filename, self.path(subdir, name))
+
+    #----------------------------------------------------------------
+    def read(self, subdir, name, envelope_only = False):
+        with open(self.path(subdir, name), 'rb') as f:
+            envelope = json.loads(f.readline().decode('utf-8'))
+            if envelope_only:
+                return envelope
+            return envelope, f.read()
+
+    #----------------------------------------------------------------
+    def put(self, from_addr, to_addrs, raw_message):
+        """
+            Queue a message for sending.  Returns its name in the
+            outbox.
+        """
+
+        self.count += 1
+        name = '%.6f.P%dQ%d.msg' % (time.time(), os.getpid(), self.count)
+
+        envelope = {
+            'from':         from_addr,
+            'to':           list(to_addrs),
+            'attempts':     0,
+            'next_attempt': 0,
+            'error':        None
+        }
+
+        self.write('queue', name, envelope, raw_message)
+        return name
+
+    #----------------------------------------------------------------
+    def ready(self, now = None):
+        """
+            Get the names of the queued messages due to be sent, oldest
+            first.  Messages left claimed by a dead sender are returned
+            to the queue first.
+        """
+
+        if now is None:
+            now = time.time()
+
+        for name in os.listdir(os.path.join(self.directory, 'active')):
+            try:
+                if os.path.getmtime(self.path('active', name)) < now - STALE_CLAIM_AGE:
+                    os.rename(self.path('active', name), self.path('queue', name))
+            except FileNotFoundError:
+                pass
+
+        names = []
+        for name in sorted(os.listdir(os.path.join(self.directory, 'queue'))):
+            try:
+                envelope = self.read('queue', name, envelope_only = True)
+            except (FileNotFoundError, ValueError):
+                continue
+
+            if envelope ['next_attempt'] <= now:
+                names.append(name)
+
+        return names
+
+    #----------------------------------------------------------------
+    def claim(self, name):
+        """
+            Claim a queued message for sending.  Returns a tuple of
+            (envelope, raw_message), or None if another sender has
+            claimed it already.
+        """
+
+        try:
+            os.rename(self.path('queue', name), self.path('active', name))
+            os.utime(self.path('active', name))
+        except FileNotFoundError:
+            return None
+
+        return self.read('active', name)
+
+    #----------------------------------------------------------------
+    def release(self, name):
+        """
+            Return a claimed message to the queue unchanged.
+        """
+
+        os.rename(self.path('active', name), self.path('queue', name))
+
+    #----------------------------------------------------------------
+    def complete(self, name):
+        """
+            Remove a claimed message once it has been sent.
+        """
+
+        os.remove(self.path('active', name))
+
+    #----------------------------------------------------------------
+    def defer(self, name, envelope, raw_message, error, delay):
+        """
+            Return a claimed message to the queue, to be attempted
+            again after delay seconds.
+        """
+
+        envelope ['error'] = error
+        envelope ['next_attempt'] = time.time() + delay
+        self.write('queue', name, envelope, raw_message)
+        os.remove(self.path('active', name))
+
+    #----------------------------------------------------------------
+    def fail(self, name, envelope, raw_message, error):
+        """
+            Move a claimed message to the failed directory.
+        """
+
+        envelope ['error'] = error
+        self.write('failed', name, envelope, raw_message)
+        os.remove(self.path('active', name))
+
+    #----------------------------------------------------------------
+    def stats(self):
+        """
+            Get the number of messages queued, being sent and failed.
+        """
+
+        return dict((subdir, len(os.listdir(os.path.join(self.directory, subdir))))
+                for subdir in ['queue', 'active', 'failed'])
+
+#-------------------------------------------------------------------
+class MailSender():
+    """
+        An object for sending messages over a single SMTP session,
+        which is reused for every message sent.
+
+        If the server supports PIPELINING (RFC 2920), the MAIL, RCPT
+        and DATA commands of each message are sent together, so a
+        message costs two round trips instead of one per command.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, attempts = SEND_ATTEMPTS, retry_delay = RETRY_DELAY,
+                 retry_max_delay = RETRY_MAX_DELAY):
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.login_args = None
+        self.smtp = None
+        self.sent = 0
+
+    #----------------------------------------------------------------
+    def connect(self, username, password,
+                hostname = "smtp.gmail.com",
+                port = 587, mode = 'tls', timeout = 60):
+        """
+            Connect and log in to the SMTP server.
+
+            mode:
+                'tls' to upgrade the connection with STARTTLS, 'ssl'
+                to connect with TLS from the start, or 'plain'.
+            username:
+                If None, the session is not authenticated.
+        """
+
+        self.login_args = (username, password, hostname, port, mode, timeout)
+
+        if mode == 'ssl':
+            self.smtp = smtplib.SMTP_SSL(hostname, port, timeout = timeout)
+        elif mode in ('tls', 'plain'):
+            self.smtp = smtplib.SMTP(hostname, port, timeout = timeout)
+        else:
+            raise MailSenderException("Unknown SMTP mode \"%s\", expected tls, ssl or plain." % mode)
+
+        self.smtp.ehlo()
+
+        if mode == 'tls':
+            self.smtp.starttls()
+            self.smtp.ehlo()
+
+        if username is not None:
+            self.smtp.login(username, password)
+
+    #----------------------------------------------------------------
+    def reconnect(self):
+        if self.login_args is None:
+            raise MailSenderException("Cannot reconnect, never connected.")
+
+        self.disconnect()
+        self.connect(*self.login_args)
+
+    #----------------------------------------------------------------
+    def disconnect(self):
+        if self.smtp is None:
+            return
+
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+
+        self.smtp = None
+
+    #----------------------------------------------------------------
+    def is_connected(self):
+        return self.smtp is not None and self.smtp.sock is not None
+
+    #----------------------------------------------------------------
+    def has_extension(self, name):
+        """
+            Determine if the server advertised the given ESMTP extension.
+        """
+
+        return self.is_connected() and self.smtp.has_extn(name)
+
+    #----------------------------------------------------------------
+    def send(self, from_addr, to_addrs, raw_message):
+        """
+            Send a raw message to the given recipients.
+
+            Returns a dictionary mapping each refused recipient to its
+            (code, response).  Raises smtplib.SMTPRecipientsRefused if
+            every recipient was refused, smtplib.SMTPSenderRefused or
+            smtplib.SMTPDataError if the message was refused, and
+            smtplib.SMTPServerDisconnected if the session was lost.
+        """
+
+        if not self.is_connected():
+            raise MailSenderException("Cannot send, not connected.")
+
+        addresses = [from_addr] + list(to_addrs)
+
+        if not self.has_extension('pipelining') or \
+                not all(addr.isascii() for addr in addresses):
+            refused = self.smtp.sendmail(from_addr, to_addrs, raw_message)
+
+        else:
+            refused = self.send_pipelined(from_addr, to_addrs, raw_message)
+
+        self.sent += 1
+        return refused
+
+    #----------------------------------------------------------------
+    def send_pipelined(self, from_addr, to_addrs, raw_message):
+        smtp = self.smtp
+
+        data = _PERIOD_RE.sub(b'..', _EOL_RE.sub(_CRLF, raw_message))
+        if not data.endswith(_CRLF):
+            data += _CRLF
+
+        options = ''
+        if smtp.has_extn('size'):
+            options = ' SIZE=%d' % len(data)
+
+        commands = ['MAIL FROM:%s%s' % (smtplib.quoteaddr(from_addr), options)]
+        commands.extend('RCPT TO:%s' % smtplib.quoteaddr(addr) for addr in to_addrs)
+        commands.append('DATA')
+
+        smtp.send(''.join(command + '\r\n' for command in commands))
+
+        # Every reply must be read, even after a failure, to keep the
+        # session in step for the next message.
+        replies = [smtp.getreply() for command in commands]
+        mail_reply, rcpt_replies, data_reply = replies [0], replies [1:-1], replies [-1]
+
+        refused = {}
+        for addr, (code, response) in zip(to_addrs, rcpt_replies):
+            if code not in (250, 251):
+                refused [addr] = (code, response)
+
+        if data_reply [0] != 354:
+            smtp.rset()
+
+            if mail_reply [0] != 250:
+                raise smtplib.SMTPSenderRefused(mail_reply [0], mail_reply [1], from_addr)
+            elif len(refused) == len(to_addrs):
+                raise smtplib.SMTPRecipientsRefused(refused)
+            raise smtplib.SMTPDataError(*data_reply)
+
+        smtp.send(data + b'.' + _CRLF)
+
+        code, response = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+
+        return refused
+
+    #----------------------------------------------------------------
+    def send_outbox(self, outbox, limit = None, log = None, on_sent = None):
+        """
+            Send the messages in the outbox which are due, over this
+            session.  If the session is lost it is reconnected.
+
+            Messages refused with a temporary (4xx) error, or which
+            could not be sent because the server was unreachable, are
+            deferred with exponential backoff.  Messages refused with a
+            permanent (5xx) error, or attempted too many times, are
+            moved to the failed directory of the outbox.
+
+            log:
+                If specified, a callable taking the name of each message
+                and its outcome: 'sent', 'deferred' or 'failed', followed
+                by the error if any.
+            on_sent:
+                If specified, a callable taking the envelope and raw
+                bytes of each message once it has been sent, e.g. to
+                save a copy to the Sent mailbox.
+
+            Returns a dictionary counting each outcome.
+        """
+
+        counts = {'sent': 0, 'deferred': 0, 'failed': 0}
+        names = outbox.ready()
+
+        if limit is not None:
+            names = names [:limit]
+
+        for name in names:
+            claimed = outbox.claim(name)
+            if claimed is None:
+                continue
+
+            envelope, raw_message = claimed
+
+            if not self.is_connected():
+                try:
+                    self.reconnect()
+                except BaseException:
+                    # The message was not attempted, so it is returned
+                    # to the queue as it was.
+                    outbox.release(name)
+                    raise
+
+            envelope ['attempts'] += 1
+            error = None
+            permanent = False
+
+            try:
+                refused = self.send(envelope ['from'], envelope ['to'], raw_message)
+                if refused:
+                    # Only the refused recipients are attempted again.
+                    envelope ['to'] = [addr for addr in envelope ['to'] if addr in refused]
+                    error = _describe_refused(refused)
+                    permanent = all(code >= 500 for code, response in refused.values())
+
+            except smtplib.SMTPRecipientsRefused as e:
+                error = _describe_refused(e.recipients)
+                permanent = all(code >= 500 for code, response in e.recipients.values())
+
+            except smtplib.SMTPResponseException as e:
+                error = '%d %s' % (e.smtp_code, _decode(e.smtp_error))
+                permanent = e.smtp_code >= 500
+
+            except CONNECTION_ERRORS as e:
+                error = str(e) or e.__class__.__name__
+                self.disconnect()
+
+            except BaseException:
+                outbox.release(name)
+                raise
+
+            if error is None:
+                outbox.complete(name)
+                outcome = 'sent'
+
+                if on_sent is not None:
+                    on_sent(envelope, raw_message)
+
+            elif permanent or envelope ['attempts'] >= self.attempts:
+                outbox.fail(name, envelope, raw_message, error)
+                outcome = 'failed'
+
+            else:
+                delay = min(self.retry_max_delay,
+                            self.retry_delay * 2 ** (envelope ['attempts'] - 1))
+                outbox.defer(name, envelope, raw_message, error,
+                             delay * random.uniform(0.5, 1.0))
+                outcome = 'deferred'
+
+            counts [outcome] += 1
+            if log is not None:
+                log(name, outcome, error)
+
+        return counts
+
+#-------------------------------------------------------------------
+def envelope_recipients(raw_message):
+    """
+        Get the recipients of a raw message from its To, Cc and Bcc
+        headers.  Returns a tuple of (recipients, raw_message), where
+        the Bcc header has been removed from the message.
+    """
+
+    header_end = len(raw_message)
+    for separator in (b'\r\n\r\n', b'\n\n'):
+        n = raw_message.find(separator)
+        if 0 <= n < header_end:
+            header_end = n + len(separator)
+
+    header = email.parser.BytesHeaderParser().parsebytes(raw_message[:header_end])
+    recipients = [addr for name, addr in email.utils.getaddresses(
+                    header.get_all('to', []) + header.get_all('cc', []) +
+                    header.get_all('bcc', []))
+                  if addr]
+
+    if 'bcc' in header:
+        raw_message = _BCC_RE.sub(b'', raw_message[:header_end]) + raw_message[header_end:]
+
+    return recipients, raw_message
+
+#-------------------------------------------------------------------
+def _decode(response):
+    if isinstance(response, bytes):
+        return response.decode('utf-8', 'replace')
+    return str(response)
+
+#-------------------------------------------------------------------
+def _describe_refused(refused):
+    return ', '.join('%s: %d %s' % (addr, code, _decode(response))
+                     for addr, (code, response) in sorted(refused.items()))
@@ -0,0 +1,180 @@
+#-------------------------------------------------------------------
+# webmail.stats
+#
+# Instrumentation of the IMAP commands sent by each connection,
+# with per-verb aggregates and hooks for metrics exporters.
+#-------------------------------------------------------------------
+
+import collections
+import threading
+
+# The number of individual command records kept for inspection.
+HISTORY_SIZE = 1000
+
+#-------------------------------------------------------------------
+class CommandRecord():
+    """
+        The measurements of a single IMAP command.
+
+        verb:
+            The command name, e.g. 'SELECT' or 'UID FETCH'.
+        tag:
+            The tag the command was sent with.
+        status:
+            The status of the tagged response, e.g. 'OK', or 'ABORT'
+            if the connection failed before it arrived.
+        bytes_sent, bytes_received:
+            The bytes sent and received while the command was
+            outstanding, before compression.
+        wire_bytes_sent, wire_bytes_received:
+            As above, as counted on the socket.
+        latency:
+            Seconds from sending the command to its tagged response.
+    """
+
+    __slots__ = ('verb', 'tag', 'status', 'bytes_sent', 'bytes_received',
+                 'wire_bytes_sent', 'wire_bytes_received', 'latency')
+
+    #----------------------------------------------------------------
+    def __init__(self, verb, tag, status, bytes_sent, bytes_received,
+                 wire_bytes_sent, wire_bytes_received, latency):
+        self.verb = verb
+        self.tag = tag
+        self.status = status
+        self.bytes_sent = bytes_sent
+        self.bytes_received = bytes_received
+        self.wire_bytes_sent = wire_bytes_sent
+        self.wire_bytes_received = wire_bytes_received
+        self.latency = latency
+
+    #----------------------------------------------------------------
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+#-------------------------------------------------------------------
+class CommandStats():
+    """
+        Aggregates CommandRecords by verb, and passes each record to
+        the registered hooks as it is completed.
+
+        A hook is any callable taking a CommandRecord, e.g. to feed
+        a StatsD client:
+
+            stats.add_hook(lambda record: statsd.timing(
+                'imap.' + record.verb.replace(' ', '_').lower(),
+                record.latency * 1000))
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, history = HISTORY_SIZE):
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.history = history
+        self.reset()
+
+    #----------------------------------------------------------------
+    def reset(self):
+        with self.lock:
+            self.verbs = collections.OrderedDict()
+            self.records = collections.deque(maxlen = self.history)
+
+    #----------------------------------------------------------------
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    #----------------------------------------------------------------
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    #----------------------------------------------------------------
+    def record(self, record):
+        with self.lock:
+            totals = self.verbs.get(record.verb)
+            if totals is None:
+                totals = self.verbs [record.verb] = {
+                    'count':                0,
+                    'errors':               0,
+                    'bytes_sent':           0,
+                    'bytes_received':       0,
+                    'wire_bytes_sent':      0,
+                    'wire_bytes_received':  0,
+                    'latency':              0.0,
+                    'max_latency':          0.0
+                }
+
+            totals ['count'] += 1
+            if record.status != 'OK':
+                totals ['errors'] += 1
+            totals ['bytes_sent'] += record.bytes_sent
+            totals ['bytes_received'] += record.bytes_received
+            totals ['wire_bytes_sent'] += record.wire_bytes_sent
+            totals ['wire_bytes_received'] += record.wire_bytes_received
+            totals ['latency'] += record.latency
+            totals ['max_latency'] = max(totals ['max_latency'], record.latency)
+
+            self.records.append(record)
+
+        for hook in list(self.hooks):
+            hook(record)
+
+    #----------------------------------------------------------------
+    def summary(self):
+        """
+            Get a dictionary mapping each verb to its totals, with
+            an additional 'TOTAL' entry across all verbs.
+        """
+
+        with self.lock:
+            summary = collections.OrderedDict(
+                    (verb, dict(totals)) for verb, totals in self.verbs.items())
+
+        total = dict((name, 0) for name in ['count', 'errors', 'bytes_sent',
+            'bytes_received', 'wire_bytes_sent', 'wire_bytes_received',
+            'latency', 'max_latency'])
+
+        for totals in summary.values():
+            for name, value in totals.items():
+                if name == 'max_latency':
+                    total [name] = max(total [name], value)
+                else:
+                    total [name] += value
+
+        summary ['TOTAL'] = total
+        return summary
+
+    #----------------------------------------------------------------
+    def format_summary(self):
+        """
+            Format the summary as a table, one line per verb.
+        """
+
+        lines = ["%-14s %7s %7s %11s %13s %10s %10s %10s" % (
+            'Command', 'Count', 'Errors', 'Sent', 'Received',
+            'Total', 'Mean', 'Max')]
+
+        for verb, totals in self.summary().items():
+            lines.append("%-14s %7d %7d %11d %13d %9.3fs %9.2fms %8.2fms" % (
+                verb, totals ['count'], totals ['errors'],
+                totals ['bytes_sent'], totals ['bytes_received'],
+                totals ['latency'],
+                totals ['latency'] * 1000 / max(totals ['count'], 1),
+                totals ['max_latency'] * 1000))
+
+        return '\n'.join(lines)
+
+#-------------------------------------------------------------------
+# The statistics of all IMAP connections in this process.
+command_stats = CommandStats()
+
+#-------------------------------------------------------------------
+def add_hook(hook):
+    """
+        Register a callable to receive the CommandRecord of every
+        IMAP command completed in this process.
+    """
+
+    command_stats.add_hook(hook)
+
+#-------------------------------------------------------------------
+def remove_hook(hook):
+    command_stats.remove_hook(hook)
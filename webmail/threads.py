@@ -0,0 +1,343 @@
+#-------------------------------------------------------------------
+# webmail.threads
+#
+# Conversation threading of header index records, following
+# Jamie Zawinski's algorithm (https://www.jwz.org/doc/threading.html).
+#-------------------------------------------------------------------
+
+import contextlib
+import gc
+import re
+
+#-------------------------------------------------------------------
+# Matches a message ID in an In-Reply-To header.
+MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+
+# Matches reply and forward prefixes in a subject.
+SUBJECT_PREFIX_RE = re.compile(r'^(?:\s*(?:re|fwd?|aw|sv)(?:\[\d+\])?\s*:|\s*\[[^\]]*\])+\s*', re.IGNORECASE)
+
+#-------------------------------------------------------------------
+@contextlib.contextmanager
+def _gc_paused():
+    # Threading a large mailbox allocates many linked objects, which
+    # would otherwise trigger repeated full garbage collections.
+    enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+#-------------------------------------------------------------------
+class Container():
+    """
+        A node in the message ID table, which may hold a message or
+        may only stand in for a message that has been referred to.
+    """
+
+    __slots__ = ('record', 'parent', 'children')
+
+    #----------------------------------------------------------------
+    def __init__(self):
+        self.record = None
+        self.parent = None
+        self.children = []
+
+    #----------------------------------------------------------------
+    def has_descendant(self, container):
+        while container is not None:
+            if container is self:
+                return True
+            container = container.parent
+
+        return False
+
+    #----------------------------------------------------------------
+    def set_parent(self, parent):
+        if self.parent is not None:
+            self.parent.children.remove(self)
+
+        self.parent = parent
+        if parent is not None:
+            parent.children.append(self)
+
+#-------------------------------------------------------------------
+class ThreadNode():
+    """
+        A message in a thread.  The record is None for a missing
+        message whose replies were found.
+    """
+
+    __slots__ = ('record', 'children', 'latest')
+
+    #----------------------------------------------------------------
+    def __init__(self, record, children, latest = None):
+        self.record = record
+        self.children = children
+
+        if latest is None:
+            latest = max([(record ['date'] or 0) if record else 0] +
+                         [child.latest for child in children])
+        self.latest = latest
+
+    #----------------------------------------------------------------
+    def walk(self, depth = 0):
+        """
+            Yield a (depth, node) tuple for this node and each of
+            its descendants in depth-first order.
+        """
+
+        # Walked with an explicit stack rather than recursion, as a
+        # chain of replies may be thousands of messages deep.
+        stack = [(depth, self)]
+        while stack:
+            depth, node = stack.pop()
+            yield depth, node
+            for child in reversed(node.children):
+                stack.append((depth + 1, child))
+
+#-------------------------------------------------------------------
+def normalize_subject(subject):
+    """
+        Strip reply and forward prefixes from a subject.
+    """
+
+    return SUBJECT_PREFIX_RE.sub('', subject or '').strip().lower()
+
+#-------------------------------------------------------------------
+def _references(record):
+    refs = (record ['refs'] or '').split()
+    in_reply_to = record ['in_reply_to']
+
+    if in_reply_to and (not refs or in_reply_to != refs[-1]):
+        in_reply_to = MESSAGE_ID_RE.findall(in_reply_to)
+        if in_reply_to and (not refs or refs[-1] != in_reply_to[0]):
+            refs.append(in_reply_to[0])
+
+    return refs
+
+#-------------------------------------------------------------------
+class Threader():
+    """
+        Builds conversation threads from header index records.
+
+        Messages may be added at any time, e.g. as they arrive while
+        watching a mailbox; the links between messages are kept, and
+        only the final pruning and sorting is done by threads().
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, records = ()):
+        self.id_table = {}
+        self.count = 0
+
+        with _gc_paused():
+            for record in records:
+                self.add(record)
+
+    #----------------------------------------------------------------
+    def get_container(self, message_id):
+        container = self.id_table.get(message_id)
+        if container is None:
+            container = self.id_table [message_id] = Container()
+
+        return container
+
+    #----------------------------------------------------------------
+    def add(self, record):
+        """
+            Add a header index record and link it to the messages it
+            refers to.
+        """
+
+        self.count += 1
+
+        message_id = record ['message_id']
+        container = self.id_table.get(message_id) if message_id else None
+
+        if container is None or container.record is not None:
+            # Messages without an ID, or with the ID of a message
+            # already seen, are threaded as distinct messages.
+            if not message_id or container is not None:
+                message_id = '%s#%d' % (message_id, record ['uid'])
+            container = self.get_container(message_id)
+
+        container.record = record
+
+        # Link each reference to the one before it, unless a parent
+        # has been found already or it would create a loop.
+        id_table = self.id_table
+        parent = None
+        for ref in _references(record):
+            ref_container = id_table.get(ref)
+            if ref_container is None:
+                ref_container = id_table [ref] = Container()
+                if parent is not None:
+                    ref_container.set_parent(parent)
+
+            elif parent is not None and ref_container.parent is None and \
+                    ref_container is not parent and \
+                    not ref_container.has_descendant(parent):
+                ref_container.set_parent(parent)
+
+            parent = ref_container
+
+        if parent is not None and (parent is container or container.has_descendant(parent)):
+            parent = None
+
+        if container.parent is not parent:
+            container.set_parent(parent)
+
+    #----------------------------------------------------------------
+    def threads(self):
+        """
+            Get the current threads as a list of root ThreadNodes,
+            most recently active thread first.  Replies within a
+            thread are sorted by date.
+        """
+
+        roots = []
+
+        with _gc_paused():
+            for container in self.id_table.values():
+                if container.parent is None:
+                    roots.extend(_collect(container, True))
+
+            roots = _group_by_subject(roots)
+        roots.sort(key = lambda node: node.latest, reverse = True)
+        return roots
+
+#-------------------------------------------------------------------
+def _collect(container, is_root = False):
+    """
+        Convert a container to a list of ThreadNodes, dropping
+        containers with no message and promoting their children.
+        A root with no message is kept if it has several children,
+        as they are siblings in the same thread.
+    """
+
+    # Each entry holds a container, an iterator over its children and
+    # the nodes they have been converted to so far.  Containers are
+    # converted after their children, without recursion, as a chain of
+    # replies may be thousands of messages deep.
+    stack = [(container, iter(container.children), [])]
+
+    while True:
+        current, pending, children = stack [-1]
+
+        child = next(pending, None)
+        if child is not None:
+            stack.append((child, iter(child.children), []))
+            continue
+
+        stack.pop()
+        nodes = _convert(current, children, is_root and not stack)
+
+        if not stack:
+            return nodes
+        stack [-1][2].extend(nodes)
+
+#-------------------------------------------------------------------
+def _convert(container, children, is_root):
+    record = container.record
+
+    if not children:
+        if record is None:
+            return []
+        return [ThreadNode(record, [], record ['date'] or 0)]
+
+    if len(children) > 1:
+        children.sort(key = _node_date)
+
+    latest = 0
+    for child in children:
+        if child.latest > latest:
+            latest = child.latest
+
+    if record is not None:
+        date = record ['date'] or 0
+        return [ThreadNode(record, children, date if date > latest else latest)]
+    elif is_root and len(children) > 1:
+        return [ThreadNode(None, children, latest)]
+    else:
+        return children
+
+#-------------------------------------------------------------------
+def _node_date(node):
+    return (node.record ['date'] or 0) if node.record is not None else node.latest
+
+#-------------------------------------------------------------------
+def _group_by_subject(roots):
+    """
+        Gather replies at the root level under the root message with
+        the same subject, where a thread was broken by a client that
+        did not send references.
+    """
+
+    originals = {}
+    replies = []
+
+    for node in roots:
+        if node.record is None:
+            continue
+
+        subject = normalize_subject(node.record ['subject'])
+        if not subject:
+            continue
+
+        if subject != (node.record ['subject'] or '').strip().lower():
+            replies.append((subject, node))
+        elif subject not in originals:
+            originals [subject] = node
+
+    moved = set()
+    for subject, node in replies:
+        root = originals.get(subject)
+        if root is not None:
+            root.children.append(node)
+            root.latest = max(root.latest, node.latest)
+            moved.add(id(node))
+
+    return [node for node in roots if id(node) not in moved]
+
+#-------------------------------------------------------------------
+def thread_records(records):
+    """
+        Thread the given header index records, returning a list of
+        root ThreadNodes as for Threader.threads().
+    """
+
+    return Threader(records).threads()
+
+#-------------------------------------------------------------------
+def thread_tree(tree, records):
+    """
+        Convert a thread tree from MailClient.thread() into a list of
+        root ThreadNodes, using the given dictionary mapping UIDs to
+        header index records.
+    """
+
+    roots = []
+
+    # Converted without recursion as for _collect(), each entry holding
+    # a UID, an iterator over its children and the nodes they have been
+    # converted to so far.
+    for uid, children in tree:
+        stack = [(uid, iter(children), [])]
+
+        while stack:
+            uid, pending, nodes = stack [-1]
+
+            child = next(pending, None)
+            if child is not None:
+                stack.append((child [0], iter(child [1]), []))
+                continue
+
+            stack.pop()
+            node = ThreadNode(records.get(uid) if uid is not None else None, nodes)
+            (stack [-1][2] if stack else roots).append(node)
+
+    roots.sort(key = lambda node: node.latest, reverse = True)
+    return roots
@@ -0,0 +1,163 @@
+#-------------------------------------------------------------------
+# webmail.timing
+#
+# Phase timers which attribute the running time of a command to
+# config loading, login, mailbox selection, search, fetch, parse
+# and render, with output as a summary or a Chrome trace file.
+#-------------------------------------------------------------------
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+# The maximum number of individual phases kept for a trace file.
+# Phase totals are always kept in full.
+MAX_EVENTS = 100000
+
+#-------------------------------------------------------------------
+class PhaseTimer():
+    """
+        Measures named phases, which may be nested.  Each phase is
+        counted with its total time and its self time, which excludes
+        the time spent in the phases nested within it.
+
+        Phases are timed in every thread, each with its own nesting.
+    """
+
+    #----------------------------------------------------------------
+    def __init__(self, max_events = MAX_EVENTS):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.max_events = max_events
+        self.reset()
+
+    #----------------------------------------------------------------
+    def reset(self):
+        with self.lock:
+            self.origin = time.perf_counter()
+            self.phases = collections.OrderedDict()
+            self.events = []
+
+    #----------------------------------------------------------------
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+            Time the enclosed block as a phase with the given name.
+        """
+
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+
+        # Each entry is [name, start, time spent in nested phases].
+        entry = [name, time.perf_counter(), 0.0]
+        stack.append(entry)
+
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            stack.pop()
+
+            duration = end - entry[1]
+            if stack:
+                stack[-1][2] += duration
+
+            # A phase nested in another of the same name, e.g. a fetch
+            # made while fetching, is only counted once in the total.
+            recursive = any(outer[0] == name for outer in stack)
+            self.add(name, entry[1], duration, duration - entry[2], recursive)
+
+    #----------------------------------------------------------------
+    def add(self, name, start, duration, self_time = None, recursive = False):
+        """
+            Record a phase which has already completed, where start
+            is a time.perf_counter() value.
+        """
+
+        if self_time is None:
+            self_time = duration
+
+        with self.lock:
+            totals = self.phases.get(name)
+            if totals is None:
+                totals = self.phases [name] = {
+                    'count':        0,
+                    'total':        0.0,
+                    'self':         0.0
+                }
+
+            totals ['count'] += 1
+            if not recursive:
+                totals ['total'] += duration
+            totals ['self'] += self_time
+
+            if len(self.events) < self.max_events:
+                self.events.append((name, start, duration, threading.get_ident()))
+
+    #----------------------------------------------------------------
+    def format_summary(self):
+        """
+            Format the phase totals as a table, in the order each phase
+            was first completed.
+        """
+
+        with self.lock:
+            phases = [(name, dict(totals)) for name, totals in self.phases.items()]
+            elapsed = time.perf_counter() - self.origin
+
+        lines = ["%-14s %7s %10s %10s %7s" % ('Phase', 'Count', 'Total', 'Self', '%')]
+
+        for name, totals in phases:
+            lines.append("%-14s %7d %9.3fs %9.3fs %6.1f%%" % (
+                name, totals ['count'], totals ['total'], totals ['self'],
+                totals ['self'] * 100 / elapsed if elapsed else 0))
+
+        lines.append("%-14s %7s %9.3fs" % ('ELAPSED', '', elapsed))
+        return '\n'.join(lines)
+
+    #----------------------------------------------------------------
+    def write_trace(self, filename):
+        """
+            Write the recorded phases as a Chrome trace event file,
+            which can be opened in chrome://tracing or Perfetto.
+        """
+
+        with self.lock:
+            events = list(self.events)
+            origin = self.origin
+
+        pid = os.getpid()
+        trace = {
+            'traceEvents': [{
+                'name':     name,
+                'cat':      'webmail',
+                'ph':       'X',
+                'ts':       (start - origin) * 1e6,
+                'dur':      duration * 1e6,
+                'pid':      pid,
+                'tid':      tid
+            } for name, start, duration, tid in events],
+            'displayTimeUnit': 'ms'
+        }
+
+        with open(filename, 'w') as outfile:
+            json.dump(trace, outfile)
+
+#-------------------------------------------------------------------
+# The phase timer of this process.
+timer = PhaseTimer()
+
+#-------------------------------------------------------------------
+def phase(name):
+    """
+        Time the enclosed block as a phase of the current command, e.g.
+
+            with timing.phase('search'):
+                uids = client.search(query)
+    """
+
+    return timer.phase(name)
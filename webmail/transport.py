@@ -0,0 +1,313 @@
+#-------------------------------------------------------------------
+# webmail.transport
+#
+# Socket level transport for IMAP connections, replacing the
+# buffered file objects used by imaplib with a buffer we control.
+#-------------------------------------------------------------------
+
+import imaplib
+import re
+import select
+import time
+import zlib
+
+from . import stats
+
+# The maximum length of a single response line, as enforced by imaplib.
+MAX_LINE = imaplib._MAXLINE
+
+# The number of bytes requested from the socket per read.
+READ_SIZE = 65536
+
+# COMPRESS (RFC 4978) is not known to imaplib.
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+# Matches an untagged response line, e.g. "* 12 EXISTS".
+UNTAGGED_RE = re.compile(rb'^\* (?:(?P<num>\d+) )?(?P<type>[A-Za-z-]+)(?: (?P<data>.*))?$')
+
+#-------------------------------------------------------------------
+class BufferedTransport():
+    """
+        A mixin for imaplib.IMAP4 classes which reads from the
+        socket into a buffer owned by the connection, so that
+        we always know whether a response is waiting to be read.
+        This is needed to wait on the socket while in IDLE.
+
+        While record_unsolicited is set, mailbox status responses
+        are also recorded in the order in which they were received,
+        see take_unsolicited().
+
+        The transport also supports COMPRESS=DEFLATE, see compress(),
+        and counts the bytes sent and received both on the wire and
+        after decompression.  Each command is timed and recorded in
+        stats.command_stats, see begin_command().
+
+        capabilities:
+            The capabilities the server is known to advertise before
+            login, e.g. from a CapabilityCache.  If given, and the
+            server does not list its capabilities in its greeting,
+            they are used instead of sending CAPABILITY.
+    """
+
+    record_unsolicited = False
+
+    #----------------------------------------------------------------
+    def __init__(self, *args, capabilities = None, **kwargs):
+        self.known_capabilities = capabilities
+        super().__init__(*args, **kwargs)
+
+    #----------------------------------------------------------------
+    def open(self, *args, **kwargs):
+        self._inbuf = bytearray()
+        self._unsolicited = []
+        self._compressor = None
+        self._decompressor = None
+
+        self.wire_bytes_sent = 0
+        self.wire_bytes_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._commands = {}
+
+        super().open(*args, **kwargs)
+
+    #----------------------------------------------------------------
+    def begin_command(self, verb, tag):
+        """
+            Start measuring a command, before it is sent with the
+            given tag.  Commands sent by imaplib are measured
+            automatically; this is for commands sent directly.
+        """
+
+        self._commands [tag] = (verb, time.perf_counter(),
+                self.bytes_sent, self.bytes_received,
+                self.wire_bytes_sent, self.wire_bytes_received)
+
+    #----------------------------------------------------------------
+    def end_command(self, tag, status):
+        """
+            Record the command with the given tag as completed with
+            the given status.
+        """
+
+        start = self._commands.pop(tag, None)
+        if start is None:
+            return
+
+        verb, started, sent, received, wire_sent, wire_received = start
+
+        if isinstance(tag, bytes):
+            tag = tag.decode('ascii', 'replace')
+
+        stats.command_stats.record(stats.CommandRecord(
+            verb, tag, status,
+            self.bytes_sent - sent, self.bytes_received - received,
+            self.wire_bytes_sent - wire_sent, self.wire_bytes_received - wire_received,
+            time.perf_counter() - started))
+
+    #----------------------------------------------------------------
+    def _command(self, name, *args):
+        verb = name
+        if name == 'UID' and args:
+            verb = 'UID %s' % str(args [0]).upper()
+
+        # The tag is not known until the command is built, so it is
+        # predicted the same way imaplib assigns it.
+        tag = ('%s%s' % (self.tagpre.decode('ascii'), self.tagnum)).encode('ascii')
+        self.begin_command(verb, tag)
+
+        try:
+            return super()._command(name, *args)
+        except Exception:
+            self.end_command(tag, 'ABORT')
+            raise
+
+    #----------------------------------------------------------------
+    def _command_complete(self, name, tag):
+        try:
+            typ, data = super()._command_complete(name, tag)
+        except Exception:
+            self.end_command(tag, 'ABORT')
+            raise
+
+        # imaplib reports the BYE of a successful LOGOUT as its status.
+        self.end_command(tag, 'OK' if name == 'LOGOUT' and typ == 'BYE' else typ)
+        return typ, data
+
+    #----------------------------------------------------------------
+    def _get_capabilities(self):
+        # Most servers list their capabilities in the greeting, which
+        # imaplib ignores in favour of asking with CAPABILITY.
+        data = self.untagged_responses.pop('CAPABILITY', None)
+
+        if data and data [-1]:
+            self.capabilities = tuple(data [-1].decode('ascii', 'replace').upper().split())
+        elif self.known_capabilities:
+            self.capabilities = tuple(name.upper() for name in self.known_capabilities)
+        else:
+            super()._get_capabilities()
+
+    #----------------------------------------------------------------
+    def compress(self):
+        """
+            Negotiate COMPRESS=DEFLATE with the server.  Once enabled,
+            all data in both directions is compressed with a raw
+            DEFLATE stream for the rest of the connection.
+        """
+
+        typ, dat = self._simple_command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            raise self.error('COMPRESS failed: %s' % dat)
+
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+
+        # Anything already buffered arrived after the server's OK.
+        if self._inbuf:
+            self._inbuf = bytearray(self._decompressor.decompress(bytes(self._inbuf)))
+
+        return typ, dat
+
+    #----------------------------------------------------------------
+    def is_compressed(self):
+        return self._compressor is not None
+
+    #----------------------------------------------------------------
+    def send(self, data):
+        self.bytes_sent += len(data)
+
+        if self._compressor is not None:
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        self.wire_bytes_sent += len(data)
+        super().send(data)
+
+    #----------------------------------------------------------------
+    def _recv(self):
+        """
+            Read the next block of data from the socket, decompressing
+            it if compression is enabled.
+        """
+
+        while True:
+            data = self.sock.recv(READ_SIZE)
+            if not data:
+                raise self.abort('socket error: EOF')
+
+            self.wire_bytes_received += len(data)
+
+            if self._decompressor is not None:
+                data = self._decompressor.decompress(data)
+
+            if data:
+                self.bytes_received += len(data)
+                return data
+
+    #----------------------------------------------------------------
+    def _fill(self):
+        self._inbuf.extend(self._recv())
+
+    #----------------------------------------------------------------
+    def read(self, size):
+        while len(self._inbuf) < size:
+            self._fill()
+
+        data = bytes(self._inbuf[:size])
+        del self._inbuf[:size]
+        return data
+
+    #----------------------------------------------------------------
+    def readline(self):
+        start = 0
+
+        while True:
+            n = self._inbuf.find(b'\n', start)
+            if n >= 0:
+                break
+
+            if len(self._inbuf) > MAX_LINE:
+                raise self.error("got more than %d bytes" % MAX_LINE)
+
+            start = len(self._inbuf)
+            self._fill()
+
+        if n + 1 > MAX_LINE:
+            raise self.error("got more than %d bytes" % MAX_LINE)
+
+        line = bytes(self._inbuf[:n + 1])
+        del self._inbuf[:n + 1]
+        return line
+
+    #----------------------------------------------------------------
+    def has_pending(self):
+        """
+            Determine if data is available to read without blocking
+            on the socket.
+        """
+
+        if self._inbuf:
+            return True
+
+        pending = getattr(self.sock, 'pending', None)
+        return pending is not None and pending() > 0
+
+    #----------------------------------------------------------------
+    def wait_readable(self, timeout):
+        """
+            Wait up to timeout seconds for data to be available.
+            Returns True if data can be read.
+        """
+
+        if self.has_pending():
+            return True
+
+        readable, writable, errors = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    #----------------------------------------------------------------
+    def _append_untagged(self, typ, dat):
+        if self.record_unsolicited and typ in ('EXISTS', 'EXPUNGE', 'FETCH'):
+            self._unsolicited.append((typ, dat))
+
+        super()._append_untagged(typ, dat)
+
+    #----------------------------------------------------------------
+    def take_unsolicited(self):
+        """
+            Return and clear the list of (type, data) tuples for the
+            mailbox status responses received since the last call,
+            in the order in which they were received.
+        """
+
+        responses = self._unsolicited
+        self._unsolicited = []
+        return responses
+
+#-------------------------------------------------------------------
+class IMAP4(BufferedTransport, imaplib.IMAP4):
+    pass
+
+#-------------------------------------------------------------------
+class IMAP4_SSL(BufferedTransport, imaplib.IMAP4_SSL):
+    pass
+
+#-------------------------------------------------------------------
+def parse_untagged(line):
+    """
+        Parse an untagged response line into a (type, data) tuple in
+        the same form imaplib stores untagged responses, or return
+        None if the line is not an untagged response.
+    """
+
+    m = UNTAGGED_RE.match(line.rstrip(b'\r\n'))
+    if m is None:
+        return None
+
+    typ = m.group('type').decode().upper()
+    num = m.group('num')
+    data = m.group('data')
+
+    if num is not None:
+        data = num if data is None else num + b' ' + data
+
+    return typ, data or b''